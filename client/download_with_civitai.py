@@ -5,6 +5,7 @@ Download models from CivitAI using Pod API with token from .env file.
 
 import os
 import json
+import time
 import requests
 import sys
 from pathlib import Path
@@ -51,7 +52,8 @@ def download_from_civitai(pod_url, model_url, model_type, filename=None, overwri
     if civitai_token:
         payload["civitai_token"] = civitai_token
 
-    # Submit download request
+    # Submit as a background download and poll its progress (no long-lived HTTP request)
+    payload["background"] = True
     download_url = f"{pod_url.rstrip('/')}/download"
 
     print(f"Downloading from: {model_url}")
@@ -65,31 +67,75 @@ def download_from_civitai(pod_url, model_url, model_type, filename=None, overwri
             download_url,
             json=payload,
             headers={"Content-Type": "application/json"},
-            timeout=300  # 5 minutes timeout
+            timeout=60
         )
-
-        if response.status_code == 200:
-            result = response.json()
-            print("✅ Download successful!")
-            print(f"   Saved to: {result.get('path', 'unknown')}")
-            print(f"   Size: {result.get('size_mb', 'unknown')} MB")
-            return True
-        else:
+        if response.status_code != 200:
             print(f"❌ Download failed: HTTP {response.status_code}")
             print(f"   Error: {response.text}")
             return False
+        result = response.json()
+        if result.get("status") == "exists":
+            print(f"✅ Already present: {result.get('path')}")
+            return True
+        return wait_for_download(pod_url, result["id"])
 
     except Exception as e:
         print(f"❌ Download failed: {e}")
         return False
 
+
+def wait_for_download(pod_url, task_id, poll_interval=2.0):
+    """Poll GET /download/{id} until the transfer finishes, printing bytes, rate and ETA."""
+    status_url = f"{pod_url.rstrip('/')}/download/{task_id}"
+    while True:
+        st = requests.get(status_url, timeout=30).json()
+        done, total = st.get("bytes", 0), st.get("total")
+        rate = st.get("bytes_per_s", 0) / (1024 * 1024)
+        pct = f"{100 * done / total:5.1f}%" if total else f"{done / (1024 * 1024):.0f} MB"
+        eta = f", ETA {st['eta_s']:.0f}s" if "eta_s" in st else ""
+        print(f"   {st['status']}: {pct} at {rate:.1f} MB/s{eta}")
+        if st["status"] == "COMPLETED":
+            res = st.get("result") or {}
+            print("✅ Download successful!")
+            print(f"   Saved to: {res.get('path', 'unknown')}")
+            if res.get("size") is not None:
+                print(f"   Size: {res['size'] / (1024 * 1024):.1f} MB")
+            return True
+        if st["status"] == "FAILED":
+            print(f"❌ Download failed: {st.get('error')}")
+            return False
+        time.sleep(poll_interval)
+
+
+def download_batch(pod_url, items_file):
+    """Queue every entry of a JSON list of /download bodies with POST /download/batch and wait for all."""
+    load_dotenv_if_present()
+    token = os.getenv("CIVITAI_TOKEN") or os.getenv("CIVITAI_API_TOKEN")
+    items = json.loads(Path(items_file).read_text())
+    for item in items:
+        if token and "civitai.com" in item.get("url", ""):
+            item.setdefault("civitai_token", token)
+    resp = requests.post(f"{pod_url.rstrip('/')}/download/batch", json={"items": items}, timeout=60)
+    resp.raise_for_status()
+    ok = True
+    for entry in resp.json()["downloads"]:
+        if "id" in entry:
+            ok = wait_for_download(pod_url, entry["id"]) and ok
+        elif entry.get("status") == "exists":
+            print(f"✅ Already present: {entry.get('path')}")
+        else:
+            print(f"❌ {entry.get('url')}: {entry.get('error')}")
+            ok = False
+    return ok
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(description="Download models from CivitAI via Pod API")
     parser.add_argument("--pod-url", required=True, help="Pod API URL (e.g. https://abc123-8000.proxy.runpod.net)")
-    parser.add_argument("--url", required=True, help="CivitAI model download URL")
-    parser.add_argument("--type", required=True, choices=[
+    parser.add_argument("--url", help="CivitAI model download URL")
+    parser.add_argument("--batch", help="JSON file with a list of /download bodies to fetch in one go")
+    parser.add_argument("--type", choices=[
         "checkpoints", "loras", "vae", "controlnet", "clip", "clip_vision", "unet", "embeddings"
     ], help="Model type/category")
     parser.add_argument("--filename", help="Custom filename (optional)")
@@ -97,6 +143,11 @@ def main():
 
     args = parser.parse_args()
 
+    if args.batch:
+        sys.exit(0 if download_batch(args.pod_url, args.batch) else 1)
+    if not (args.url and args.type):
+        parser.error("--url and --type are required unless --batch is given")
+
     success = download_from_civitai(
         pod_url=args.pod_url,
         model_url=args.url,
@@ -76,6 +76,18 @@ def run_plain_async(endpoint_id: str, api_key: str, timeout: int = 180) -> dict:
     return _poll_until_done(base, api_key, jid, timeout)
 
 
+def run_pod_jobs(pod_url: str, api_key: str, timeout: int = 180) -> dict:
+    """Pod mode: POST /jobs then poll /status/<id> (same contract as serverless /run)."""
+    base = pod_url.rstrip("/")
+    body = {"workflow": _noop_workflow()}
+    r = requests.post(f"{base}/jobs", headers=_headers(api_key), data=json.dumps(body), timeout=30)
+    r.raise_for_status()
+    jid = r.json().get("id")
+    if not jid:
+        return {"error": "no_job_id", "response": r.json()}
+    return _poll_until_done(base, api_key, jid, timeout)
+
+
 def run_encrypted_runsync(endpoint_id: str, api_key: str, server_public_key_b64: str, workflow_path: Path | None, timeout: int = 180) -> dict:
     if encrypt_for_server is None:
         return {"error": "pynacl_missing", "hint": "pip install pynacl requests"}
@@ -100,12 +112,13 @@ def run_encrypted_runsync(endpoint_id: str, api_key: str, server_public_key_b64:
 
 def main():
     p = argparse.ArgumentParser(description="RunPod serverless tests for ComfyUI encrypted worker")
-    p.add_argument("mode", choices=["quick", "async", "encrypted"], help="Which test to run")
+    p.add_argument("mode", choices=["quick", "async", "encrypted", "pod"], help="Which test to run")
     p.add_argument("--endpoint-id", default=os.getenv("RP_ENDPOINT_ID"), help="RunPod endpoint ID (env RP_ENDPOINT_ID)")
     p.add_argument("--api-key", default=os.getenv("RP_API_KEY"), help="RunPod API key (env RP_API_KEY)")
     p.add_argument("--public-key", default=os.getenv("SERVER_PUBLIC_KEY_B64"), help="Server public key b64 (required for encrypted mode)")
     p.add_argument("--public-key-file", default=os.getenv("SERVER_PUBLIC_KEY_B64_FILE"), help="Path to a file containing the server public key (b64)")
     p.add_argument("--workflow", default=str(Path(__file__).parent / "examples/minimal_text2img.json"), help="Workflow JSON path (encrypted mode); default example")
+    p.add_argument("--pod-url", default=os.getenv("POD_URL"), help="Pod API base URL (pod mode; env POD_URL)")
     p.add_argument("--timeout", type=int, default=180, help="Timeout seconds for runsync/status polling")
     args = p.parse_args()
 
@@ -120,6 +133,14 @@ def main():
     if not args.api_key:
         args.api_key = os.getenv("RP_API_KEY")
 
+    if args.mode == "pod":
+        pod_url = args.pod_url or os.getenv("POD_URL")
+        if not pod_url:
+            print("error: --pod-url or POD_URL required for pod mode", file=sys.stderr)
+            sys.exit(2)
+        print(json.dumps(run_pod_jobs(pod_url, args.api_key or "", timeout=args.timeout), indent=2))
+        return
+
     if not args.endpoint_id or not args.api_key:
         print("error: endpoint id and api key required (set RP_ENDPOINT_ID and RP_API_KEY)", file=sys.stderr)
         sys.exit(2)
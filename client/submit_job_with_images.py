@@ -13,7 +13,9 @@ repo_root = Path(__file__).resolve().parents[1]
 if str(repo_root) not in sys.path:
     sys.path.insert(0, str(repo_root))
 
-from shared.crypto_secure import encrypt_for_server
+from shared.crypto_secure import (encrypt_for_server, encrypt_for_server_binary_session, iter_chunks,
+                                  stream_encryptor_for_server, decrypt_from_server, stream_decryptor_from_server)
+from shared.payload_codec import pack_payload, unpack_payload
 
 def encode_image_to_base64(image_path: str) -> str:
     """Convert local image file to base64 data URL."""
@@ -81,6 +83,8 @@ def submit_workflow_with_images(workflow, input_images=None, encrypted=True):
     }
 
     if encrypted:
+        if os.getenv("TENANT_KEY"):
+            payload_data["tenant_key"] = os.getenv("TENANT_KEY")  # stable identity for cache/single-flight/input store
         # Encrypt the entire payload
         encrypted_payload = encrypt_for_server(
             SERVER_PUBLIC_KEY_B64,
@@ -113,6 +117,95 @@ def submit_workflow_with_images(workflow, input_images=None, encrypted=True):
     print("Response:", json.dumps(result, indent=2))
     return result
 
+def submit_workflow_binary(pod_url, workflow, input_images=None, outputs_dir=None):
+    """
+    Pod mode: send local images as raw bytes inside one encrypted binary body
+    (POST /run/binary) instead of base64 data URLs inside JSON.
+    URLs and data: strings are passed through as input_images.
+    With outputs_dir, the generated files are returned (sealed to this request) and saved there.
+    """
+    SERVER_PUBLIC_KEY_B64 = os.getenv("SERVER_PUBLIC_KEY_B64")
+    if not SERVER_PUBLIC_KEY_B64:
+        raise ValueError("Missing SERVER_PUBLIC_KEY_B64 for encryption")
+
+    meta = {"workflow": workflow}
+    if os.getenv("TENANT_KEY"):
+        meta["tenant_key"] = os.getenv("TENANT_KEY")
+    blobs, refs = {}, {}
+    for filename, image_data in (input_images or {}).items():
+        image_data = str(image_data)
+        if image_data.startswith(('http', 'data:')):
+            refs[filename] = image_data
+        else:
+            path = Path(image_data)
+            if not path.exists():
+                raise FileNotFoundError(f"Image not found: {image_data}")
+            blobs[filename] = path.read_bytes()
+    if refs:
+        meta["input_images"] = refs
+    if outputs_dir:
+        meta["return_outputs"] = True
+
+    body, eph_sk = encrypt_for_server_binary_session(SERVER_PUBLIC_KEY_B64, pack_payload(meta, blobs))
+    url = f"{pod_url.rstrip('/')}/run/binary"
+    print(f"Submitting to: {url} ({len(body)} bytes, binary)")
+    print(f"Images: {list(blobs) + list(refs) or 'None'}")
+
+    response = requests.post(url, data=body, headers={"content-type": "application/octet-stream"}, timeout=300)
+    if response.status_code != 200:
+        print(f"Error {response.status_code}: {response.text}")
+        return None
+
+    result = response.json()
+    if outputs_dir and result.get("outputs"):
+        for path in save_outputs(pod_url, result.pop("outputs"), eph_sk, SERVER_PUBLIC_KEY_B64, outputs_dir):
+            print(f"Saved output: {path}")
+    print("Response:", json.dumps(result, indent=2))
+    return result
+
+def save_outputs(pod_url, outputs, eph_sk_b64, server_pk_b64, outputs_dir):
+    """
+    Open a result's sealed 'outputs' (see return_outputs) and write every file under outputs_dir:
+    inline files come from the sealed payload, large ones from their one-shot /outputs/<token> link.
+    """
+    meta, blobs = unpack_payload(decrypt_from_server(
+        eph_sk_b64, server_pk_b64, outputs["sealed"]["nonce"], outputs["sealed"]["ciphertext"]))
+    base = Path(outputs_dir).resolve()
+    saved = []
+    for info in meta["files"]:
+        dest = (base / info["name"]).resolve()
+        if not dest.is_relative_to(base):
+            continue
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if info.get("inline"):
+            dest.write_bytes(bytes(blobs[info["name"]]))
+        else:
+            dec = stream_decryptor_from_server(eph_sk_b64, server_pk_b64)
+            with requests.get(f"{pod_url.rstrip('/')}{info['download']}", stream=True, timeout=300) as r:
+                r.raise_for_status()
+                with open(dest, "wb") as f:
+                    for chunk in dec.decrypt_iter(r.iter_content(chunk_size=1024 * 1024)):
+                        f.write(chunk)
+        saved.append(str(dest))
+    return saved
+
+def upload_input_stream(pod_url, filename, path):
+    """
+    Pod mode: stream one large local input (e.g. a video for i2v) to /inputs/stream/<filename>
+    with chunked encryption; memory use stays at one chunk on both ends.
+    """
+    SERVER_PUBLIC_KEY_B64 = os.getenv("SERVER_PUBLIC_KEY_B64")
+    if not SERVER_PUBLIC_KEY_B64:
+        raise ValueError("Missing SERVER_PUBLIC_KEY_B64 for encryption")
+
+    enc = stream_encryptor_for_server(SERVER_PUBLIC_KEY_B64)
+    url = f"{pod_url.rstrip('/')}/inputs/stream/{filename}"
+    with open(path, "rb") as f:
+        response = requests.post(url, data=enc.encrypt_iter(iter_chunks(f)),
+                                 headers={"content-type": "application/octet-stream"}, timeout=300)
+    response.raise_for_status()
+    return response.json()
+
 if __name__ == "__main__":
     # Example usage
     import argparse
@@ -122,6 +215,11 @@ if __name__ == "__main__":
     parser.add_argument("--image", action="append", nargs=2, metavar=("filename", "path_or_url"),
                        help="Add input image: --image filename.png /path/to/image.png")
     parser.add_argument("--no-encrypt", action="store_true", help="Send plaintext (for testing)")
+    parser.add_argument("--pod-url", default=os.getenv("POD_URL"),
+                       help="Pod API base URL; sends one encrypted binary body to /run/binary")
+    parser.add_argument("--stream-image", action="append", nargs=2, metavar=("filename", "path"),
+                       help="Pod mode: pre-upload a large input with chunked streaming encryption")
+    parser.add_argument("--outputs-dir", help="Pod mode: return the generated files (encrypted) and save them here")
 
     args = parser.parse_args()
 
@@ -135,12 +233,21 @@ if __name__ == "__main__":
         for filename, path_or_url in args.image:
             input_images[filename] = path_or_url
 
+    if args.stream_image:
+        if not args.pod_url:
+            parser.error("--stream-image requires --pod-url")
+        for filename, path in args.stream_image:
+            print("Uploaded:", upload_input_stream(args.pod_url, filename, path))
+
     # Submit
-    result = submit_workflow_with_images(
-        workflow=workflow,
-        input_images=input_images,
-        encrypted=not args.no_encrypt
-    )
+    if args.pod_url and not args.no_encrypt:
+        result = submit_workflow_binary(args.pod_url, workflow, input_images, outputs_dir=args.outputs_dir)
+    else:
+        result = submit_workflow_with_images(
+            workflow=workflow,
+            input_images=input_images,
+            encrypted=not args.no_encrypt
+        )
 
     if result:
         print("✅ Submission successful!")
@@ -24,6 +24,11 @@ def handler(event: Dict[str, Any]):
     global _COMFY_INIT_DONE
     data = event.get("input") or {}
 
+    # {"input": {"action": "metrics"}}: counters and stage timings of this worker (no ComfyUI needed)
+    if data.get("action") == "metrics":
+        from phserver import metrics, worker_core  # type: ignore  # worker_core registers its gauges
+        return {"metrics": metrics.snapshot()}
+
     # Fast path: DRY_RUN short-circuit without touching ComfyUI.
     if DRY_RUN:
         # Still enforce encryption flag if ENCRYPTION_REQUIRED=1 (logic handled downstream if needed),
@@ -41,6 +46,12 @@ def handler(event: Dict[str, Any]):
             # Surface structured error instead of crash so the RunPod harness can return JSON.
             return {"error": f"comfy_init_failed: {type(e).__name__}: {str(e)}"}
         _COMFY_INIT_DONE = True
+        # Load PRELOAD_MODELS now so later jobs on this warm worker skip the volume read.
+        from phserver.warmup import Warmer  # type: ignore
+        from phserver import worker_core  # type: ignore
+        warmer = Warmer(worker_core.MODEL_DIR, clients=worker_core.comfy_clients)
+        worker_core.WARM_INSTANCE = warmer.warm_client  # standbys and restarted instances
+        warmer.run()
 
     return handle_request(data)
 
@@ -1,18 +1,27 @@
 import os
 from shared.env_loader import load_dotenv_if_present
 import json
+import asyncio
 import pathlib
-from typing import Optional
+from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
-from phserver.worker_core import handle_request, init_comfy, MODEL_DIR, server_public_key_b64
-from phserver.worker_core import COMFY_AUTOSTART  # new flag
+from phserver.worker_core import handle_request_async, init_comfy, MODEL_DIR, server_public_key_b64, WORKER_PRIVATE_KEY_B64
+from phserver.worker_core import stage_input_stream
+from phserver.worker_core import COMFY_AUTOSTART, STARTUP_TIMINGS
+from phserver.jobs import JobTable, JobQueueFull
+from phserver import worker_core, input_store, output_stage, downloader, model_index, warmup, metrics, scheduler
 
 # Load .env (best-effort) before reading environment
 load_dotenv_if_present()
 DOCS_ENABLED = os.getenv("API_DOCS", "false").lower() == "true"
+# How often /run checks whether its HTTP client is still connected (seconds)
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "1"))
+# Largest /run/binary and /jobs/binary body accepted (the whole envelope is held in memory)
+BINARY_MAX_BYTES = int(os.getenv("BINARY_MAX_BYTES", str(1024 * 1024 * 1024)))
 
 
 class RunRequest(BaseModel):
@@ -24,6 +33,11 @@ class RunRequest(BaseModel):
     ciphertext: Optional[str] = None
     client_id: Optional[str] = None
     no_history: Optional[bool] = Field(default=None, description="Override history fetch")
+    stream_encrypt: Optional[bool] = Field(default=None, description="Encrypt /jobs/{id}/events to the request's epk")
+    return_outputs: Optional[bool] = Field(default=None, description="Return the prompt's output files (sealed to epk)")
+    cache: Optional[bool] = Field(default=None, description="false: bypass the result cache")
+    priority: Optional[str] = Field(default=None, description="high | normal | low (scheduler class)")
+    timeout_s: Optional[float] = Field(default=None, gt=0, description="Deadline in seconds (capped by JOB_TIMEOUT_SECONDS)")
 
 
 MODEL_SUBDIRS = {
@@ -41,6 +55,16 @@ MODEL_SUBDIRS = {
 }
 
 
+class ProbeRequest(BaseModel):
+    # Plaintext: hashes + client_id. Encrypted: epk/nonce/ciphertext sealing {"hashes": [...]}.
+    hashes: list[str] = Field(default_factory=list, max_length=4096, description="SHA-256 hex digests of input files")
+    client_id: Optional[str] = None
+    encrypted: Optional[bool] = None
+    epk: Optional[str] = None
+    nonce: Optional[str] = None
+    ciphertext: Optional[str] = None
+
+
 class DownloadRequest(BaseModel):
     url: str
     type: Optional[str] = Field(default=None, description="Model type, e.g. checkpoints, vae, loras, controlnet, etc.")
@@ -49,6 +73,21 @@ class DownloadRequest(BaseModel):
     overwrite: bool = False
     civitai_token: Optional[str] = Field(default=None, description="Civitai API token; sets Authorization: Bearer <token>")
     headers: Optional[dict] = Field(default=None, description="Optional extra HTTP headers to include on the request")
+    sha256: Optional[str] = Field(default=None, description="Expected SHA-256 (hex); the file is only kept if it matches")
+    connections: Optional[int] = Field(default=None, ge=1, le=16, description="Parallel Range connections (default DOWNLOAD_CONNECTIONS)")
+    background: bool = Field(default=False, description="Queue the download and return a task id; poll GET /download/{id}")
+
+
+class WarmupRequest(BaseModel):
+    models: Optional[List[str]] = Field(default=None, description="Paths relative to MODEL_DIR; default PRELOAD_MODELS")
+
+
+class DownloadBatchRequest(BaseModel):
+    items: List[DownloadRequest]
+
+
+WARMER = warmup.Warmer(MODEL_DIR, clients=worker_core.comfy_clients)
+worker_core.WARM_INSTANCE = WARMER.warm_client  # pool instances that (re)start later warm up too
 
 
 from contextlib import asynccontextmanager
@@ -59,6 +98,9 @@ async def lifespan(app: FastAPI):
     from phserver.worker_core import DRY_RUN as WORKER_DRY_RUN
     if not WORKER_DRY_RUN and COMFY_AUTOSTART:
         init_comfy()
+        WARMER.start()  # PRELOAD_MODELS; /healthz answers 503 until it finishes
+    else:
+        WARMER.start([])  # no ComfyUI yet: nothing to warm, report ready
     yield
     # Shutdown (if needed)
 
@@ -75,25 +117,259 @@ app = FastAPI(
 
 @app.get("/healthz")
 def healthz():
-    return {
-        "ok": True,
+    body = {
+        "ok": WARMER.ready,
         "model_dir": MODEL_DIR,
         "server_public_key_b64": server_public_key_b64(),
+        "warmup": WARMER.state(),
+        "startup": STARTUP_TIMINGS,
+        "tmpfs": worker_core.TMPFS.stats(),
     }
+    if worker_core.POOL is not None:
+        body["instances"] = worker_core.POOL.status()
+    if worker_core.SCHEDULER.enabled:
+        body["scheduler"] = worker_core.SCHEDULER.stats()
+    if not WARMER.ready:
+        # Keep the load balancer away until preloaded models are warm.
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+
+@app.get("/metrics")
+def metrics_text():
+    # Prometheus text exposition; labels are stage/instance identifiers only
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/warmup")
+def warmup_status():
+    return WARMER.state()
+
+
+@app.post("/warmup")
+async def warmup_models(req: WarmupRequest):
+    """Page the listed models into the OS cache and load checkpoints in ComfyUI (background)."""
+    from phserver.worker_core import DRY_RUN as WORKER_DRY_RUN
+    if not WORKER_DRY_RUN:
+        try:
+            await asyncio.to_thread(init_comfy)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    return WARMER.start(req.models)
+
+
+def _raise_for_error(res):
+    if not (isinstance(res, dict) and res.get("error")):
+        return
+    if "timeout" in res:
+        raise HTTPException(status_code=504, detail={"error": res["error"], "timeout": res["timeout"]})
+    if res.get("disconnected"):
+        raise HTTPException(status_code=499, detail=res["error"])  # nginx's "client closed request"
+    if "retry_after" in res:
+        raise HTTPException(status_code=429, detail=res["error"], headers={"Retry-After": str(res["retry_after"])})
+    raise HTTPException(status_code=400, detail=res["error"])
+
+
+def _admit(client: Optional[str]):
+    """Refuse a background job up front when the scheduler would (429 + Retry-After)."""
+    if not worker_core.SCHEDULER.enabled:
+        return
+    try:
+        worker_core.SCHEDULER.check(client)
+    except scheduler.QueueFull as e:
+        raise HTTPException(status_code=429, detail=f"queue_full: {e}", headers={"Retry-After": str(e.retry_after)})
+
+
+async def _run_attached(request: Request, data: dict) -> dict:
+    """
+    handle_request_async tied to the HTTP connection: when the client goes away the job is
+    cancelled, which removes or interrupts its prompt in ComfyUI instead of finishing unseen.
+    """
+    task = asyncio.create_task(handle_request_async(data))
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if not task.done() and await request.is_disconnected():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                return {"error": "client_disconnected", "disconnected": True}
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    return task.result()
 
 
 @app.post("/run")
-def run_workflow(req: RunRequest):
+async def run_workflow(req: RunRequest, request: Request):
     data = req.model_dump(exclude_none=True)
     try:
-        res = handle_request(data)
+        res = await _run_attached(request, data)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    _raise_for_error(res)
+    return res
+
+
+async def _binary_request(request: Request) -> dict:
+    """
+    Body is a raw encrypted envelope (application/octet-stream): epk | nonce | ciphertext,
+    whose plaintext is a shared.payload_codec payload. Decryption happens in the worker.
+    Bodies over BINARY_MAX_BYTES are refused with 413 without being read to the end.
+    """
+    too_large = HTTPException(status_code=413, detail=f"body exceeds BINARY_MAX_BYTES ({BINARY_MAX_BYTES})")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > BINARY_MAX_BYTES:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > BINARY_MAX_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    body = b"".join(chunks)
+    if not body:
+        raise HTTPException(status_code=400, detail="empty body")
+    return {"encrypted": True, "binary": body}
+
+
+@app.post("/run/binary")
+async def run_workflow_binary(request: Request):
+    data = await _binary_request(request)
+    try:
+        res = await _run_attached(request, data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    if isinstance(res, dict) and res.get("error"):
-        raise HTTPException(status_code=400, detail=res["error"])
+    _raise_for_error(res)
     return res
 
 
+@app.post("/inputs/stream/{filename:path}")
+async def upload_input_stream(filename: str, request: Request):
+    """
+    Chunked encrypted upload (crypto_secure.stream_encryptor_for_server) of one input file;
+    decrypted into the ComfyUI input dir at constant memory. Reference it by filename in /run.
+    """
+    try:
+        size = await stage_input_stream(filename, request.stream())
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"invalid_stream: {type(e).__name__}")
+    return {"status": "ok", "filename": filename, "size": size}
+
+
+@app.post("/inputs/probe")
+def probe_inputs(req: ProbeRequest):
+    """Which of the caller's input hashes are already in the content-addressed store (send 'sha256:<hex>' for those)."""
+    try:
+        out = worker_core.probe_inputs(req.model_dump(exclude_none=True))
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if "error" in out:
+        raise HTTPException(status_code=400, detail=out["error"])
+    return out
+
+
+@app.get("/outputs/{token}")
+def download_output(token: str):
+    """
+    One-shot download of an output too large to inline (link from a result's outputs).
+    Encrypted requests get a secretstream body for crypto_secure.stream_decryptor_from_server.
+    The file is wiped from tmpfs once sent.
+    """
+    item = output_stage.PARKED.take(token)
+    if item is None:
+        raise HTTPException(status_code=404, detail="unknown or expired output")
+    path, epk = item
+    return StreamingResponse(output_stage.stream_parked(path, epk, worker_core.WORKER_PRIVATE_KEY_B64),
+                             media_type="application/octet-stream")
+
+
+JOBS = JobTable(handle_request_async)
+metrics.REGISTRY.gauge("jobs_active", "Background /jobs not finished yet", JOBS.active_count)
+
+
+@app.post("/jobs")
+async def submit_job(req: RunRequest):
+    """Queue a workflow and return immediately with a job id (RunPod /run semantics)."""
+    data = req.model_dump(exclude_none=True)
+    encode = None
+    if data.get("stream_encrypt"):
+        if not (data.get("encrypted") and data.get("epk") and WORKER_PRIVATE_KEY_B64):
+            raise HTTPException(status_code=400, detail="stream_encrypt requires an encrypted request (epk) and a worker key")
+        from shared.crypto_secure import encrypt_to_client
+        epk = data["epk"]
+        encode = lambda evt: encrypt_to_client(WORKER_PRIVATE_KEY_B64, epk, json.dumps(evt).encode("utf-8"))
+    # an encrypted request may seal its client_id; only the global bound applies until it is opened
+    _admit(None if data.get("encrypted") else scheduler.client_of(data.get("client_id")))
+    try:
+        job = JOBS.submit(data, encode=encode)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return job.to_dict()
+
+
+@app.post("/jobs/binary")
+async def submit_job_binary(request: Request):
+    """Binary-envelope variant of POST /jobs."""
+    data = await _binary_request(request)
+    _admit(None)  # client is inside the envelope; only the global bound applies here
+    try:
+        job = JOBS.submit(data)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-sent events: node_start/node_done (with ms), progress, cached, executed, end,
+    then a final status event. With stream_encrypt each data line is {nonce, ciphertext}.
+    """
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+
+    async def _stream():
+        q = job.listen()
+        try:
+            while True:
+                evt = await q.get()
+                if evt is None:
+                    break
+                yield f"data: {json.dumps(evt)}\n\n"
+        finally:
+            job.unlisten(q)
+
+    return StreamingResponse(_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# RunPod-compatible alias so existing /status pollers (client/run_tests.py) work against a Pod
+app.add_api_route("/status/{job_id}", job_status, methods=["GET"])
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a job; a prompt it already queued is deleted from ComfyUI's queue or interrupted."""
+    job = JOBS.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+
+# RunPod-compatible alias for POST /cancel/{id}
+app.add_api_route("/cancel/{job_id}", cancel_job, methods=["POST"])
+
+
 def _target_path(req: DownloadRequest) -> pathlib.Path:
     base = pathlib.Path(MODEL_DIR).resolve()
     if req.dest:
@@ -114,9 +390,12 @@ def _target_path(req: DownloadRequest) -> pathlib.Path:
     return resolved_target
 
 
-@app.post("/download")
-def download_model(req: DownloadRequest):
-    import requests
+def _prepare_download(req: DownloadRequest):
+    """
+    Validate the request and build the transfer. Returns (key, work) where work(progress)
+    runs the download, or (None, result) when the file already exists.
+    Path errors raise HTTPException before anything is queued.
+    """
     from urllib.parse import urlparse
 
     base_dir = pathlib.Path(MODEL_DIR).resolve()
@@ -134,7 +413,7 @@ def download_model(req: DownloadRequest):
 
     dest_path = _resolve_dest(filename) if filename else None
     if dest_path and dest_path.exists() and not req.overwrite:
-        return {"status": "exists", "path": str(dest_path)}
+        return None, {"status": "exists", "path": str(dest_path)}
 
     # Build request headers
     hdrs = {}
@@ -145,50 +424,104 @@ def download_model(req: DownloadRequest):
         # Add/override Authorization for Civitai; harmless if used elsewhere
         hdrs["Authorization"] = f"Bearer {req.civitai_token}"
 
+    def _dest_for(resp_headers) -> pathlib.Path:
+        name = filename
+        # If filename not provided by client, try content-disposition header
+        if not user_supplied:
+            cd = resp_headers.get('content-disposition') or resp_headers.get('Content-Disposition')
+            if cd and 'filename=' in cd:
+                # naive parse; strip quotes if present
+                fname = cd.split('filename=')[-1].strip().strip('"').strip("'")
+                if fname:
+                    name = fname
+        if not name:
+            name = "download.bin"
+        dest = _resolve_dest(name)
+        if dest.exists() and not req.overwrite:
+            raise downloader.AlreadyExists(dest)
+        return dest
+
+    def work(progress=None) -> dict:
+        res = downloader.download(req.url, _dest_for, headers=hdrs, sha256=req.sha256, progress=progress,
+                                  connections=req.connections or downloader.DOWNLOAD_CONNECTIONS)
+        if res.get("status") == "ok":
+            MODELS.note(res["path"], sha256=req.sha256)
+        return res
+
+    return (req.url, str(target_dir), filename or ""), work
+
+
+DOWNLOADS = downloader.DownloadQueue()
+
+
+@app.post("/download")
+def download_model(req: DownloadRequest):
+    key, work = _prepare_download(req)
+    if key is None:
+        return work
+    if req.background:
+        return DOWNLOADS.submit(key, req.url, work).to_dict()
+
     try:
-        with requests.get(req.url, stream=True, timeout=120, headers=hdrs, allow_redirects=True) as r:
-            r.raise_for_status()
-            # If filename not provided by client, try content-disposition header
-            if not user_supplied:
-                cd = r.headers.get('content-disposition') or r.headers.get('Content-Disposition')
-                if cd and 'filename=' in cd:
-                    # naive parse; strip quotes if present
-                    fname = cd.split('filename=')[-1].strip().strip('"').strip("'")
-                    if fname:
-                        filename = fname
-                        dest_path = _resolve_dest(filename)
-
-            if not filename:
-                filename = pathlib.Path(parsed_url.path).name or None
-            if not filename:
-                filename = "download.bin"
-
-            dest_path = _resolve_dest(filename)
-            if dest_path.exists() and not req.overwrite:
-                return {"status": "exists", "path": str(dest_path)}
-            with open(dest_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024 * 1024):  # 1MB chunks
-                    if chunk:
-                        f.write(chunk)
+        res = work()
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"download_failed: {type(e).__name__}: {str(e)}")
 
-    return {"status": "ok", "path": str(dest_path), "size": dest_path.stat().st_size}
+    return res
+
+
+@app.post("/download/batch")
+def download_batch(req: DownloadBatchRequest):
+    """Queue several downloads at once (e.g. a full model set); one entry per item, in order."""
+    out = []
+    for item in req.items:
+        try:
+            key, work = _prepare_download(item)
+        except HTTPException as e:
+            out.append({"status": "FAILED", "url": item.url, "error": e.detail})
+            continue
+        out.append(work if key is None else DOWNLOADS.submit(key, item.url, work).to_dict())
+    return {"downloads": out}
+
+
+@app.get("/download/{task_id}")
+def download_status(task_id: str):
+    task = DOWNLOADS.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="download not found")
+    return task.to_dict()
+
+
+MODELS = model_index.ModelIndex(MODEL_DIR, MODEL_SUBDIRS.values())
 
 
 @app.get("/models/ls")
-def list_models():
-    base = pathlib.Path(MODEL_DIR)
-    out = {}
-    for name in sorted(MODEL_SUBDIRS.values()):
-        p = base / name
-        files = []
-        if p.exists():
-            for child in p.iterdir():
-                if child.is_file():
-                    files.append({"name": child.name, "size": child.stat().st_size})
-        out[name] = files
-    return {"dir": MODEL_DIR, "models": out}
+def list_models(type: Optional[str] = None, q: Optional[str] = None, ext: Optional[str] = None,
+                metadata: bool = False, refresh: bool = False):
+    """
+    Model files from the persistent index (no directory walk per request). Filters: type
+    (folder or alias), q (substring of the name), ext; metadata=true adds safetensors
+    __metadata__; refresh=true rescans before answering.
+    """
+    folder = None
+    if type:
+        folder = MODEL_SUBDIRS.get(type.lower())
+        if not folder:
+            raise HTTPException(status_code=400, detail=f"Unknown model type: {type}")
+    MODELS.ensure_fresh(force=refresh)
+    return {"dir": MODEL_DIR, "models": MODELS.listing(folder, q=q, ext=ext, metadata=metadata), "index": MODELS.stats()}
+
+
+@app.get("/models/by-hash/{sha256}")
+def model_by_hash(sha256: str):
+    """Find an installed model by SHA-256 (or a unique prefix of at least 10 hex chars)."""
+    MODELS.ensure_fresh()
+    entry = MODELS.by_hash(sha256)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="no model with that hash (it may not be hashed yet)")
+    return entry
 
 
 if __name__ == "__main__":
@@ -0,0 +1,254 @@
+import os, json, copy, time, asyncio, logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from phserver import comfy_client
+
+# Micro-batching for small text2img graphs (examples/minimal_text2img.json style).
+# Jobs that use the same checkpoint, resolution and sampler settings and arrive within
+# BATCH_WINDOW_MS are merged into one ComfyUI prompt:
+# - every job's nodes are copied under "<job>_<node id>";
+# - identical non-output nodes (checkpoint loader, empty latent, equal prompt encodes)
+#   are kept once, so the model is loaded and shared for the whole group;
+# - the merged history, events and outputs are split back per job.
+# Only jobs from the same caller (scope, see worker_core._tenant) are merged, and a job
+# takes no scheduler slot while it waits: the group runs in one slot, that of its first job.
+# Stock ComfyUI samples one conditioning and seed per KSampler, so the samplers still
+# run one after the other inside the prompt; the gain is one queue round trip, one
+# model load and no idle GPU between the jobs. BATCH_WINDOW_MS bounds the added latency.
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "0"))  # 0 = off
+BATCH_MAX = int(os.getenv("BATCH_MAX", "8"))
+_OUTPUT_CLASSES = ("SaveImage", "PreviewImage")
+
+log = logging.getLogger("worker")
+
+
+def _nodes(wf: Dict[str, Any], class_type: str) -> List[Dict[str, Any]]:
+    return [n for n in wf.values() if isinstance(n, dict) and n.get("class_type") == class_type]
+
+
+def signature(wf: Dict[str, Any]) -> Optional[Tuple]:
+    """Compatibility key of a batchable text2img graph, or None."""
+    ckpt, latent, sampler = (_nodes(wf, c) for c in ("CheckpointLoaderSimple", "EmptyLatentImage", "KSampler"))
+    if len(ckpt) != 1 or len(latent) != 1 or len(sampler) != 1:
+        return None
+    li, si = latent[0].get("inputs") or {}, sampler[0].get("inputs") or {}
+    return (ckpt[0].get("inputs", {}).get("ckpt_name"), li.get("width"), li.get("height"), li.get("batch_size", 1),
+            si.get("sampler_name"), si.get("scheduler"), si.get("steps"))
+
+
+def _is_link(v: Any) -> bool:
+    return isinstance(v, list) and len(v) == 2 and isinstance(v[0], str)
+
+
+def _is_output(node: Dict[str, Any]) -> bool:
+    return node.get("class_type") in _OUTPUT_CLASSES or "filename_prefix" in (node.get("inputs") or {})
+
+
+def _topo(wf: Dict[str, Any]) -> List[str]:
+    order, seen = [], set()
+
+    def visit(nid: str):
+        if nid in seen or nid not in wf:
+            return
+        seen.add(nid)
+        for v in (wf[nid].get("inputs") or {}).values():
+            if _is_link(v):
+                visit(v[0])
+        order.append(nid)
+
+    for nid in sorted(wf):
+        visit(nid)
+    return order
+
+
+def merge(workflows: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[Dict[str, str]]]:
+    """One prompt for all workflows, plus per workflow {original node id: merged node id}."""
+    merged: Dict[str, Any] = {}
+    shared: Dict[str, str] = {}  # canonical node json -> merged id
+    maps = []
+    for i, wf in enumerate(workflows):
+        ids: Dict[str, str] = {}
+        for nid in _topo(wf):
+            node = copy.deepcopy(wf[nid])
+            inputs = node.get("inputs") or {}
+            for k, v in inputs.items():
+                if _is_link(v):
+                    inputs[k] = [ids[v[0]], v[1]]
+            if not _is_output(node):
+                canon = json.dumps({"c": node.get("class_type"), "i": inputs}, sort_keys=True)
+                if canon in shared:
+                    ids[nid] = shared[canon]
+                    continue
+                shared[canon] = f"{i}_{nid}"
+            ids[nid] = f"{i}_{nid}"
+            merged[ids[nid]] = node
+        maps.append(ids)
+    return merged, maps
+
+
+def _split_message(msg: Any, back: Dict[str, str]) -> Optional[Any]:
+    """A status message of the merged prompt as one job sees it, or None if it is about another job's node."""
+    if not (isinstance(msg, list) and len(msg) == 2 and isinstance(msg[1], dict)):
+        return None
+    kind, data = msg
+    data = dict(data)
+    if "nodes" in data:
+        data["nodes"] = [back[n] for n in data["nodes"] or [] if n in back]
+    if "node_id" in data:
+        if data["node_id"] not in back:
+            return None
+        data["node_id"] = back[data["node_id"]]
+    return [kind, data]
+
+
+def split(res: Dict[str, Any], ids: Dict[str, str], wf: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The merged run's result as seen by one job: a history entry rebuilt from its own workflow
+    and nodes only (outputs, meta, status messages under its original ids), nothing of the others.
+    """
+    back = {m: o for o, m in ids.items()}
+    prompt_id = res.get("prompt_id")
+    merged = (res.get("history") or {}).get(prompt_id)
+    if not isinstance(merged, dict):
+        return dict(res, history={}, _batched=True)
+    entry: Dict[str, Any] = {"outputs": {back[m]: copy.deepcopy(out)
+                                         for m, out in (merged.get("outputs") or {}).items() if m in back}}
+    prompt = merged.get("prompt")
+    if isinstance(prompt, list) and len(prompt) >= 3:
+        # [number, prompt_id, graph, extra_data, outputs_to_execute]
+        prompt = [prompt[0], prompt[1], copy.deepcopy(wf)] + copy.deepcopy(prompt[3:4])
+        if len(merged["prompt"]) >= 5:
+            prompt.append([back[m] for m in merged["prompt"][4] or [] if m in back])
+        entry["prompt"] = prompt
+    if isinstance(merged.get("meta"), dict):
+        entry["meta"] = {back[m]: copy.deepcopy(v) for m, v in merged["meta"].items() if m in back}
+    if isinstance(merged.get("status"), dict):
+        status = {k: v for k, v in merged["status"].items() if k != "messages"}
+        msgs = [_split_message(m, back) for m in merged["status"].get("messages") or []]
+        entry["status"] = dict(status, messages=[m for m in msgs if m is not None])
+    return dict(res, history={prompt_id: entry}, _batched=True)
+
+
+class _Pending:
+    def __init__(self, wf, client_id, on_event, deadline, ticket):
+        self.wf = wf
+        self.client_id = client_id
+        self.on_event = on_event
+        self.deadline = deadline
+        self.ticket = ticket  # scheduler slot, taken by whichever run this job ends up in
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.group: List["_Pending"] = []
+        self.task: Optional[asyncio.Task] = None  # the group's run, once flushed
+
+
+class MicroBatcher:
+    """
+    run(wf, client_id, on_event, deadline, scope, ticket) -> result, like worker_core's run
+    functions; runner(wf, client_id, on_event=, deadline=, ticket=) runs one prompt in the
+    ticket's slot. Batchable workflows wait up to window_s for compatible company from the
+    same scope (at most max_jobs per prompt), holding no slot meanwhile. Each job times out
+    at its own deadline; a merged prompt runs until the latest one and is cancelled once
+    none of its jobs waits for it any more.
+    """
+
+    def __init__(self, runner: Callable[..., Awaitable[Dict[str, Any]]], window_ms: int = BATCH_WINDOW_MS,
+                 max_jobs: int = BATCH_MAX):
+        self.runner = runner
+        self.window_s = window_ms / 1000.0
+        self.max_jobs = max(1, max_jobs)
+        self._groups: Dict[Tuple, List[_Pending]] = {}
+        self.batches = 0
+        self.batched_jobs = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_s > 0 and self.max_jobs > 1
+
+    async def run(self, wf: Dict[str, Any], client_id: str, on_event=None, deadline: Optional[float] = None,
+                  scope: str = "", ticket=None) -> Dict[str, Any]:
+        sig = signature(wf) if self.enabled else None
+        if sig is None:
+            return await self.runner(wf, client_id, on_event=on_event, deadline=deadline, ticket=ticket)
+        sig = (scope, sig)  # never merge two callers' jobs into one prompt
+        job = _Pending(wf, client_id, on_event, deadline, ticket)
+        group = job.group = self._groups.setdefault(sig, [])
+        group.append(job)
+        if len(group) == 1:
+            asyncio.get_running_loop().call_later(self.window_s, self._flush, sig, group)
+        if len(group) >= self.max_jobs:
+            self._flush(sig, group)
+        # shield: the future is shared with the group run and only settled by it
+        remaining = None if deadline is None else max(0.0, deadline - time.time())
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), remaining)
+        except comfy_client.PromptTimeout:
+            raise  # the prompt's own deadline
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            self._leave(job)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise comfy_client.PromptTimeout(None, "running") from None
+
+    @staticmethod
+    def _leave(job: _Pending):
+        job.future.cancel()  # the group run skips it
+        if job.task is not None and all(j.future.done() for j in job.group):
+            job.task.cancel()  # nobody waits for the prompt any more: cancel it in ComfyUI
+
+    def _flush(self, sig: Tuple, group: List[_Pending]):
+        if self._groups.get(sig) is not group:
+            return  # already flushed (full group) before its window ended
+        del self._groups[sig]
+        task = asyncio.get_running_loop().create_task(self._run_group(group))
+        for j in group:
+            j.task = task
+
+    async def _run_group(self, group: List[_Pending]):
+        jobs = [j for j in group if not j.future.done()]  # skip waiters cancelled meanwhile
+        if not jobs:
+            return
+        if len(jobs) == 1:
+            j = jobs[0]
+            await self._settle(jobs, lambda: self.runner(j.wf, j.client_id, on_event=j.on_event, deadline=j.deadline,
+                                                         ticket=j.ticket),
+                               lambda res, i: res)
+            return
+        merged, maps = merge([j.wf for j in jobs])
+        backs = [{m: o for o, m in ids.items()} for ids in maps]
+
+        def fan_out(evt):
+            # node events go to the jobs owning that node (under their own ids), the rest to all
+            data = evt.get("data") or {}
+            node = data.get("node")
+            for j, back in zip(jobs, backs):
+                if j.on_event is None:
+                    continue
+                if node is None:
+                    j.on_event(evt)
+                elif node in back:
+                    j.on_event(dict(evt, data=dict(data, node=back[node])))
+
+        self.batches += 1
+        self.batched_jobs += len(jobs)
+        log.info("micro-batch of %d jobs (%d nodes)", len(jobs), len(merged))
+        deadlines = [j.deadline for j in jobs]
+        deadline = None if None in deadlines else max(deadlines)
+        ticket = next((j.ticket for j in jobs if j.ticket is not None), None)
+        if ticket is not None:
+            ticket.handed_off = True  # held by the merged prompt, even if its own job leaves first
+        await self._settle(jobs, lambda: self.runner(merged, jobs[0].client_id, on_event=fan_out, deadline=deadline,
+                                                     ticket=ticket),
+                           lambda res, i: split(res, maps[i], jobs[i].wf))
+
+    @staticmethod
+    async def _settle(jobs: List[_Pending], call, per_job):
+        try:
+            res = await call()
+        except Exception as e:
+            for j in jobs:
+                if not j.future.done():
+                    j.future.set_exception(e)
+            return
+        for i, j in enumerate(jobs):
+            if not j.future.done():
+                j.future.set_result(per_job(res, i))
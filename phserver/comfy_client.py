@@ -1,51 +1,471 @@
 # comfy_client.py
-import os, time, json
+import os, time, json, uuid, queue, asyncio, threading, logging
+from collections import OrderedDict, deque
 import requests
+from requests.adapters import HTTPAdapter
 from websocket import create_connection
 
 COMFY_HOST = os.environ.get("COMFY_HOST", "127.0.0.1")
 COMFY_PORT = int(os.environ.get("COMFY_PORT", "8188"))
 BASE_HTTP = f"http://{COMFY_HOST}:{COMFY_PORT}"
+# Keep-alive pool shared by all HTTP calls to one ComfyUI process (max idle+active sockets).
+COMFY_HTTP_POOL_SIZE = int(os.environ.get("COMFY_HTTP_POOL_SIZE", "16"))
+# Per-call timeouts (seconds): connect is local so keep it short; read covers /prompt validation.
+COMFY_HTTP_CONNECT_TIMEOUT = float(os.environ.get("COMFY_HTTP_CONNECT_TIMEOUT", "2"))
+COMFY_HTTP_TIMEOUT = float(os.environ.get("COMFY_HTTP_TIMEOUT", "30"))
+# Seconds without any event for a prompt before its waiter double-checks /history (guards against lost events).
+COMFY_WS_IDLE_CHECK = float(os.environ.get("COMFY_WS_IDLE_CHECK", "15"))
+# Upper bound of the reconnect backoff for the shared WebSocket.
+COMFY_WS_MAX_BACKOFF = float(os.environ.get("COMFY_WS_MAX_BACKOFF", "5"))
+# Startup readiness polling: first retry delay, doubling up to the max (seconds).
+COMFY_READY_POLL_MIN = float(os.environ.get("COMFY_READY_POLL_MIN", "0.05"))
+COMFY_READY_POLL_MAX = float(os.environ.get("COMFY_READY_POLL_MAX", "1"))
 
-def wait_for_server(timeout=120):
-    t0 = time.time()
-    while time.time() - t0 < timeout:
-        try:
-            r = requests.get(f"{BASE_HTTP}/system_stats", timeout=2)
-            if r.status_code == 200:
-                return True
-        except Exception:
-            time.sleep(0.5)
-    return False
-
-def queue_prompt(workflow: dict, client_id: str):
-    r = requests.post(f"{BASE_HTTP}/prompt", json={"prompt": workflow, "client_id": client_id}, timeout=30)
-    r.raise_for_status()
-    return r.json()
-
-def get_history(prompt_id: str):
-    r = requests.get(f"{BASE_HTTP}/history/{prompt_id}", timeout=30)
-    r.raise_for_status()
-    return r.json()
-
-def run_workflow_and_wait(workflow: dict, client_id: str):
-    res = queue_prompt(workflow, client_id)
-    prompt_id = res.get("prompt_id")
-
-    ws_url = f"ws://{COMFY_HOST}:{COMFY_PORT}/ws?clientId={client_id}"
-    ws = create_connection(ws_url)
-    try:
+# Event types that mark the end of a prompt's execution.
+TERMINAL_EVENTS = ("execution_end", "execution_success", "execution_error", "execution_interrupted")
+
+# Event types that mean ComfyUI has taken a prompt off its queue.
+START_EVENTS = ("execution_start", "execution_cached", "executing", "progress", "executed")
+
+log = logging.getLogger("worker")
+
+class PromptTimeout(TimeoutError):
+    """A prompt outlived its deadline; it has already been dropped from ComfyUI's queue or interrupted."""
+
+    def __init__(self, prompt_id: str | None, stage: str):
+        super().__init__(f"deadline exceeded while {stage}")
+        self.prompt_id = prompt_id
+        self.stage = stage  # "waiting" (not submitted), "queued" (in ComfyUI's queue) or "running"
+
+def make_session(pool_size: int = COMFY_HTTP_POOL_SIZE) -> requests.Session:
+    """requests.Session with a keep-alive connection pool of pool_size sockets per host."""
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+def is_terminal(evt: dict, prompt_id: str) -> bool:
+    """True if evt ends execution of prompt_id (explicit end event, or 'executing' with node=None)."""
+    data = evt.get("data") or {}
+    if data.get("prompt_id") != prompt_id:
+        return False
+    if evt.get("type") in TERMINAL_EVENTS:
+        return True
+    return evt.get("type") == "executing" and data.get("node") is None
+
+class PromptTimer:
+    """
+    Splits one prompt's wall time into submit (POST /prompt), queue_wait (until ComfyUI
+    starts it), execution and history_fetch, in seconds; also keeps client.waiting (prompts
+    queued in ComfyUI but not started) current.
+    """
+
+    def __init__(self, client: "ComfyClient"):
+        self.client = client
+        self.t0 = time.perf_counter()
+        self.queued_at = self.started_at = self.ended_at = None
+        self.timings = {}
+
+    def queued(self):
+        self.queued_at = time.perf_counter()
+        self.timings["submit"] = self.queued_at - self.t0
+        self.client._add_waiting(1)
+
+    def feed(self, evt: dict):
+        if self.started_at is None and evt.get("type") in START_EVENTS:
+            self._start()
+
+    def _start(self):
+        self.started_at = time.perf_counter()
+        self.timings["queue_wait"] = self.started_at - self.queued_at
+        self.client._add_waiting(-1)
+
+    def ended(self):
+        if self.queued_at is None:
+            return
+        if self.started_at is None:
+            self._start()  # no start event seen (e.g. lost while reconnecting): count it as waiting
+        self.ended_at = time.perf_counter()
+        self.timings["execution"] = self.ended_at - self.started_at
+
+    def fetched(self):
+        self.timings["history_fetch"] = time.perf_counter() - self.ended_at
+
+class EventMux:
+    """
+    One long-lived WebSocket per ComfyUI process. A background reader thread routes
+    every event to the sinks subscribed for its prompt_id and reconnects on failure.
+    Events for prompts nobody has subscribed to yet are buffered (bounded), so the
+    window between POST /prompt and subscribe() cannot lose a completion event.
+    """
+
+    ORPHAN_PROMPTS = 256
+    ORPHAN_EVENTS = 256
+
+    def __init__(self, host: str = COMFY_HOST, port: int = COMFY_PORT, client_id: str | None = None, history=None):
+        self.client_id = client_id or f"mux-{uuid.uuid4()}"
+        self.ws_url = f"ws://{host}:{port}/ws?clientId={self.client_id}"
+        self._history = history  # callable(prompt_id) -> dict, used to recover after reconnects
+        self._lock = threading.Lock()
+        self._sinks = {}  # prompt_id -> [callable(evt)]
+        self._orphans = OrderedDict()  # prompt_id -> deque[evt]
+        self._connected = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._ws = None
+        self.reconnects = 0
+
+    def start(self, timeout: float = 10.0) -> bool:
+        """Start the reader thread if needed and wait (up to timeout) for the socket to connect."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="comfy-ws-mux", daemon=True)
+                self._thread.start()
+        return self._connected.wait(timeout)
+
+    def stop(self):
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def subscribe(self, prompt_id: str, sink):
+        """Route events for prompt_id to sink(evt); replays anything buffered before subscription."""
+        with self._lock:
+            self._sinks.setdefault(prompt_id, []).append(sink)
+            backlog = self._orphans.pop(prompt_id, ())
+        for evt in backlog:
+            sink(evt)
+
+    def unsubscribe(self, prompt_id: str, sink):
+        with self._lock:
+            sinks = self._sinks.get(prompt_id)
+            if not sinks:
+                return
+            try:
+                sinks.remove(sink)
+            except ValueError:
+                pass
+            if not sinks:
+                del self._sinks[prompt_id]
+
+    def _dispatch(self, evt: dict):
+        prompt_id = (evt.get("data") or {}).get("prompt_id")
+        if not prompt_id:
+            return
+        with self._lock:
+            sinks = list(self._sinks.get(prompt_id, ()))
+            if not sinks:
+                buf = self._orphans.get(prompt_id)
+                if buf is None:
+                    buf = self._orphans[prompt_id] = deque(maxlen=self.ORPHAN_EVENTS)
+                    while len(self._orphans) > self.ORPHAN_PROMPTS:
+                        self._orphans.popitem(last=False)
+                buf.append(evt)
+                return
+        for sink in sinks:
+            try:
+                sink(evt)
+            except Exception:
+                log.exception("event sink failed")
+
+    def _recover(self):
+        """After a reconnect, synthesize completion for subscribed prompts that finished while we were offline."""
+        if self._history is None:
+            return
+        with self._lock:
+            pending = list(self._sinks.keys())
+        for prompt_id in pending:
+            try:
+                if prompt_id in (self._history(prompt_id) or {}):
+                    self._dispatch({"type": "execution_end", "data": {"prompt_id": prompt_id, "recovered": True}})
+            except Exception:
+                pass
+
+    def _run(self):
+        backoff = 0.1
+        first = True
+        while not self._stop.is_set():
+            try:
+                self._ws = create_connection(self.ws_url, timeout=5)
+                self._ws.settimeout(None)
+            except Exception:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, COMFY_WS_MAX_BACKOFF)
+                continue
+            backoff = 0.1
+            self._connected.set()
+            if not first:
+                self.reconnects += 1
+                self._recover()
+            first = False
+            try:
+                while not self._stop.is_set():
+                    msg = self._ws.recv()
+                    if not msg:
+                        break
+                    if isinstance(msg, bytes):
+                        continue  # binary preview frames carry no prompt routing info
+                    try:
+                        evt = json.loads(msg)
+                    except ValueError:
+                        continue
+                    self._dispatch(evt)
+            except Exception:
+                pass
+            finally:
+                self._connected.clear()
+                try:
+                    self._ws.close()
+                except Exception:
+                    pass
+                self._ws = None
+
+class ComfyClient:
+    """
+    Client for one ComfyUI process: a pooled keep-alive HTTP session plus the shared
+    EventMux. All calls accept a per-call timeout (seconds, read timeout).
+    """
+
+    def __init__(self, host: str = COMFY_HOST, port: int = COMFY_PORT, pool_size: int = COMFY_HTTP_POOL_SIZE,
+                 timeout: float = COMFY_HTTP_TIMEOUT, connect_timeout: float = COMFY_HTTP_CONNECT_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.base_http = f"http://{host}:{self.port}"
+        self.session = make_session(pool_size)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._mux = None
+        self._mux_lock = threading.Lock()
+        self.waiting = 0  # prompts queued in ComfyUI and not yet started (see PromptTimer)
+        self.warmed = set()  # models warm-up loaded into the current process (reset by the pool on launch)
+
+    def _add_waiting(self, n: int):
+        with self._mux_lock:
+            self.waiting += n
+
+    def _timeout(self, timeout):
+        return (self.connect_timeout, self.timeout if timeout is None else timeout)
+
+    @property
+    def mux(self) -> EventMux:
+        with self._mux_lock:
+            if self._mux is None:
+                self._mux = EventMux(self.host, self.port, history=self.get_history)
+            return self._mux
+
+    def wait_for_server(self, timeout=120, proc=None, ready: threading.Event | None = None):
+        """
+        Poll /system_stats until ComfyUI answers. Returns False at the deadline, or as soon
+        as proc (the ComfyUI Popen) has exited. Retries back off from COMFY_READY_POLL_MIN
+        to COMFY_READY_POLL_MAX; setting ready (e.g. on a stdout marker) triggers a probe
+        right away.
+        """
+        deadline = time.time() + timeout
+        delay = COMFY_READY_POLL_MIN
         while True:
-            msg = ws.recv()
-            if not msg:
-                break
-            evt = json.loads(msg)
-            if evt.get("type") == "execution_end" and evt.get("data", {}).get("prompt_id") == prompt_id:
-                break
-    finally:
-        ws.close()
-
-    # Minimal fetch (metadata only). You can turn this off if you want even less I/O.
-    hist = get_history(prompt_id)
-    return {"prompt_id": prompt_id, "history": hist}
+            if proc is not None and proc.poll() is not None:
+                return False
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                r = self.session.get(f"{self.base_http}/system_stats", timeout=self._timeout(min(2.0, remaining)))
+                if r.status_code == 200:
+                    return True
+            except Exception:
+                pass
+            pause = min(delay, max(0.0, deadline - time.time()))
+            if ready is not None:
+                if ready.wait(pause):
+                    ready.clear()
+                    delay = COMFY_READY_POLL_MIN
+                    continue
+            else:
+                time.sleep(pause)
+            delay = min(delay * 2, COMFY_READY_POLL_MAX)
+
+    def queue_prompt(self, workflow: dict, client_id: str, timeout: float | None = None):
+        r = self.session.post(f"{self.base_http}/prompt", json={"prompt": workflow, "client_id": client_id},
+                              timeout=self._timeout(timeout))
+        r.raise_for_status()
+        return r.json()
+
+    def get_history(self, prompt_id: str, timeout: float | None = None):
+        r = self.session.get(f"{self.base_http}/history/{prompt_id}", timeout=self._timeout(timeout))
+        r.raise_for_status()
+        return r.json()
+
+    def cancel(self, prompt_id: str, running: bool = True, timeout: float | None = None):
+        """
+        Free ComfyUI from prompt_id: delete it from the pending queue and, if it has started,
+        POST /interrupt. The interrupt names the prompt; ComfyUI versions that ignore the
+        body stop whatever is executing, so callers only pass running=True while they
+        still consider the prompt active. Best effort: failures are logged, not raised.
+        """
+        try:
+            self.session.post(f"{self.base_http}/queue", json={"delete": [prompt_id]},
+                              timeout=self._timeout(timeout)).raise_for_status()
+            if running:
+                self.session.post(f"{self.base_http}/interrupt", json={"prompt_id": prompt_id},
+                                  timeout=self._timeout(timeout)).raise_for_status()
+        except Exception as e:
+            log.warning("cancelling prompt %s failed: %s", prompt_id, type(e).__name__)
+
+    @staticmethod
+    def _wait_time(deadline: float | None) -> float:
+        if deadline is None:
+            return COMFY_WS_IDLE_CHECK
+        return min(COMFY_WS_IDLE_CHECK, deadline - time.time())
+
+    def run_workflow_and_wait(self, workflow: dict, client_id: str, on_event=None, deadline: float | None = None):
+        """
+        Queue workflow and block until ComfyUI reports it finished.
+        Events arrive over the shared mux socket, so the prompt is queued under the mux's
+        client id; client_id is kept for call compatibility. on_event(evt), if given,
+        sees every event for the prompt (progress, executing, executed, ...).
+        Past deadline (time.time()), the prompt is cancelled and PromptTimeout raised.
+        """
+        mux = self.mux
+        if not mux.start():
+            raise RuntimeError("ComfyUI event socket did not connect")
+        if deadline is not None and time.time() >= deadline:
+            raise PromptTimeout(None, "waiting")
+        timer = PromptTimer(self)
+        res = self.queue_prompt(workflow, mux.client_id)
+        prompt_id = res.get("prompt_id")
+        timer.queued()
+
+        events = queue.Queue()
+        mux.subscribe(prompt_id, events.put)
+        try:
+            while True:
+                wait = self._wait_time(deadline)
+                if wait <= 0:
+                    running = timer.started_at is not None
+                    self.cancel(prompt_id, running)
+                    raise PromptTimeout(prompt_id, "running" if running else "queued")
+                try:
+                    evt = events.get(timeout=wait)
+                except queue.Empty:
+                    if wait < COMFY_WS_IDLE_CHECK:
+                        continue  # woke up for the deadline
+                    # Idle for a while: make sure we did not miss the end while the socket was down.
+                    if prompt_id in (self.get_history(prompt_id) or {}):
+                        break
+                    continue
+                timer.feed(evt)
+                if on_event is not None:
+                    on_event(evt)
+                if is_terminal(evt, prompt_id):
+                    break
+        finally:
+            mux.unsubscribe(prompt_id, events.put)
+            timer.ended()
+
+        # Minimal fetch (metadata only). You can turn this off if you want even less I/O.
+        hist = self.get_history(prompt_id)
+        timer.fetched()
+        return {"prompt_id": prompt_id, "history": hist, "_timings": timer.timings}
+
+    async def run_workflow_async(self, workflow: dict, client_id: str, on_event=None, deadline: float | None = None):
+        """
+        asyncio flavour of run_workflow_and_wait: events are handed to the running loop
+        from the mux thread, so waiting holds no worker thread. Only the short local
+        HTTP calls (/prompt, /history) are offloaded to the default executor.
+        Cancelling the task (client gone, DELETE /jobs/{id}) cancels the prompt in ComfyUI too.
+        """
+        loop = asyncio.get_running_loop()
+        mux = self.mux
+        if not await asyncio.to_thread(mux.start):
+            raise RuntimeError("ComfyUI event socket did not connect")  # nothing would see the prompt's events
+        if deadline is not None and time.time() >= deadline:
+            raise PromptTimeout(None, "waiting")
+        timer = PromptTimer(self)
+        submit = asyncio.ensure_future(asyncio.to_thread(self.queue_prompt, workflow, mux.client_id))
+        try:
+            res = await asyncio.shield(submit)
+        except asyncio.CancelledError:
+            # the POST goes through anyway: cancel the prompt it queued once its id is known
+            submit.add_done_callback(lambda f: self._cancel_submitted(loop, f))
+            raise
+        prompt_id = res.get("prompt_id")
+        timer.queued()
+
+        events = asyncio.Queue()
+        sink = lambda evt: loop.call_soon_threadsafe(events.put_nowait, evt)
+        mux.subscribe(prompt_id, sink)
+        try:
+            while True:
+                wait = self._wait_time(deadline)
+                if wait <= 0:
+                    running = timer.started_at is not None
+                    await asyncio.to_thread(self.cancel, prompt_id, running)
+                    raise PromptTimeout(prompt_id, "running" if running else "queued")
+                try:
+                    evt = await asyncio.wait_for(events.get(), wait)
+                except asyncio.TimeoutError:
+                    if wait < COMFY_WS_IDLE_CHECK:
+                        continue
+                    if prompt_id in (await asyncio.to_thread(self.get_history, prompt_id) or {}):
+                        break
+                    continue
+                timer.feed(evt)
+                if on_event is not None:
+                    on_event(evt)
+                if is_terminal(evt, prompt_id):
+                    break
+        except asyncio.CancelledError:
+            # Do not await here (the task is being torn down); the executor finishes the call.
+            loop.run_in_executor(None, self.cancel, prompt_id, timer.started_at is not None)
+            raise
+        finally:
+            mux.unsubscribe(prompt_id, sink)
+            timer.ended()
+
+        hist = await asyncio.to_thread(self.get_history, prompt_id)
+        timer.fetched()
+        return {"prompt_id": prompt_id, "history": hist, "_timings": timer.timings}
+
+    def _cancel_submitted(self, loop, submit):
+        if submit.cancelled() or submit.exception() is not None:
+            return
+        prompt_id = (submit.result() or {}).get("prompt_id")
+        if prompt_id:
+            loop.run_in_executor(None, self.cancel, prompt_id, True)  # it may have started meanwhile
+
+_DEFAULT = None
+_DEFAULT_LOCK = threading.Lock()
+
+def default_client() -> ComfyClient:
+    """Process-wide ComfyClient for the local ComfyUI server (COMFY_HOST:COMFY_PORT)."""
+    global _DEFAULT
+    with _DEFAULT_LOCK:
+        if _DEFAULT is None:
+            _DEFAULT = ComfyClient()
+        return _DEFAULT
+
+def get_mux() -> EventMux:
+    return default_client().mux
+
+# Module-level helpers kept for existing callers; all share the default client's pool.
+
+def wait_for_server(timeout=120, proc=None, ready=None):
+    return default_client().wait_for_server(timeout, proc=proc, ready=ready)
+
+def queue_prompt(workflow: dict, client_id: str, timeout: float | None = None):
+    return default_client().queue_prompt(workflow, client_id, timeout)
+
+def get_history(prompt_id: str, timeout: float | None = None):
+    return default_client().get_history(prompt_id, timeout)
+
+def run_workflow_and_wait(workflow: dict, client_id: str, on_event=None, deadline: float | None = None):
+    return default_client().run_workflow_and_wait(workflow, client_id, on_event, deadline)
 
+async def run_workflow_async(workflow: dict, client_id: str, on_event=None, deadline: float | None = None):
+    return await default_client().run_workflow_async(workflow, client_id, on_event, deadline)
@@ -0,0 +1,295 @@
+import os, time, threading, subprocess, logging
+from typing import Any, Callable, Dict, List, Optional
+
+from phserver import comfy_client
+
+# Supervisor for several ComfyUI processes on consecutive ports (COMFY_PORT, +1, ...).
+# - COMFY_INSTANCES processes take jobs; COMFY_STANDBY more are started and kept idle,
+#   and one of them takes over the moment an active instance dies.
+# - A health thread polls every instance each COMFY_HEALTH_INTERVAL seconds and restarts
+#   exited or unresponsive ones in the background, so a crash costs no request a cold start.
+# - Jobs go to the ready active instance with the fewest jobs in flight.
+COMFY_INSTANCES = int(os.getenv("COMFY_INSTANCES", "1"))
+COMFY_STANDBY = int(os.getenv("COMFY_STANDBY", "0"))
+COMFY_HEALTH_INTERVAL = float(os.getenv("COMFY_HEALTH_INTERVAL", "5"))
+COMFY_HEALTH_FAILURES = int(os.getenv("COMFY_HEALTH_FAILURES", "3"))  # failed probes before a restart
+# CPU sharding (CPU mode only): K instances, each pinned to its own slice of the cores with
+# OMP/MKL thread counts to match. "auto" = one shard per COMFY_CPU_SHARD_CORES cores.
+COMFY_CPU_SHARDS = os.getenv("COMFY_CPU_SHARDS", "0")
+COMFY_CPU_SHARD_CORES = int(os.getenv("COMFY_CPU_SHARD_CORES", "4"))
+_THREAD_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+STARTING = "starting"
+READY = "ready"
+DEAD = "dead"
+
+log = logging.getLogger("worker")
+
+
+def enabled() -> bool:
+    return COMFY_INSTANCES > 1 or COMFY_STANDBY > 0
+
+
+def available_cpus() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        return list(range(os.cpu_count() or 1))
+
+
+def shard_count(ncpus: int, setting: str = COMFY_CPU_SHARDS) -> int:
+    """Number of CPU shards for ncpus cores: an explicit count, or 'auto'."""
+    if str(setting).lower() == "auto":
+        k = ncpus // max(COMFY_CPU_SHARD_CORES, 1)
+    else:
+        k = int(setting or 0)
+    return max(1, min(k, ncpus))
+
+
+def cpu_sets(k: int, cpus: List[int]) -> List[List[int]]:
+    """Split cpus into k disjoint contiguous slices (sizes differ by at most one)."""
+    k = max(1, min(k, len(cpus)))
+    step, extra = divmod(len(cpus), k)
+    out, start = [], 0
+    for i in range(k):
+        end = start + step + (1 if i < extra else 0)
+        out.append(cpus[start:end])
+        start = end
+    return out
+
+
+def shard_env(cpus: List[int]) -> Dict[str, str]:
+    """Thread-count variables so torch/OpenMP use exactly the shard's cores."""
+    return {var: str(len(cpus)) for var in _THREAD_VARS}
+
+
+def pin_to(cpus: List[int]):
+    """preexec_fn for Popen: restrict the child (and its threads) to cpus."""
+    def _pin():
+        os.sched_setaffinity(0, cpus)
+    return _pin if hasattr(os, "sched_setaffinity") else None
+
+
+class Instance:
+    def __init__(self, index: int, port: int, role: str, output_dir: str, temp_dir: str):
+        self.index = index
+        self.port = port
+        self.role = role  # "active" | "standby"
+        self.output_dir = output_dir
+        self.temp_dir = temp_dir
+        self.client = comfy_client.ComfyClient(port=port)
+        self.proc = None
+        self.state = DEAD
+        self.inflight = 0
+        self.jobs = 0
+        self.restarts = 0
+        self.failures = 0
+        self.ready_ms: Optional[int] = None
+        self.timings: Dict[str, int] = {}  # startup phases from ComfyUI output, if watched
+        self.cpus: Optional[List[int]] = None  # CPU shard this instance is pinned to
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        out = {"index": self.index, "port": self.port, "role": self.role, "state": self.state,
+               "inflight": self.inflight, "jobs": self.jobs, "restarts": self.restarts, "ready_ms": self.ready_ms}
+        if self.cpus:
+            out["cpus"] = list(self.cpus)
+        if self.timings:
+            out["startup"] = dict(self.timings)
+        if self.error:
+            out["error"] = self.error
+        return out
+
+
+class ComfyPool:
+    """
+    spawn(instance) must start ComfyUI for that instance (its port and dirs) and return
+    the Popen; the pool waits for readiness, health-checks and restarts it. on_ready(instance),
+    if given, runs on the launch thread each time an instance comes up (first start, standby,
+    restart after a crash), e.g. to load PRELOAD_MODELS into the new process.
+    """
+
+    def __init__(self, spawn: Callable[[Instance], Any], base_port: int, output_dir: str, temp_dir: str,
+                 active: int = COMFY_INSTANCES, standby: int = COMFY_STANDBY, startup_timeout: float = 300,
+                 health_interval: float = COMFY_HEALTH_INTERVAL, cpu_sets: Optional[List[List[int]]] = None,
+                 on_ready: Optional[Callable[[Instance], None]] = None):
+        self.spawn = spawn
+        self.on_ready = on_ready
+        self.startup_timeout = startup_timeout
+        self.health_interval = health_interval
+        active, standby = max(1, active), max(0, standby)
+        if cpu_sets and active + standby > len(cpu_sets):
+            # one instance per shard: more would share cores and oversubscribe them
+            log.warning("%d ComfyUI instances for %d CPU shards; starting %d", active + standby, len(cpu_sets),
+                        len(cpu_sets))
+            active = min(active, len(cpu_sets))
+            standby = len(cpu_sets) - active
+        self.instances: List[Instance] = []
+        for i in range(active + standby):
+            suffix = "" if i == 0 else f"_{i}"  # instance 0 keeps the single-process paths
+            self.instances.append(Instance(i, base_port + i, "active" if i < active else "standby",
+                                           output_dir + suffix, temp_dir + suffix))
+            if cpu_sets:
+                self.instances[-1].cpus = cpu_sets[i]
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._supervisor: Optional[threading.Thread] = None
+        self._launches: List[threading.Thread] = []
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def start(self, wait: bool = True):
+        """Launch every instance; with wait, return once one active instance is ready."""
+        if self._supervisor is not None:
+            return
+        for inst in self.instances:
+            self._launch_async(inst)
+        self._supervisor = threading.Thread(target=self._supervise, name="comfy-pool", daemon=True)
+        self._supervisor.start()
+        if wait:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pick() is not None or self._all_dead(), self.startup_timeout)
+                first = self._pick()
+            if first is None:
+                errors = "; ".join(f"#{i.index}: {i.error}" for i in self.instances if i.error)
+                raise RuntimeError(f"no ComfyUI instance became ready ({errors or 'timeout'})")
+
+    def stop(self, timeout: float = 10):
+        """Stop supervising and shut every instance down; returns once the processes are reaped."""
+        self._stop.set()
+        self._terminate_all()  # launch threads waiting for readiness see the exit and return
+        with self._cond:
+            threads = list(self._launches) + [t for t in (self._supervisor,) if t is not None]
+        for t in threads:
+            t.join(timeout)
+        self._terminate_all()
+        for inst in self.instances:
+            if inst.proc is None:
+                continue
+            try:
+                inst.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                inst.proc.kill()
+                inst.proc.wait()
+
+    def _terminate_all(self):
+        for inst in self.instances:
+            if inst.proc is not None and inst.proc.poll() is None:
+                inst.proc.terminate()
+
+    def _all_dead(self) -> bool:
+        return all(i.state == DEAD for i in self.instances)
+
+    def _launch_async(self, inst: Instance):
+        with self._cond:
+            if inst.state == STARTING or self._stop.is_set():
+                return
+            inst.state = STARTING
+            t = threading.Thread(target=self._launch, args=(inst,), name=f"comfy-start-{inst.index}", daemon=True)
+            self._launches = [x for x in self._launches if x.is_alive()] + [t]
+        t.start()
+
+    def _launch(self, inst: Instance):
+        t0 = time.time()
+        try:
+            if inst.proc is not None and inst.proc.poll() is None:
+                inst.proc.kill()
+                inst.proc.wait()
+            inst.timings.clear()
+            inst.client.warmed.clear()  # a new process starts cold
+            inst.proc = self.spawn(inst)
+            if self._stop.is_set():  # stop() ran while this one was spawning: do not leave it behind
+                inst.proc.terminate()
+                inst.proc.wait()
+                up, err = False, "pool stopped"
+            else:
+                up = inst.client.wait_for_server(timeout=self.startup_timeout, proc=inst.proc)
+                err = None if up else (f"exited with code {inst.proc.returncode}" if inst.proc.poll() is not None
+                                       else f"not ready within {self.startup_timeout}s")
+        except Exception as e:
+            up, err = False, f"{type(e).__name__}: {e}"
+        with self._cond:
+            inst.state = READY if up else DEAD
+            inst.error = err
+            inst.failures = 0
+            if up:
+                inst.ready_ms = int((time.time() - t0) * 1000)
+            self._cond.notify_all()
+        if self._stop.is_set():
+            return
+        if err:
+            log.error("ComfyUI instance %d failed to start: %s", inst.index, err)
+        elif self.on_ready is not None:
+            try:
+                self.on_ready(inst)
+            except Exception as e:
+                log.warning("ready hook failed for ComfyUI instance %d: %s", inst.index, type(e).__name__)
+
+    def _restart(self, inst: Instance, reason: str):
+        log.warning("restarting ComfyUI instance %d: %s", inst.index, reason)
+        with self._cond:
+            inst.state = DEAD
+            inst.error = reason
+            inst.restarts += 1
+            self._cond.notify_all()
+        self._launch_async(inst)
+
+    def _supervise(self):
+        while not self._stop.wait(self.health_interval):
+            for inst in self.instances:
+                if inst.state == STARTING:
+                    continue
+                if inst.state == DEAD or inst.proc is None or inst.proc.poll() is not None:
+                    code = inst.proc.poll() if inst.proc is not None else None
+                    self._restart(inst, f"exited with code {code}" if code is not None else (inst.error or "not running"))
+                    continue
+                try:
+                    r = inst.client.session.get(f"{inst.client.base_http}/system_stats", timeout=inst.client._timeout(2))
+                    healthy = r.status_code == 200
+                except Exception:
+                    healthy = False
+                inst.failures = 0 if healthy else inst.failures + 1
+                if inst.failures >= COMFY_HEALTH_FAILURES:
+                    self._restart(inst, f"{inst.failures} failed health checks")
+
+    # -- routing -----------------------------------------------------------
+
+    @staticmethod
+    def _usable(inst: Instance) -> bool:
+        # poll() also catches a crash the health thread has not seen yet
+        return inst.state == READY and inst.proc is not None and inst.proc.poll() is None
+
+    def _pick(self) -> Optional[Instance]:
+        # Caller holds the lock. Least-loaded ready active instance; if none, promote a ready standby.
+        ready = [i for i in self.instances if i.role == "active" and self._usable(i)]
+        if not ready:
+            standby = next((i for i in self.instances if i.role == "standby" and self._usable(i)), None)
+            down = next((i for i in self.instances if i.role == "active" and not self._usable(i)), None)
+            if standby is None:
+                return None
+            if down is not None and down.state == STARTING and not down.restarts:
+                return None  # first launch still in progress: not a failure, keep the roles
+            if down is not None:
+                down.role = "standby"  # it becomes the new standby once its restart completes
+            standby.role = "active"
+            log.warning("ComfyUI standby %d promoted to active", standby.index)
+            ready = [standby]
+        return min(ready, key=lambda i: (i.inflight, i.jobs))
+
+    def acquire(self, timeout: Optional[float] = None) -> Instance:
+        """Reserve the least-loaded healthy instance; waits while every instance is (re)starting."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pick() is not None, timeout or self.startup_timeout):
+                raise RuntimeError("no healthy ComfyUI instance")
+            inst = self._pick()
+            inst.inflight += 1
+            inst.jobs += 1
+            return inst
+
+    def release(self, inst: Instance):
+        with self._cond:
+            inst.inflight -= 1
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            return [i.to_dict() for i in self.instances]
@@ -0,0 +1,351 @@
+import os, json, time, uuid, weakref, hashlib, pathlib, threading, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+
+# Model downloader used by POST /download.
+# - Servers that advertise "Accept-Ranges: bytes" with a known size are fetched over
+#   DOWNLOAD_CONNECTIONS parallel Range requests, each writing its own byte span.
+# - Bytes land in "<dest>.part"; progress per span is kept in "<dest>.part.json", so a
+#   failed download resumes where it stopped (same URL, size and ETag/Last-Modified).
+# - Optional SHA-256 check, then an atomic rename to dest: a failure never leaves a
+#   truncated file under the final name.
+# - One transfer per dest at a time (blocking /download and queued jobs alike): a second
+#   one waits for the first to finish, then looks at dest again.
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "4"))
+DOWNLOAD_MIN_SPAN_BYTES = int(os.getenv("DOWNLOAD_MIN_SPAN_BYTES", str(16 * 1024 * 1024)))
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "120"))
+_CHUNK = 1024 * 1024
+_SPAN_READ = 64 * 1024  # small reads so a dropped connection loses little of its span
+_MANIFEST_EVERY = 8 * 1024 * 1024  # flush span progress at most every N bytes per span
+# Never forwarded to another host after a redirect (requests strips them the same way)
+_CREDENTIAL_HEADERS = ("authorization", "proxy-authorization", "cookie")
+
+log = logging.getLogger("worker")
+
+_DEST_LOCKS_GUARD = threading.Lock()
+_DEST_LOCKS: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class AlreadyExists(Exception):
+    def __init__(self, path: pathlib.Path):
+        super().__init__(str(path))
+        self.path = path
+
+
+def _header(headers, name: str) -> Optional[str]:
+    return headers.get(name) or headers.get(name.lower())
+
+
+def _split(total: int, connections: int):
+    n = max(1, min(connections, total // max(DOWNLOAD_MIN_SPAN_BYTES, 1)))
+    step = -(-total // n)
+    return [[start, min(start + step, total) - 1, 0] for start in range(0, total, step)]  # [first, last, done]
+
+
+class _Manifest:
+    def __init__(self, path: pathlib.Path, meta: dict):
+        self.path = path
+        self.meta = meta
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load_or_new(cls, path: pathlib.Path, ident: dict, total: int, connections: int, part: pathlib.Path):
+        try:
+            meta = json.loads(path.read_text())
+            if meta.get("ident") == ident and part.exists() and part.stat().st_size == total:
+                return cls(path, meta), True
+        except (OSError, ValueError):
+            pass
+        meta = {"ident": ident, "spans": _split(total, connections)}
+        return cls(path, meta), False
+
+    @property
+    def spans(self):
+        return self.meta["spans"]
+
+    def done_bytes(self) -> int:
+        return sum(s[2] for s in self.spans)
+
+    def save(self):
+        with self.lock:
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(json.dumps(self.meta))
+            os.replace(tmp, self.path)
+
+
+def _headers_for(url: str, final_url: str, headers: dict) -> dict:
+    """Headers for requests to final_url: credentials only go to the host they were given for."""
+    if urlparse(final_url).netloc == urlparse(url).netloc:
+        return dict(headers)
+    return {k: v for k, v in headers.items() if k.lower() not in _CREDENTIAL_HEADERS}
+
+
+def _sha256_file(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _dest_lock(dest: pathlib.Path) -> threading.Lock:
+    """The lock guarding dest and its .part/.part.json files; alive while anyone holds a reference."""
+    with _DEST_LOCKS_GUARD:
+        lock = _DEST_LOCKS.get(str(dest))
+        if lock is None:
+            lock = _DEST_LOCKS[str(dest)] = threading.Lock()
+        return lock
+
+
+def download(url: str, dest_for: Callable[[Dict[str, str]], pathlib.Path], headers: Optional[dict] = None,
+             connections: int = DOWNLOAD_CONNECTIONS, sha256: Optional[str] = None,
+             progress: Optional[Callable[[int, Optional[int]], None]] = None) -> dict:
+    """
+    Download url. dest_for(response_headers) picks the final path once the first response
+    is in (so Content-Disposition can name the file) and may raise AlreadyExists.
+    progress(bytes_done, total_or_None) is called as data arrives.
+    Returns {"status": "ok", "path", "size", "resumed", "connections"} or {"status": "exists", "path"}.
+    """
+    import requests
+
+    hdrs = dict(headers or {})
+    while True:
+        with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=hdrs, allow_redirects=True) as r:
+            r.raise_for_status()
+            try:
+                dest = dest_for(r.headers)
+            except AlreadyExists as e:
+                return {"status": "exists", "path": str(e.path)}
+            lock = _dest_lock(dest)
+            if lock.acquire(blocking=False):
+                try:
+                    return _transfer(r, url, dest, hdrs, connections, sha256, progress)
+                finally:
+                    lock.release()
+        # another transfer owns dest's .part files: wait it out, then ask dest_for again
+        with lock:
+            pass
+
+
+def _transfer(r, url: str, dest: pathlib.Path, hdrs: dict, connections: int, sha256: Optional[str], progress) -> dict:
+    # Caller holds dest's lock.
+    part = dest.with_name(dest.name + ".part")
+    manifest_path = dest.with_name(dest.name + ".part.json")
+
+    length = _header(r.headers, "Content-Length")
+    total = int(length) if length and str(length).isdigit() else None
+    ranged = (_header(r.headers, "Accept-Ranges") or "").lower() == "bytes" and bool(total)
+    final_url = getattr(r, "url", None) or url
+
+    if not ranged:
+        # Plain stream from this response; nothing to resume from.
+        done = 0
+        h = hashlib.sha256() if sha256 else None
+        if progress:
+            progress(0, total)
+        with open(part, "wb") as f:
+            for chunk in r.iter_content(chunk_size=_CHUNK):
+                if chunk:
+                    f.write(chunk)
+                    if h is not None:
+                        h.update(chunk)
+                    done += len(chunk)
+                    if progress:
+                        progress(done, total)
+        digest = h.hexdigest() if h is not None else None
+        used, resumed = 1, False
+
+    ident = {
+        "url": url,
+        "size": total,
+        "etag": _header(r.headers, "ETag"),
+        "last_modified": _header(r.headers, "Last-Modified"),
+    }
+
+    if ranged:
+        r.close()  # spans use their own connections
+        manifest, resumed = _Manifest.load_or_new(manifest_path, ident, total, connections, part)
+        if not resumed:
+            with open(part, "wb") as f:
+                f.truncate(total)
+            manifest.save()
+        used = len(manifest.spans)
+        # span requests go straight to the redirect target (e.g. a presigned CDN URL)
+        _fetch_spans(final_url, _headers_for(url, final_url, hdrs), part, manifest, total, progress)
+        digest = None
+
+    if sha256:
+        digest = digest or _sha256_file(part)
+        if digest.lower() != sha256.lower():
+            for p in (part, manifest_path):
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+            raise DownloadError("sha256 mismatch")
+
+    os.replace(part, dest)
+    try:
+        manifest_path.unlink()
+    except OSError:
+        pass
+    return {"status": "ok", "path": str(dest), "size": dest.stat().st_size, "resumed": resumed, "connections": used}
+
+
+def _fetch_spans(url: str, headers: dict, part: pathlib.Path, manifest: _Manifest, total: int, progress):
+    import requests
+
+    lock = threading.Lock()
+    state = {"done": manifest.done_bytes()}
+    if progress:
+        progress(state["done"], total)
+
+    def _one(span):
+        first, last, done = span
+        if first + done > last:
+            return
+        hdrs = dict(headers)
+        hdrs["Range"] = f"bytes={first + done}-{last}"
+        unsaved = 0
+        fd = os.open(part, os.O_WRONLY)
+        try:
+            with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=hdrs, allow_redirects=True) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise DownloadError(f"server ignored Range request (HTTP {r.status_code})")
+                for chunk in r.iter_content(chunk_size=_SPAN_READ):
+                    if not chunk:
+                        continue
+                    room = last - (first + span[2]) + 1
+                    chunk = chunk[:room]
+                    os.pwrite(fd, chunk, first + span[2])
+                    span[2] += len(chunk)
+                    unsaved += len(chunk)
+                    with lock:
+                        state["done"] += len(chunk)
+                        if progress:
+                            progress(state["done"], total)
+                    if unsaved >= _MANIFEST_EVERY:
+                        manifest.save()
+                        unsaved = 0
+            if first + span[2] <= last:
+                raise DownloadError("connection closed before span completed")
+        finally:
+            os.close(fd)
+            manifest.save()
+
+    spans = manifest.spans
+    if len(spans) == 1:
+        _one(spans[0])
+        return
+    with ThreadPoolExecutor(max_workers=len(spans), thread_name_prefix="download") as pool:
+        for f in [pool.submit(_one, span) for span in spans]:
+            f.result()
+
+
+# Background downloads (POST /download with background=true, POST /download/batch).
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "2"))  # concurrent transfers; the rest wait IN_QUEUE
+DOWNLOAD_RETENTION_MAX = int(os.getenv("DOWNLOAD_RETENTION_MAX", "256"))  # finished tasks kept for GET /download/{id}
+
+
+class DownloadTask:
+    def __init__(self, key: tuple, url: str, work: Callable):
+        from phserver.jobs import IN_QUEUE
+
+        self.id = str(uuid.uuid4())
+        self.key = key
+        self.url = url
+        self.work = work
+        self.status = IN_QUEUE
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.bytes_done = 0
+        self.bytes_start: Optional[int] = None  # already on disk when the transfer started (resume)
+        self.total: Optional[int] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+
+    def progress(self, done: int, total: Optional[int]):
+        if self.bytes_start is None:
+            self.bytes_start = done  # first report is what was already on disk
+        self.bytes_done = done
+        self.total = total
+
+    def to_dict(self) -> dict:
+        out = {"id": self.id, "status": self.status, "url": self.url, "bytes": self.bytes_done, "total": self.total}
+        if self.started_at is not None:
+            elapsed = max((self.finished_at or time.time()) - self.started_at, 1e-6)
+            rate = (self.bytes_done - (self.bytes_start or 0)) / elapsed
+            out["bytes_per_s"] = int(rate)
+            if self.total and self.finished_at is None and rate > 0:
+                out["eta_s"] = round((self.total - self.bytes_done) / rate, 1)
+        if self.result is not None:
+            out["result"] = self.result
+        if self.error is not None:
+            out["error"] = self.error
+        return out
+
+
+class DownloadQueue:
+    """
+    Runs downloads on a bounded thread pool. A request for a url+destination that is
+    already queued or running returns the existing task instead of starting a second
+    transfer into the same .part file.
+    """
+
+    def __init__(self, workers: int = DOWNLOAD_WORKERS, retention_max: int = DOWNLOAD_RETENTION_MAX):
+        self.workers = max(1, workers)
+        self.retention_max = retention_max
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._tasks: Dict[str, DownloadTask] = {}
+        self._active: Dict[tuple, DownloadTask] = {}
+
+    def submit(self, key: tuple, url: str, work: Callable[[Callable], dict]) -> DownloadTask:
+        """work(progress) performs the transfer and returns downloader.download()'s result."""
+        with self._lock:
+            task = self._active.get(key)
+            if task is not None:
+                return task
+            task = DownloadTask(key, url, work)
+            self._tasks[task.id] = task
+            self._active[key] = task
+            self._prune()
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="dlq")
+        self._pool.submit(self._run, task)
+        return task
+
+    def get(self, task_id: str) -> Optional[DownloadTask]:
+        with self._lock:
+            return self._tasks.get(task_id)
+
+    def _run(self, task: DownloadTask):
+        from phserver.jobs import IN_PROGRESS, COMPLETED, FAILED
+
+        task.status = IN_PROGRESS
+        task.started_at = time.time()
+        try:
+            task.result = task.work(task.progress)
+            task.status = COMPLETED
+        except Exception as e:
+            log.warning("download failed: %s", type(e).__name__)
+            task.error = f"{type(e).__name__}: {getattr(e, 'detail', None) or e}"
+            task.status = FAILED
+        finally:
+            task.finished_at = time.time()
+            task.work = None
+            with self._lock:
+                if self._active.get(task.key) is task:
+                    del self._active[task.key]
+
+    def _prune(self):
+        finished = [t for t in self._tasks.values() if t.finished_at is not None]
+        for t in finished[:max(0, len(finished) - self.retention_max)]:
+            self._tasks.pop(t.id, None)
@@ -0,0 +1,221 @@
+import os, time, base64, hashlib, logging, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+from phserver import comfy_client
+from phserver import input_store
+from phserver.input_store import is_sha256
+from shared.crypto_secure import stream_decryptor_from_client
+
+# Input staging: writes request inputs (raw blobs, data: URLs, http(s) URLs) into the
+# ComfyUI input dir on tmpfs. Each file is its own task on a bounded pool, so URL
+# fetches overlap and base64 decoding stays off the request thread. Every staged file
+# is also recorded in the content-addressed input store, so later requests can send
+# "sha256:<hex>" (or {"url": ..., "sha256": ...}) instead of the bytes.
+INPUT_DIR = "/dev/shm/comfy_input"
+INPUT_FETCH_CONCURRENCY = int(os.getenv("INPUT_FETCH_CONCURRENCY", "8"))
+INPUT_FETCH_TIMEOUT = float(os.getenv("INPUT_FETCH_TIMEOUT", "30"))
+INPUT_MAX_BYTES = int(os.getenv("INPUT_MAX_BYTES", str(512 * 1024 * 1024)))  # per file
+_FETCH_CHUNK = 256 * 1024
+
+log = logging.getLogger("worker")
+
+_POOL = None
+_FETCH_SESSION = None
+
+
+class InputTooLarge(ValueError):
+    pass
+
+
+class InputNotStored(LookupError):
+    pass
+
+
+class InputHashMismatch(ValueError):
+    pass
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadPoolExecutor(max_workers=max(1, INPUT_FETCH_CONCURRENCY), thread_name_prefix="input-stage")
+    return _POOL
+
+
+def _fetch_session():
+    """Keep-alive session reused for input URL downloads (same pooling as ComfyUI calls)."""
+    global _FETCH_SESSION
+    if _FETCH_SESSION is None:
+        _FETCH_SESSION = comfy_client.make_session(max(INPUT_FETCH_CONCURRENCY, 1))
+    return _FETCH_SESSION
+
+
+def input_path(filename: str) -> str:
+    """Destination under INPUT_DIR for an input file; rejects names that escape it."""
+    root = os.path.realpath(INPUT_DIR)
+    path = os.path.realpath(os.path.join(root, str(filename)))
+    if not path.startswith(root + os.sep):
+        raise ValueError(f"invalid input filename: {filename!r}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def _open_part(path: str):
+    """(file, name) of a fresh .part file beside path; concurrent jobs staging one name never share it."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".part")
+    return os.fdopen(fd, "wb"), tmp
+
+
+def _write_chunks(path: str, chunks, scope: str, expect_sha: str | None = None) -> int:
+    """
+    Write chunks to path via a .part file, enforcing INPUT_MAX_BYTES and hashing on the
+    fly; the result is added to the input store under scope. Returns (bytes written, sha256).
+    """
+    f, tmp = _open_part(path)
+    size = 0
+    h = hashlib.sha256()
+    try:
+        with f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > INPUT_MAX_BYTES:
+                    raise InputTooLarge(f"input exceeds INPUT_MAX_BYTES ({INPUT_MAX_BYTES})")
+                h.update(chunk)
+                f.write(chunk)
+        sha = h.hexdigest()
+        if expect_sha and sha != expect_sha:
+            raise InputHashMismatch("downloaded content does not match sha256")
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    input_store.STORE.add(path, sha, size, scope)
+    return size, sha
+
+
+def _stage_blob(filename: str, blob, scope: str) -> Tuple[int, str]:
+    return _write_chunks(input_path(filename), [blob], scope)
+
+
+def _stage_data_url(filename: str, value: str, scope: str) -> Tuple[int, str]:
+    header, encoded = value.split(',', 1)
+    if len(encoded) * 3 // 4 > INPUT_MAX_BYTES:
+        raise InputTooLarge(f"input exceeds INPUT_MAX_BYTES ({INPUT_MAX_BYTES})")
+    return _write_chunks(input_path(filename), [base64.b64decode(encoded)], scope)
+
+
+def _stage_url(filename: str, url: str, scope: str, expect_sha: str | None = None) -> Tuple[int, str]:
+    with _fetch_session().get(url, stream=True, timeout=INPUT_FETCH_TIMEOUT) as r:
+        r.raise_for_status()
+        declared = r.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > INPUT_MAX_BYTES:
+            raise InputTooLarge(f"input exceeds INPUT_MAX_BYTES ({INPUT_MAX_BYTES})")
+        return _write_chunks(input_path(filename), r.iter_content(chunk_size=_FETCH_CHUNK), scope, expect_sha)
+
+
+def _stage_stored(filename: str, sha: str, scope: str) -> Tuple[int, str]:
+    sha = sha.lower()
+    size = input_store.STORE.materialize(sha, input_path(filename), scope)
+    if size is None:
+        raise InputNotStored("input hash not in store; upload the bytes")
+    return size, sha
+
+
+def _stage_ref(filename: str, ref: dict, scope: str) -> Tuple[int, str]:
+    """{"sha256": hex, "url"?: ...}: use the stored copy when present, else fetch and verify."""
+    sha = str(ref.get("sha256") or "").lower()
+    if sha:
+        size = input_store.STORE.materialize(sha, input_path(filename), scope)
+        if size is not None:
+            return size, sha
+    url = ref.get("url")
+    if not url:
+        raise InputNotStored("input hash not in store; upload the bytes")
+    return _stage_url(filename, url, scope, sha or None)
+
+
+def _timed(source: str, fn, filename: str, value, digests: Dict[str, str], scope: str) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    stat = {"source": source, "ok": True, "bytes": 0}
+    try:
+        stat["bytes"], sha = fn(filename, value, scope)
+        digests[os.path.realpath(input_path(filename))] = sha
+        log.info(f"Staged {source} input: {filename}")
+    except Exception as e:
+        stat["ok"] = False
+        stat["error"] = type(e).__name__
+        log.error(f"Failed to process image {filename}: {e}")
+    stat["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return stat
+
+
+def stage_inputs(data: Dict[str, Any], scope: str = "") -> List[Dict[str, Any]]:
+    """
+    Stage payload['input_blobs'] (raw bytes) and payload['input_images']
+    ({filename: data-URL | http(s) URL | "sha256:<hex>" | {"sha256", "url"?}}) concurrently, at most INPUT_FETCH_CONCURRENCY
+    at a time. Failures are logged per file and do not abort the others.
+    Returns per-file stats in submission order: source, ok, bytes, ms (no filenames,
+    since responses are not encrypted). The sha256 of every staged file, keyed by its real
+    path, goes to payload['_input_digests'] so cache keys need not hash the inputs again.
+    Store lookups and additions are confined to scope (the caller's tenant).
+    """
+    digests = data["_input_digests"] = {}  # always reset: never trust a client-supplied map
+    jobs = []
+    for filename, blob in (data.pop("input_blobs", None) or {}).items():
+        jobs.append(("blob", _stage_blob, filename, blob))
+    for filename, value in (data.get("input_images") or {}).items():
+        if isinstance(value, dict):
+            jobs.append(("ref", _stage_ref, filename, value))
+            continue
+        if not isinstance(value, str):
+            continue
+        if value.startswith("sha256:") and is_sha256(value[7:].lower()):
+            jobs.append(("store", _stage_stored, filename, value[7:]))
+        elif value.startswith("data:"):
+            jobs.append(("data_url", _stage_data_url, filename, value))
+        elif value.startswith("http"):
+            jobs.append(("url", _stage_url, filename, value))
+    if not jobs:
+        return []
+    if len(jobs) == 1:
+        return [_timed(*jobs[0], digests, scope)]
+    futures = [_pool().submit(_timed, *job, digests, scope) for job in jobs]
+    return [f.result() for f in futures]
+
+
+async def stage_input_stream(filename: str, pieces, server_sk_b64: str, scope_for=None) -> int:
+    """
+    Decrypt a chunked upload stream (crypto_secure secretstream format) from the async
+    iterator `pieces` straight into the input dir, one chunk in memory at a time.
+    The file only appears under its final name once the stream authenticated to the end.
+    scope_for(epk bytes), if given, names the store scope the upload is recorded under.
+    Returns the plaintext size.
+    """
+    path = input_path(filename)
+    f, tmp = _open_part(path)
+    dec = stream_decryptor_from_client(server_sk_b64)
+    size = 0
+    h = hashlib.sha256()
+    try:
+        with f:
+            async for piece in pieces:
+                for chunk in dec.feed(piece):
+                    size += len(chunk)
+                    if size > INPUT_MAX_BYTES:
+                        raise InputTooLarge(f"input exceeds INPUT_MAX_BYTES ({INPUT_MAX_BYTES})")
+                    h.update(chunk)
+                    f.write(chunk)
+        dec.close()
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    input_store.STORE.add(path, h.hexdigest(), size, scope_for(dec.epk) if scope_for else "")
+    return size
@@ -0,0 +1,140 @@
+import os, re, shutil, hashlib, secrets, threading, logging
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+# Content-addressed store for staged inputs, keyed by SHA-256 of the file bytes.
+# Every lookup is scoped to the caller (worker_core._tenant): an entry is stored under
+# sha256(scope, sha), so nobody can probe for or reference another tenant's inputs.
+# Lives on the same tmpfs as the ComfyUI input dir so entries are hard-linked, not
+# copied, into place. LRU eviction keeps the store under INPUT_STORE_BYTES
+# (0 disables the store entirely).
+INPUT_STORE_DIR = os.getenv("INPUT_STORE_DIR", "/dev/shm/comfy_input_store")
+INPUT_STORE_BYTES = int(os.getenv("INPUT_STORE_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+log = logging.getLogger("worker")
+
+
+def is_sha256(value: str) -> bool:
+    return bool(_SHA256_RE.match(str(value)))
+
+
+def _link_or_copy(src: str, dst: str):
+    tmp = f"{dst}.{secrets.token_hex(6)}.part"  # unique: two jobs may materialize the same name
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _scoped(sha: str, scope: str) -> str:
+    return hashlib.sha256(f"{scope}\0{sha}".encode("utf-8")).hexdigest() if scope else sha
+
+
+class InputStore:
+    def __init__(self, root: str = INPUT_STORE_DIR, budget: int = INPUT_STORE_BYTES):
+        self.root = root
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # sha -> size, oldest first
+        self._bytes = 0
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def _path(self, sha: str) -> str:
+        return os.path.join(self.root, sha)
+
+    def _load(self):
+        # Caller holds the lock. Pick up entries that survived a server restart (tmpfs outlives us).
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and is_sha256(entry.name):
+                st = entry.stat()
+                found.append((st.st_atime, entry.name, st.st_size))
+        for _, sha, size in sorted(found):
+            self._entries[sha] = size
+            self._bytes += size
+
+    def usage(self) -> Dict[str, int]:
+        with self._lock:
+            self._load()
+            return {"entries": len(self._entries), "bytes": self._bytes, "budget": self.budget}
+
+    def has(self, sha: str, scope: str = "") -> bool:
+        with self._lock:
+            self._load()
+            return _scoped(str(sha).lower(), scope) in self._entries
+
+    def probe(self, hashes: Iterable[str], scope: str = "") -> Dict[str, List[str]]:
+        present, missing = [], []
+        with self._lock:
+            self._load()
+            for h in hashes:
+                h = str(h).lower()
+                (present if _scoped(h, scope) in self._entries else missing).append(h)
+        return {"present": present, "missing": missing}
+
+    def add(self, path: str, sha: str, size: int, scope: str = ""):
+        """Record an already-written file under its hash (hard link), then evict to budget."""
+        if not self.enabled or not is_sha256(sha) or size > self.budget:
+            return
+        sha = _scoped(sha, scope)
+        with self._lock:
+            self._load()
+            if sha in self._entries:
+                self._entries.move_to_end(sha)
+                return
+            try:
+                _link_or_copy(path, self._path(sha))
+            except OSError as e:
+                log.error(f"input store add failed: {e}")
+                return
+            self._entries[sha] = size
+            self._bytes += size
+            self._evict()
+
+    def materialize(self, sha: str, dest: str, scope: str = "") -> Optional[int]:
+        """Place the stored file for sha at dest; returns its size, or None on a miss."""
+        sha = _scoped(str(sha).lower(), scope)
+        with self._lock:
+            self._load()
+            size = self._entries.get(sha)
+            if size is None:
+                return None
+            self._entries.move_to_end(sha)
+            try:
+                _link_or_copy(self._path(sha), dest)
+            except FileNotFoundError:
+                self._entries.pop(sha, None)
+                self._bytes -= size
+                return None
+        return size
+
+    def _evict(self):
+        while self._bytes > self.budget and self._entries:
+            sha, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(self._path(sha))
+            except OSError:
+                pass
+
+
+STORE = InputStore()
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
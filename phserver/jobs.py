@@ -0,0 +1,226 @@
+import os, time, uuid, asyncio, logging
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# In-process job table for Pod mode (POST /jobs, GET/DELETE /jobs/{id}).
+# Status strings and response fields mirror RunPod's /run + /status contract.
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "64"))  # max jobs not yet finished
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))  # keep finished jobs this long
+JOB_RETENTION_MAX = int(os.getenv("JOB_RETENTION_MAX", "256"))  # ...and at most this many
+JOB_EVENT_BUFFER = int(os.getenv("JOB_EVENT_BUFFER", "512"))  # progress events replayed to late stream subscribers
+
+IN_QUEUE = "IN_QUEUE"
+IN_PROGRESS = "IN_PROGRESS"
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+FINAL_STATES = (COMPLETED, FAILED, CANCELLED)
+
+log = logging.getLogger("worker")
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class NodeTimer:
+    """
+    Turns raw ComfyUI events for one prompt into compact progress events for API
+    clients: node start/finish with wall time, sampler progress, cached nodes, end.
+    Only node ids and counters are forwarded, never workflow inputs.
+    """
+
+    def __init__(self):
+        self.node: Optional[str] = None
+        self.node_t0 = 0.0
+        self.t0 = time.time()
+        self.ended = False
+
+    def _finish_node(self, now: float) -> list:
+        if self.node is None:
+            return []
+        out = [{"type": "node_done", "node": self.node, "ms": int((now - self.node_t0) * 1000)}]
+        self.node = None
+        return out
+
+    def _end(self, now: float, **extra) -> list:
+        self.ended = True
+        return self._finish_node(now) + [{"type": "end", "ms": int((now - self.t0) * 1000), **extra}]
+
+    def feed(self, evt: Dict[str, Any]) -> list:
+        if self.ended:
+            return []
+        etype = evt.get("type")
+        data = evt.get("data") or {}
+        now = time.time()
+        if etype == "execution_start":
+            self.t0 = now
+            return [{"type": "start"}]
+        if etype == "execution_cached":
+            return [{"type": "cached", "nodes": list(data.get("nodes") or [])}]
+        if etype == "executing":
+            node = data.get("node")
+            if node is None:
+                return self._end(now)
+            out = self._finish_node(now)
+            self.node, self.node_t0 = str(node), now
+            return out + [{"type": "node_start", "node": self.node}]
+        if etype == "progress":
+            return [{"type": "progress", "node": data.get("node"), "value": data.get("value"), "max": data.get("max")}]
+        if etype == "executed":
+            return [{"type": "executed", "node": data.get("node")}]
+        if etype in ("execution_success", "execution_end", "execution_error", "execution_interrupted"):
+            return self._end(now, status=etype)
+        return []
+
+
+class Job:
+    def __init__(self, data: Dict[str, Any], encode: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None):
+        self.id = str(uuid.uuid4())
+        self.status = IN_QUEUE
+        self.data = data
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.output: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.encode = encode  # optional per-event encryption for the stream
+        self.events = deque(maxlen=JOB_EVENT_BUFFER)
+        self._listeners = set()
+        self._timer = NodeTimer()
+
+    def on_comfy_event(self, evt: Dict[str, Any]):
+        if self.done:
+            return  # a cancelled job's prompt may keep running for single-flight followers
+        for out in self._timer.feed(evt):
+            self.publish(out)
+
+    def publish(self, evt: Dict[str, Any]):
+        if self.encode is not None:
+            evt = self.encode(evt)
+        self.events.append(evt)
+        for q in self._listeners:
+            q.put_nowait(evt)
+
+    def listen(self) -> asyncio.Queue:
+        """Queue pre-loaded with buffered events, then fed live; None marks the end of the stream."""
+        q = asyncio.Queue()
+        for evt in self.events:
+            q.put_nowait(evt)
+        if self.done:
+            q.put_nowait(None)
+        else:
+            self._listeners.add(q)
+        return q
+
+    def unlisten(self, q: asyncio.Queue):
+        self._listeners.discard(q)
+
+    def _close_stream(self):
+        self.publish({"type": "status", "status": self.status})
+        for q in self._listeners:
+            q.put_nowait(None)
+        self._listeners.clear()
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINAL_STATES
+
+    def to_dict(self) -> Dict[str, Any]:
+        out = {"id": self.id, "status": self.status}
+        if self.started_at is not None:
+            out["delayTime"] = int((self.started_at - self.created_at) * 1000)
+        if self.finished_at is not None and self.started_at is not None:
+            out["executionTime"] = int((self.finished_at - self.started_at) * 1000)
+        if self.output is not None:
+            out["output"] = self.output
+        if self.error is not None:
+            out["error"] = self.error
+        return out
+
+
+class JobTable:
+    """
+    Runs each submitted job as an asyncio task on the server loop. Unfinished jobs are
+    capped at max_active (submit raises JobQueueFull); finished jobs are dropped after
+    retention_s or once more than retention_max of them are kept.
+    """
+
+    def __init__(self, runner: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+                 max_active: int = JOB_QUEUE_MAX, retention_s: int = JOB_RETENTION_SECONDS,
+                 retention_max: int = JOB_RETENTION_MAX):
+        self.runner = runner
+        self.max_active = max_active
+        self.retention_s = retention_s
+        self.retention_max = retention_max
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+
+    def active_count(self) -> int:
+        return sum(1 for j in self._jobs.values() if not j.done)
+
+    def submit(self, data: Dict[str, Any], encode=None) -> Job:
+        self._prune()
+        if self.active_count() >= self.max_active:
+            raise JobQueueFull(f"job queue full ({self.max_active} active)")
+        job = Job(data, encode)
+        self._jobs[job.id] = job
+        job.task = asyncio.get_running_loop().create_task(self._run(job))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._prune()
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if not job.done:
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            if job.task is not None:
+                job.task.cancel()
+            job._close_stream()
+        return job
+
+    async def _run(self, job: Job):
+        job.status = IN_PROGRESS
+        job.started_at = time.time()
+        try:
+            res = await self.runner(job.data, job.on_comfy_event)
+        except asyncio.CancelledError:
+            if job.status != CANCELLED:
+                job.status = CANCELLED
+                job._close_stream()
+            raise
+        except Exception as e:
+            log.exception("job failed")
+            job.status = FAILED
+            job.error = f"{type(e).__name__}: {e}"
+            job._close_stream()
+        else:
+            if isinstance(res, dict) and res.get("error"):
+                job.status = FAILED
+                job.error = res["error"]
+                details = {k: v for k, v in res.items() if k != "error"}
+                if details:
+                    job.output = details  # e.g. the structured timeout, or retry_after
+            else:
+                job.status = COMPLETED
+                job.output = res
+            job._close_stream()
+        finally:
+            job.data = None  # drop the (possibly large) request payload as soon as it is consumed
+            if job.finished_at is None:
+                job.finished_at = time.time()
+
+    def _prune(self):
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.done]
+        for j in finished:
+            if now - (j.finished_at or now) > self.retention_s:
+                self._jobs.pop(j.id, None)
+        finished = [j for j in self._jobs.values() if j.done]
+        for j in finished[:max(0, len(finished) - self.retention_max)]:
+            self._jobs.pop(j.id, None)
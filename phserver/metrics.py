@@ -0,0 +1,208 @@
+import os, time, threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# In-process metrics in the Prometheus text format (GET /metrics, handler.py action "metrics").
+# Label values are fixed identifiers only (stage names, outcome classes, instance
+# indexes), never anything taken from a workflow, filename or prompt text: the
+# endpoint is unauthenticated and sits next to an encrypted API.
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "comfy_worker")
+
+# Request stages timed by worker_core / comfy_client
+STAGES = ("decrypt", "input_staging", "submit", "queue_wait", "execution", "history_fetch", "output_encrypt")
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _fmt_labels(labels: Labels, extra: Labels = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name, self.help = name, help
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, n: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self._lock:
+            return [(self.name + "_total", k, v) for k, v in sorted(self._values.items())]
+
+
+class Gauge:
+    """
+    Value read at scrape time: fn() returns a number or {labels-tuple: number}. kind="counter"
+    exposes a monotonic count kept elsewhere (e.g. pool restarts).
+    """
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Any], kind: str = "gauge"):
+        self.name, self.help, self.fn, self.kind = name, help, fn, kind
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        try:
+            v = self.fn()
+        except Exception:
+            return []
+        if isinstance(v, dict):
+            return [(self.name, k, x) for k, x in sorted(v.items())]
+        return [] if v is None else [(self.name, (), v)]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=BUCKETS):
+        self.name, self.help = name, help
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._lock = threading.Lock()
+        self._series: Dict[Labels, List[float]] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {",".join(v for _, v in k) or "_": {"count": s[-1], "sum": round(s[-2], 6)}
+                    for k, s in sorted(self._series.items())}
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        out = []
+        with self._lock:
+            for key, s in sorted(self._series.items()):
+                for i, le in enumerate(self.buckets):
+                    out.append((self.name + "_bucket", key + (("le", _fmt_value(le)),), s[i]))
+                out.append((self.name + "_sum", key, s[-2]))
+                out.append((self.name + "_count", key, s[-1]))
+        return out
+
+
+class Registry:
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self._metrics: Dict[str, Any] = {}
+
+    def _add(self, metric):
+        metric.name = f"{self.prefix}_{metric.name}"
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets=BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], Any], kind: str = "gauge") -> Gauge:
+        """Register (or replace) a scrape-time gauge."""
+        g = Gauge(name, help, fn, kind)
+        g.name = f"{self.prefix}_{name}"
+        self._metrics[g.name] = g
+        return g
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics.values():
+            samples = m.samples()
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_fmt_labels(labels)} {_fmt_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSON-friendly view: histogram counts/sums per label set, counter and gauge values."""
+        out: Dict[str, Any] = {}
+        for m in self._metrics.values():
+            short = m.name[len(self.prefix) + 1:]
+            if isinstance(m, Histogram):
+                out[short] = m.summary()
+            else:
+                vals = {",".join(v for _, v in labels) or "_": value for _, labels, value in m.samples()}
+                out[short] = vals.get("_", vals) if set(vals) == {"_"} else vals
+        return out
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("stage_seconds", "Time spent per request stage")
+REQUEST_SECONDS = REGISTRY.histogram("request_seconds", "End-to-end request time in the worker")
+REQUESTS = REGISTRY.counter("requests", "Finished requests by outcome (ok | error)")
+
+_inflight = [0]
+_inflight_lock = threading.Lock()
+REGISTRY.gauge("jobs_inflight", "Requests currently being handled", lambda: _inflight[0])
+
+
+def observe_stages(timings: Optional[Dict[str, float]]):
+    """Record a {stage: seconds} mapping (e.g. a comfy_client result's _timings)."""
+    for stage, seconds in (timings or {}).items():
+        if stage in STAGES and seconds is not None:
+            STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def labels(**kv: Any) -> Labels:
+    """Label key for gauge callbacks returning several series."""
+    return tuple((k, str(v)) for k, v in sorted(kv.items()))
+
+
+def stage(name: str):
+    return STAGE_SECONDS.time(stage=name)
+
+
+@contextmanager
+def request() -> Iterator[Dict[str, Any]]:
+    """Track one request: in-flight gauge, total time; set out['ok'] to record the outcome."""
+    out: Dict[str, Any] = {"ok": False}
+    with _inflight_lock:
+        _inflight[0] += 1
+    t0 = time.perf_counter()
+    try:
+        yield out
+    finally:
+        with _inflight_lock:
+            _inflight[0] -= 1
+        REQUEST_SECONDS.observe(time.perf_counter() - t0)
+        REQUESTS.inc(outcome="ok" if out["ok"] else "error")
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def snapshot() -> Dict[str, Any]:
+    return REGISTRY.snapshot()
@@ -0,0 +1,280 @@
+import os, json, time, struct, hashlib, threading, logging
+from typing import Dict, Iterable, List, Optional
+
+# Persistent inventory of model files for /models/ls and lookup by hash.
+# - Kept in memory and saved as JSON next to the models (MODEL_INDEX_PATH), so a
+#   restarted pod does not re-hash multi-GB files it has already seen.
+# - Rescans are incremental: a file whose size and mtime are unchanged keeps its
+#   entry; only new or modified files are re-read. Requests never walk the tree;
+#   a stale index is refreshed in the background (MODEL_INDEX_RESCAN_SECONDS).
+# - SHA-256 is computed off the request path (MODEL_INDEX_HASH=0 disables it).
+MODEL_INDEX_PATH = os.getenv("MODEL_INDEX_PATH", "")  # default: <model dir>/.model_index.json
+MODEL_INDEX_RESCAN_SECONDS = int(os.getenv("MODEL_INDEX_RESCAN_SECONDS", "60"))
+MODEL_INDEX_HASH = os.getenv("MODEL_INDEX_HASH", "1") == "1"
+_CHUNK = 1024 * 1024
+_SAFETENSORS_HEADER_MAX = 16 * 1024 * 1024
+_META_VALUE_MAX = 1024  # long __metadata__ values (training tag dumps) are truncated
+_SKIP_SUFFIXES = (".part", ".part.json", ".tmp")
+
+log = logging.getLogger("worker")
+
+
+def safetensors_metadata(path: str) -> Optional[Dict[str, str]]:
+    """The '__metadata__' block of a .safetensors header, or None if absent/unreadable."""
+    try:
+        with open(path, "rb") as f:
+            (n,) = struct.unpack("<Q", f.read(8))
+            if n > _SAFETENSORS_HEADER_MAX:
+                return None
+            header = json.loads(f.read(n))
+    except (OSError, ValueError, struct.error):
+        return None
+    meta = header.get("__metadata__") if isinstance(header, dict) else None
+    if not isinstance(meta, dict):
+        return None
+    return {str(k): str(v)[:_META_VALUE_MAX] for k, v in meta.items()}
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ModelIndex:
+    def __init__(self, root: str, folders: Iterable[str], path: Optional[str] = None,
+                 rescan_s: int = MODEL_INDEX_RESCAN_SECONDS, hash_files: bool = MODEL_INDEX_HASH):
+        self.root = root
+        self.folders = sorted(set(folders))
+        self.path = path or MODEL_INDEX_PATH or os.path.join(root, ".model_index.json")
+        self.rescan_s = rescan_s
+        self.hash_files = hash_files
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}  # "<folder>/<relative name>" -> entry
+        self._by_hash: Dict[str, str] = {}
+        self._unhashed = 0
+        self._scanned_at = 0.0
+        self._hash_pass_at = 0.0
+        self._loaded = False
+        self._worker: Optional[threading.Thread] = None
+
+    # -- persistence -------------------------------------------------------
+
+    def _load(self):
+        # Caller holds the lock.
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            self._entries = {k: v for k, v in saved.get("entries", {}).items() if isinstance(v, dict)}
+        except (OSError, ValueError):
+            self._entries = {}
+        self._reindex_hashes()
+
+    def _reindex_hashes(self):
+        self._by_hash = {e["sha256"]: key for key, e in self._entries.items() if e.get("sha256")}
+        self._unhashed = sum(1 for e in self._entries.values() if not e.get("sha256"))
+
+    def _save(self):
+        with self._lock:
+            snapshot = json.dumps({"version": 1, "entries": self._entries})
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(snapshot)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("model index not saved: %s", type(e).__name__)
+
+    # -- scanning ----------------------------------------------------------
+
+    def _walk(self, folder: str):
+        top = os.path.join(self.root, folder)
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            try:
+                it = list(os.scandir(d))
+            except OSError:
+                continue
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=True):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=True) and not entry.name.endswith(_SKIP_SUFFIXES):
+                    yield os.path.relpath(entry.path, top).replace(os.sep, "/"), entry.path, entry.stat()
+
+    def refresh(self) -> Dict[str, int]:
+        """Rescan all folders; unchanged files (same size and mtime) keep their entry and hash."""
+        seen: Dict[str, dict] = {}
+        with self._lock:
+            self._load()
+            old = dict(self._entries)
+        added = changed = 0
+        for folder in self.folders:
+            for name, full, st in self._walk(folder):
+                key = f"{folder}/{name}"
+                prev = old.get(key)
+                if prev and prev.get("size") == st.st_size and prev.get("mtime_ns") == st.st_mtime_ns:
+                    seen[key] = prev
+                    continue
+                added += prev is None
+                changed += prev is not None
+                seen[key] = {
+                    "folder": folder,
+                    "name": name,
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "sha256": None,
+                    "metadata": safetensors_metadata(full) if name.endswith(".safetensors") else None,
+                }
+        removed = len(set(old) - set(seen))
+        with self._lock:
+            self._entries = seen
+            self._reindex_hashes()
+            self._scanned_at = time.time()
+        if added or changed or removed:
+            self._save()
+        return {"files": len(seen), "added": added, "changed": changed, "removed": removed}
+
+    def hash_pending(self) -> int:
+        """Hash entries without a SHA-256; a file modified while hashing is left for the next pass."""
+        with self._lock:
+            todo = [(k, dict(e)) for k, e in self._entries.items() if not e.get("sha256")]
+        done = 0
+        for key, e in todo:
+            full = os.path.join(self.root, e["folder"], e["name"])
+            try:
+                digest = file_sha256(full)
+                st = os.stat(full)
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) != (e["size"], e["mtime_ns"]):
+                continue
+            with self._lock:
+                cur = self._entries.get(key)
+                if cur is not None and cur["mtime_ns"] == e["mtime_ns"] and not cur.get("sha256"):
+                    cur["sha256"] = digest
+                    self._by_hash[digest] = key
+                    self._unhashed -= 1
+                    done += 1
+        self._hash_pass_at = time.time()
+        if done:
+            self._save()
+        return done
+
+    def note(self, full_path: str, sha256: Optional[str] = None):
+        """Record a file just written under the model dir (e.g. by /download), hash included if known."""
+        rel = os.path.relpath(os.path.realpath(full_path), os.path.realpath(self.root)).replace(os.sep, "/")
+        folder, _, name = rel.partition("/")
+        if folder not in self.folders or not name:
+            return
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return
+        entry = {
+            "folder": folder,
+            "name": name,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": sha256.lower() if sha256 else None,
+            "metadata": safetensors_metadata(full_path) if name.endswith(".safetensors") else None,
+        }
+        with self._lock:
+            self._load()
+            self._entries[rel] = entry
+            self._reindex_hashes()
+            if not entry["sha256"]:
+                self._hash_pass_at = 0.0
+        self._save()
+
+    def _background(self):
+        try:
+            self.refresh()
+            if self.hash_files:
+                self.hash_pending()
+        except Exception:
+            log.exception("model index refresh failed")
+
+    def ensure_fresh(self, force: bool = False):
+        """
+        First call (and force=True) scans synchronously; afterwards a stale index, or one
+        with files not yet hashed, is updated on a background thread while callers read
+        the current one.
+        """
+        if force or not self._scanned_at:
+            self.refresh()
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            stale = time.time() - self._scanned_at > self.rescan_s
+            unhashed = self.hash_files and self._unhashed and self._hash_pass_at < self._scanned_at
+            if not (stale or unhashed):
+                return
+            self._worker = threading.Thread(target=self._background, name="model-index", daemon=True)
+            self._worker.start()
+
+    def wait(self, timeout: Optional[float] = None):
+        """Block until a running background refresh/hash pass finishes (tests, warm-up)."""
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+
+    # -- queries -----------------------------------------------------------
+
+    @staticmethod
+    def _public(e: dict) -> dict:
+        out = {"name": e["name"], "size": e["size"], "mtime": e["mtime_ns"] // 1_000_000_000, "sha256": e.get("sha256")}
+        if e.get("metadata"):
+            out["metadata"] = e["metadata"]
+        return out
+
+    def listing(self, folder: Optional[str] = None, q: Optional[str] = None, ext: Optional[str] = None,
+                metadata: bool = False) -> Dict[str, List[dict]]:
+        q = q.lower() if q else None
+        ext = ext.lower().lstrip(".") if ext else None
+        out: Dict[str, List[dict]] = {f: [] for f in self.folders if folder in (None, f)}
+        with self._lock:
+            entries = list(self._entries.values())
+        for e in entries:
+            if e["folder"] not in out:
+                continue
+            if q and q not in e["name"].lower():
+                continue
+            if ext and not e["name"].lower().endswith("." + ext):
+                continue
+            item = self._public(e)
+            if not metadata:
+                item.pop("metadata", None)
+            out[e["folder"]].append(item)
+        for files in out.values():
+            files.sort(key=lambda x: x["name"])
+        return out
+
+    def by_hash(self, sha: str) -> Optional[dict]:
+        """Exact SHA-256, or a unique prefix of at least 10 hex chars (Civitai 'AutoV2' style)."""
+        sha = sha.lower()
+        with self._lock:
+            key = self._by_hash.get(sha)
+            if key is None and len(sha) >= 10:
+                hits = [k for h, k in self._by_hash.items() if h.startswith(sha)]
+                key = hits[0] if len(hits) == 1 else None
+            e = self._entries.get(key) if key else None
+        if e is None:
+            return None
+        return {"folder": e["folder"], "path": os.path.join(self.root, e["folder"], e["name"]), **self._public(e)}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "hashed": len(self._by_hash),
+                "bytes": sum(e["size"] for e in self._entries.values()),
+                "scanned_at": int(self._scanned_at),
+            }
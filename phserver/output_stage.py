@@ -0,0 +1,159 @@
+import os, time, base64, secrets, threading, logging
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from shared import crypto_secure
+from shared.payload_codec import pack_payload
+
+# Returns the files a finished prompt wrote (request field return_outputs=true).
+# - Files referenced by the prompt's history are collected from its output/temp dirs.
+# - Up to OUTPUT_INLINE_MAX_BYTES in total go back inline: for encrypted requests as one
+#   Box sealed to the request's epk holding a shared.payload_codec payload (names + bytes).
+# - Larger files are parked for a one-shot GET /outputs/{token}, streamed with
+#   crypto_secure.stream_encryptor_to_client, for at most OUTPUT_RETENTION_SECONDS.
+# - Every returned (or expired) file is overwritten and unlinked from tmpfs.
+# - Serverless has no /outputs route: there everything must fit inline (OutputsTooLarge).
+OUTPUT_INLINE_MAX_BYTES = int(os.getenv("OUTPUT_INLINE_MAX_BYTES", str(4 * 1024 * 1024)))
+OUTPUT_RETENTION_SECONDS = int(os.getenv("OUTPUT_RETENTION_SECONDS", "600"))
+_CHUNK = 1024 * 1024
+
+log = logging.getLogger("worker")
+
+
+class OutputsTooLarge(ValueError):
+    pass
+
+
+def secure_delete(path: str):
+    """Overwrite the file with zeros, then unlink it (on tmpfs this wipes the RAM pages)."""
+    try:
+        size = os.path.getsize(path)
+        with open(path, "r+b", buffering=0) as f:
+            zeros = bytes(min(size, _CHUNK))
+            left = size
+            while left > 0:
+                left -= f.write(zeros[:min(left, _CHUNK)])
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning("secure delete failed: %s", type(e).__name__)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def collect(history: Dict[str, Any], prompt_id: str, output_dir: str, temp_dir: str) -> List[Dict[str, Any]]:
+    """Files listed under history[prompt_id]['outputs'] that exist inside the prompt's output/temp dirs."""
+    entry = (history or {}).get(prompt_id) or {}
+    roots = {"output": os.path.realpath(output_dir), "temp": os.path.realpath(temp_dir)}
+    found, seen = [], set()
+    for node_id, node_out in (entry.get("outputs") or {}).items():
+        for kind, items in (node_out or {}).items():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                if not isinstance(item, dict) or "filename" not in item:
+                    continue
+                root = roots.get(item.get("type", "output"))
+                if root is None:
+                    continue
+                path = os.path.realpath(os.path.join(root, item.get("subfolder") or "", item["filename"]))
+                if os.path.commonpath([root, path]) != root or path in seen or not os.path.isfile(path):
+                    continue
+                seen.add(path)
+                name = os.path.relpath(path, root).replace(os.sep, "/")
+                found.append({"name": name, "node": str(node_id), "kind": kind, "type": item.get("type", "output"),
+                              "size": os.path.getsize(path), "path": path})
+    return found
+
+
+class Parked:
+    """Large outputs waiting for their one-shot download."""
+
+    def __init__(self, retention_s: int = OUTPUT_RETENTION_SECONDS):
+        self.retention_s = retention_s
+        self._lock = threading.Lock()
+        self._items: Dict[str, Tuple[str, Optional[str], float]] = {}  # token -> (path, epk_b64, expires)
+
+    def park(self, path: str, epk_b64: Optional[str]) -> str:
+        token = secrets.token_urlsafe(24)
+        with self._lock:
+            self._items[token] = (path, epk_b64, time.time() + self.retention_s)
+        return token
+
+    def take(self, token: str) -> Optional[Tuple[str, Optional[str]]]:
+        self.sweep()
+        with self._lock:
+            item = self._items.pop(token, None)
+        return (item[0], item[1]) if item else None
+
+    def holds(self, path: str) -> bool:
+        """True while path waits for a download that has not expired (tmpfs sweeps spare it)."""
+        now = time.time()
+        with self._lock:
+            return any(exp > now and os.path.realpath(p) == path for p, _, exp in self._items.values())
+
+    def sweep(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [t for t, (_, _, exp) in self._items.items() if exp <= now]
+            paths = [self._items.pop(t)[0] for t in expired]
+        for p in paths:
+            secure_delete(p)
+        return len(paths)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+PARKED = Parked()
+
+
+def package(files: List[Dict[str, Any]], epk_b64: Optional[str], server_sk_b64: str,
+            inline_max: Optional[int] = None, park: bool = True) -> Dict[str, Any]:
+    """
+    Build the response 'outputs' field and wipe inlined files. Smallest files are inlined
+    first until inline_max; the rest get a download token. With park=False (no /outputs
+    route to fetch them from) all files are wiped and OutputsTooLarge is raised instead.
+    """
+    inline_max = OUTPUT_INLINE_MAX_BYTES if inline_max is None else inline_max
+    total = sum(f["size"] for f in files)
+    if not park and total > inline_max:
+        for f in files:
+            secure_delete(f["path"])
+        raise OutputsTooLarge(f"{len(files)} output files ({total} bytes) exceed OUTPUT_INLINE_MAX_BYTES ({inline_max})")
+    meta, blobs, inline_bytes = [], {}, 0
+    for f in sorted(files, key=lambda f: f["size"]):
+        info = {k: f[k] for k in ("name", "node", "kind", "type", "size")}
+        if inline_bytes + f["size"] <= inline_max:
+            with open(f["path"], "rb") as fh:
+                blobs[f["name"]] = fh.read()
+            inline_bytes += f["size"]
+            secure_delete(f["path"])
+            info["inline"] = True
+        else:
+            info["download"] = f"/outputs/{PARKED.park(f['path'], epk_b64)}"
+        meta.append(info)
+
+    if epk_b64:
+        sealed = crypto_secure.encrypt_to_client(server_sk_b64, epk_b64, pack_payload({"files": meta}, blobs))
+        return {"count": len(meta), "sealed": sealed}
+    for info in meta:
+        if info.get("inline"):
+            info["data_b64"] = base64.b64encode(blobs[info["name"]]).decode()
+    return {"count": len(meta), "files": meta}
+
+
+def stream_parked(path: str, epk_b64: Optional[str], server_sk_b64: str) -> Iterator[bytes]:
+    """Yield the file (secretstream-encrypted when epk_b64 is set), then wipe it."""
+    try:
+        with open(path, "rb") as f:
+            chunks = crypto_secure.iter_chunks(f)
+            if epk_b64:
+                yield from crypto_secure.stream_encryptor_to_client(server_sk_b64, epk_b64).encrypt_iter(chunks)
+            else:
+                yield from chunks
+    finally:
+        secure_delete(path)
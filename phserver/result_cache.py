@@ -0,0 +1,255 @@
+import os, json, time, secrets, hashlib, threading, logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from nacl import secret
+from nacl.hash import blake2b
+from nacl.encoding import RawEncoder
+
+from phserver.input_store import file_sha256
+from shared.payload_codec import pack_payload, unpack_payload
+
+# Result cache for exact-duplicate prompts (retries, resubmitted seeds/params).
+# - Key: SHA-256 over the canonical JSON of the decrypted workflow plus the content hash of
+#   every input file it names and a fingerprint (size, mtime) of every model file it names.
+# - Value: the prompt's history and output files, one payload_codec blob per entry,
+#   encrypted with a SecretBox key derived from the worker private key (random per process
+#   without one), so nothing is readable at rest.
+# - Bounded by RESULT_CACHE_BYTES (LRU, 0 disables) and RESULT_CACHE_TTL_SECONDS.
+# - Workflows with a node whose class_type contains one of RESULT_CACHE_SKIP_NODES are
+#   never cached (their result is not a function of the graph).
+# - Keys are scoped to the caller (see worker_core._tenant) unless RESULT_CACHE_SHARED=1,
+#   which shares entries across callers and then does not report hits to them.
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "/dev/shm/comfy_result_cache")
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", "0"))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "3600"))
+RESULT_CACHE_SHARED = os.getenv("RESULT_CACHE_SHARED", "0").lower() in ("1", "true", "yes")
+RESULT_CACHE_SKIP_NODES = os.getenv("RESULT_CACHE_SKIP_NODES", "Random,URL,Url,HTTP,Http,Webcam")
+MODEL_EXTS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".sft")
+
+log = logging.getLogger("worker")
+
+
+def _skip_nodes() -> List[str]:
+    return [p.strip() for p in RESULT_CACHE_SKIP_NODES.split(",") if p.strip()]
+
+
+def _strings(wf: Dict[str, Any]) -> List[str]:
+    out = []
+    for node in wf.values():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        for v in (inputs if isinstance(inputs, dict) else {}).values():
+            if isinstance(v, str):
+                out.append(v)
+    return out
+
+
+class _HashMemo:
+    """sha256 per (path, inode, size, mtime) so repeated inputs are hashed once."""
+
+    def __init__(self, limit: int = 1024):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._memo: "OrderedDict[tuple, str]" = OrderedDict()
+
+    def sha256(self, path: str) -> str:
+        st = os.stat(path)
+        k = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if k in self._memo:
+                self._memo.move_to_end(k)
+                return self._memo[k]
+        sha = file_sha256(path)
+        with self._lock:
+            self._memo[k] = sha
+            while len(self._memo) > self.limit:
+                self._memo.popitem(last=False)
+        return sha
+
+
+_MEMO = _HashMemo()
+
+
+def _model_fingerprint(model_dir: str, name: str) -> Optional[str]:
+    try:
+        folders = os.listdir(model_dir)
+    except OSError:
+        return None
+    for folder in sorted(folders):
+        path = os.path.join(model_dir, folder, name)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            return f"{folder}/{name}:{st.st_size}:{st.st_mtime_ns}"
+    return None
+
+
+def cache_key(wf: Dict[str, Any], input_dir: str, model_dir: str,
+              digests: Optional[Dict[str, str]] = None) -> Optional[str]:
+    """
+    Key for wf with its inputs already staged, or None when it must not be cached.
+    digests maps real input paths to the sha256 staging computed, which is used instead of
+    re-reading them (a freshly staged file is a new inode, so _MEMO cannot know it).
+    """
+    skip = _skip_nodes()
+    for node in wf.values():
+        ct = str(node.get("class_type", "")) if isinstance(node, dict) else ""
+        if any(s in ct for s in skip):
+            return None
+    deps = {}
+    root = os.path.realpath(input_dir)
+    for value in sorted(set(_strings(wf))):
+        path = os.path.realpath(os.path.join(root, value))
+        if path.startswith(root + os.sep) and os.path.isfile(path):
+            deps[f"input:{value}"] = (digests or {}).get(path) or _MEMO.sha256(path)
+        elif value.lower().endswith(MODEL_EXTS):
+            deps[f"model:{value}"] = _model_fingerprint(model_dir, value)
+    canon = json.dumps({"workflow": wf, "deps": deps}, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+def derive_key(server_sk_b64: str) -> bytes:
+    if not server_sk_b64:
+        return secrets.token_bytes(secret.SecretBox.KEY_SIZE)
+    return blake2b(server_sk_b64.encode(), digest_size=secret.SecretBox.KEY_SIZE,
+                   person=b"result-cache", encoder=RawEncoder)
+
+
+class ResultCache:
+    def __init__(self, root: str = RESULT_CACHE_DIR, budget: int = RESULT_CACHE_BYTES,
+                 ttl_s: int = RESULT_CACHE_TTL_SECONDS, server_sk_b64: str = ""):
+        self.root = root
+        self.budget = budget
+        self.ttl_s = ttl_s
+        self._box = secret.SecretBox(derive_key(server_sk_b64))
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()  # key -> (size, stored_at), LRU order
+        self._bytes = 0
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _load(self):
+        # Caller holds the lock. Entries from a previous process are only readable with the same key.
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and len(entry.name) == 64:
+                st = entry.stat()
+                found.append((st.st_atime, entry.name, st.st_size, st.st_mtime))
+        for _, key, size, mtime in sorted(found):
+            self._entries[key] = (size, mtime)
+            self._bytes += size
+
+    def _drop(self, key: str):
+        # Caller holds the lock.
+        size, _ = self._entries.pop(key, (0, 0))
+        self._bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], Dict[str, bytes]]]:
+        """(meta, blobs) stored under key, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl_s:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                meta, blobs = unpack_payload(self._box.decrypt(f.read()))
+        except Exception as e:
+            log.warning("result cache entry unreadable: %s", type(e).__name__)
+            with self._lock:
+                self._drop(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return meta, {k: bytes(v) for k, v in blobs.items()}
+
+    def put(self, key: str, meta: Dict[str, Any], blobs: Dict[str, bytes]):
+        if not self.enabled:
+            return
+        data = self._box.encrypt(pack_payload(meta, blobs))
+        if len(data) > self.budget:
+            return
+        tmp = f"{self._path(key)}.part"
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                self._drop(key)
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key))
+            except OSError as e:
+                log.error(f"result cache write failed: {e}")
+                return
+            self._entries[key] = (len(data), time.time())
+            self._bytes += len(data)
+            while self._bytes > self.budget and self._entries:
+                self._drop(next(iter(self._entries)))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "budget": self.budget,
+                    "hits": self.hits, "misses": self.misses}
+
+
+def capture(history: Dict[str, Any], prompt_id: str, files: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], Dict[str, bytes]]:
+    """Cache entry for a finished prompt: its history plus the bytes of files (output_stage.collect)."""
+    blobs, listing = {}, []
+    for i, f in enumerate(files):
+        with open(f["path"], "rb") as fh:
+            blobs[str(i)] = fh.read()
+        listing.append({"blob": str(i), "type": f["type"], "name": f["name"]})
+    return {"prompt_id": prompt_id, "history": history, "files": listing}, blobs
+
+
+def restore(meta: Dict[str, Any], blobs: Dict[str, bytes], output_dir: str, temp_dir: str) -> Dict[str, Any]:
+    """
+    Write a cached entry's files back under fresh names (so they cannot clash with files
+    ComfyUI is writing) and return a run result whose history points at them.
+    """
+    tag = secrets.token_hex(4)
+    roots = {"output": output_dir, "temp": temp_dir}
+    renamed = {}
+    for f in meta.get("files") or []:
+        sub, _, base = f["name"].rpartition("/")
+        new_name = f"{sub}/cached_{tag}_{base}" if sub else f"cached_{tag}_{base}"
+        path = os.path.join(roots.get(f["type"], output_dir), new_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            fh.write(blobs[f["blob"]])
+        renamed[(f["type"], f["name"])] = f"cached_{tag}_{base}"
+
+    history = json.loads(json.dumps(meta.get("history") or {}))
+    for entry in history.values():
+        for node_out in ((entry or {}).get("outputs") or {}).values():
+            for items in (node_out or {}).values():
+                for item in (items if isinstance(items, list) else []):
+                    if isinstance(item, dict) and "filename" in item:
+                        name = "/".join(p for p in (item.get("subfolder") or "", item["filename"]) if p)
+                        new = renamed.get((item.get("type", "output"), name))
+                        if new:
+                            item["filename"] = new
+    return {"prompt_id": meta.get("prompt_id"), "history": history, "_cached": True}
@@ -0,0 +1,153 @@
+import os, math, time, asyncio, logging
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+
+# Priority and fair-share admission in front of ComfyUI's FIFO /prompt queue.
+# - At most SCHED_CONCURRENCY prompts are handed to ComfyUI at once (0 = scheduler off).
+# - Waiting jobs are served by priority class first (high > normal > low), then
+#   round-robin across clients within a class, so one client's 200 queued jobs delay
+#   another client by at most one job per turn.
+# - Beyond SCHED_MAX_QUEUE waiting jobs (or SCHED_MAX_PER_CLIENT for one client) new
+#   jobs are refused with QueueFull carrying a Retry-After estimate.
+# - Clients are told apart by client_id only; requests without one share the ANONYMOUS
+#   bucket (the epk is per request, so it would make every job its own client).
+SCHED_CONCURRENCY = int(os.getenv("SCHED_CONCURRENCY", "0"))
+SCHED_MAX_QUEUE = int(os.getenv("SCHED_MAX_QUEUE", "64"))
+SCHED_MAX_PER_CLIENT = int(os.getenv("SCHED_MAX_PER_CLIENT", "16"))
+PRIORITIES = ("high", "normal", "low")
+ANONYMOUS = "anonymous"
+
+log = logging.getLogger("worker")
+
+
+class QueueFull(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def priority_of(value: Any) -> str:
+    value = str(value or "normal").strip().lower()
+    return value if value in PRIORITIES else "normal"
+
+
+def client_of(client_id: Any) -> str:
+    return str(client_id or ANONYMOUS)
+
+
+class Ticket:
+    """A job's place in the scheduler: enqueue() -> await acquire() -> release()."""
+
+    def __init__(self, sched: "Scheduler", client: str, priority: str):
+        self.sched = sched
+        self.client = client
+        self.priority = priority
+        self.enqueued_at = time.time()
+        self.ready = False  # waiting for a slot (inputs staged)
+        self.granted = False
+        self.released = False
+        self.handed_off = False  # an abandoned single-flight leader's run releases it when it ends
+        self.started_at: Optional[float] = None
+        self._future: Optional[asyncio.Future] = None
+
+    async def acquire(self):
+        self._future = asyncio.get_running_loop().create_future()
+        self.ready = True
+        self.sched._dispatch()
+        try:
+            await self._future
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    def release(self):
+        """Give back the slot, or leave the queue if it was never granted. Idempotent."""
+        if not self.released:
+            self.released = True
+            self.sched._done(self)
+
+
+class Scheduler:
+    def __init__(self, concurrency: int = SCHED_CONCURRENCY, max_queue: int = SCHED_MAX_QUEUE,
+                 max_per_client: int = SCHED_MAX_PER_CLIENT):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        # priority -> client -> deque[Ticket]; client order is the round-robin order
+        self._queues: Dict[str, "OrderedDict[str, deque]"] = {p: OrderedDict() for p in PRIORITIES}
+        self.running = 0
+        self.rejected = 0
+        self.avg_job_s = 5.0  # EWMA of slot hold time, for Retry-After
+
+    @property
+    def enabled(self) -> bool:
+        return self.concurrency > 0
+
+    def queued(self, client: Optional[str] = None) -> int:
+        return sum(len(q) for per in self._queues.values() for c, q in per.items() if client is None or c == client)
+
+    def retry_after(self) -> int:
+        waves = (self.queued() + self.running) / max(self.concurrency, 1)
+        return max(1, math.ceil(waves * self.avg_job_s))
+
+    def check(self, client: Optional[str] = None):
+        """Raise QueueFull if a new job (from client, when known) would be refused."""
+        if self.queued() >= self.max_queue:
+            reason = f"scheduler queue full ({self.max_queue} waiting)"
+        elif client is not None and self.queued(client) >= self.max_per_client:
+            reason = f"too many queued jobs for this client ({self.max_per_client})"
+        else:
+            return
+        self.rejected += 1
+        raise QueueFull(reason, self.retry_after())
+
+    def enqueue(self, client: str, priority: str = "normal") -> Ticket:
+        self.check(client)
+        ticket = Ticket(self, client, priority_of(priority))
+        self._queues[ticket.priority].setdefault(client, deque()).append(ticket)
+        return ticket
+
+    def _next(self) -> Optional[Ticket]:
+        for prio in PRIORITIES:
+            per = self._queues[prio]
+            for client in list(per):
+                q = per[client]
+                ticket = next((t for t in q if t.ready), None)
+                if ticket is None:
+                    continue
+                q.remove(ticket)
+                per.move_to_end(client)  # this client goes to the back of the round
+                if not q:
+                    del per[client]
+                return ticket
+        return None
+
+    def _dispatch(self):
+        while self.running < self.concurrency:
+            ticket = self._next()
+            if ticket is None:
+                return
+            ticket.granted = True
+            ticket.started_at = time.time()
+            self.running += 1
+            if ticket._future is not None and not ticket._future.done():
+                ticket._future.set_result(None)
+
+    def _done(self, ticket: Ticket):
+        if ticket.granted:
+            ticket.granted = False
+            self.running -= 1
+            held = time.time() - (ticket.started_at or time.time())
+            self.avg_job_s = 0.8 * self.avg_job_s + 0.2 * held
+        else:
+            q = self._queues[ticket.priority].get(ticket.client)
+            if q is not None and ticket in q:
+                q.remove(ticket)
+                if not q:
+                    del self._queues[ticket.priority][ticket.client]
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"concurrency": self.concurrency, "running": self.running, "rejected": self.rejected,
+                "queued": {p: sum(len(q) for q in self._queues[p].values()) for p in PRIORITIES},
+                "avg_job_s": round(self.avg_job_s, 3)}
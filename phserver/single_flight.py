@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+# Coalesces identical requests that arrive while the first one is still running: the
+# first caller (leader) executes, later callers (followers) wait on its Future and
+# share the result. Usable from threads (future.result()) and from asyncio
+# (asyncio.wrap_future). Keys must already include the tenant scope.
+# A leader that goes away while followers wait abandons the flight instead of cancelling
+# it; the run is cancelled only once nobody waits for it any more.
+
+
+class Flight:
+    def __init__(self):
+        self.future: Future = Future()
+        self.followers = 0
+        self.abandoned = False  # the leader left; the run goes on for its followers
+        self.task = None  # the leader's run, for asyncio callers
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, Flight] = {}
+        self.saved = 0  # executions avoided: followers still waiting when their flight's run succeeded
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """The flight for key and whether the caller leads it (must run, then close it)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def close(self, key: str, flight: Flight) -> int:
+        """Leader succeeded: stop accepting followers; returns how many still wait (they get the result)."""
+        with self._lock:
+            self._drop(key, flight)
+            self.saved += flight.followers
+            return flight.followers
+
+    def abandon(self, key: str, flight: Flight) -> bool:
+        """Leader gave up: True if followers still wait (keep running for them), else the flight is closed."""
+        with self._lock:
+            if flight.followers > 0:
+                flight.abandoned = True
+                return True
+            self._drop(key, flight)
+            return False
+
+    def leave(self, key: str, flight: Flight) -> bool:
+        """Follower gave up: True if it was the last one waiting on an abandoned run (cancel it)."""
+        with self._lock:
+            flight.followers -= 1
+            if flight.abandoned and flight.followers == 0:
+                self._drop(key, flight)
+                return True
+            return False
+
+    def _drop(self, key: str, flight: Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def finish(self, key: str, flight: Flight, result=None, error: Optional[BaseException] = None):
+        if error is not None:
+            with self._lock:
+                self._drop(key, flight)
+        else:
+            self.close(key, flight)
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(result)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
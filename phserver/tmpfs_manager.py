@@ -0,0 +1,210 @@
+import os, time, queue, threading, logging
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from phserver.output_stage import secure_delete
+
+# Keeps the RAM-backed ComfyUI dirs (/dev/shm output, temp, input) from growing until the
+# container is OOM-killed.
+# - Each request holds a Lease on the files it staged or produced; when it finishes, the
+#   files no other running request holds are deleted.
+# - Anything else (crashed jobs, uploads never used, ComfyUI temp files) expires after
+#   TMPFS_TTL_SECONDS.
+# - Above TMPFS_BUDGET_BYTES the oldest unheld files are evicted. Crossing
+#   TMPFS_PRESSURE_RATIO of the budget logs a warning and triggers an immediate sweep.
+# All deletion happens on one background thread, never in the request.
+TMPFS_TTL_SECONDS = int(os.getenv("TMPFS_TTL_SECONDS", "3600"))
+TMPFS_BUDGET_BYTES = int(os.getenv("TMPFS_BUDGET_BYTES", "0"))  # 0 = half of /dev/shm
+TMPFS_PRESSURE_RATIO = float(os.getenv("TMPFS_PRESSURE_RATIO", "0.8"))
+TMPFS_SWEEP_INTERVAL = float(os.getenv("TMPFS_SWEEP_INTERVAL", "30"))
+TMPFS_ROOT = os.getenv("TMPFS_ROOT", "/dev/shm")
+
+log = logging.getLogger("worker")
+
+
+def default_budget(root: str = TMPFS_ROOT) -> int:
+    try:
+        st = os.statvfs(root)
+        return st.f_blocks * st.f_frsize // 2
+    except OSError:
+        return 2 * 1024 * 1024 * 1024
+
+
+def wipe(path: str):
+    """secure_delete, except for hard links (staged inputs share their inode with the input store)."""
+    if os.stat(path).st_nlink > 1:
+        os.unlink(path)
+    else:
+        secure_delete(path)
+
+
+class Lease:
+    """Files one request depends on; released (and deleted if unheld) by TmpfsManager.finish."""
+
+    def __init__(self, manager: "TmpfsManager"):
+        self.manager = manager
+        self.paths: List[str] = []
+
+    def hold(self, paths: Iterable[str]):
+        for p in paths:
+            p = os.path.realpath(p)
+            if p not in self.paths:
+                self.paths.append(p)
+                self.manager._acquire(p)
+
+
+class TmpfsManager:
+    def __init__(self, dirs: Callable[[], List[str]], budget: int = TMPFS_BUDGET_BYTES, ttl_s: int = TMPFS_TTL_SECONDS,
+                 pressure_ratio: float = TMPFS_PRESSURE_RATIO, interval: float = TMPFS_SWEEP_INTERVAL,
+                 delete: Optional[Callable[[str], None]] = None, keep: Optional[Callable[[str], bool]] = None):
+        self.dirs = dirs  # managed directories (re-read each sweep; pool instances add their own)
+        self.budget = budget or default_budget()
+        self.ttl_s = ttl_s
+        self.pressure_ratio = pressure_ratio
+        self.interval = interval
+        self.delete = delete or wipe
+        self.keep = keep or (lambda path: False)  # files owned elsewhere (e.g. parked outputs)
+        self._lock = threading.Lock()
+        self._refs: Dict[str, int] = {}
+        self._queue: "queue.Queue[List[str]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._under_pressure = False
+        self.usage: Dict[str, Any] = {"bytes": 0, "files": 0, "dirs": {}}
+        self.counters = {"deleted": 0, "expired": 0, "evicted": 0, "pressure_alerts": 0, "sweeps": 0}
+
+    # -- request side (cheap, no filesystem work) --------------------------
+
+    def lease(self) -> Lease:
+        return Lease(self)
+
+    def _acquire(self, path: str):
+        with self._lock:
+            self._refs[path] = self._refs.get(path, 0) + 1
+
+    def finish(self, lease: Lease):
+        """Release the lease; its files are deleted on the sweeper thread unless still held."""
+        released = []
+        with self._lock:
+            for p in lease.paths:
+                n = self._refs.get(p, 0) - 1
+                if n <= 0:
+                    self._refs.pop(p, None)
+                    released.append(p)
+                else:
+                    self._refs[p] = n
+        lease.paths = []
+        if released:
+            self.start()
+            self._queue.put(released)
+
+    def held(self, path: str) -> bool:
+        with self._lock:
+            return path in self._refs
+
+    # -- sweeper -----------------------------------------------------------
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="tmpfs-sweeper", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        next_sweep = time.time()
+        while True:
+            try:
+                paths = self._queue.get(timeout=max(0.0, next_sweep - time.time()))
+            except queue.Empty:
+                paths = None
+            try:
+                if paths:
+                    self._delete_released(paths)
+                if paths is None or self._under_pressure:
+                    self.sweep()
+                    next_sweep = time.time() + self.interval
+            except Exception:
+                log.exception("tmpfs sweep failed")
+            finally:
+                if paths is not None:
+                    self._queue.task_done()
+
+    def drain(self, timeout: float = 5.0) -> bool:
+        """Wait until queued deletions are done (tests, shutdown)."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def _remove(self, path: str) -> bool:
+        try:
+            self.delete(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            log.warning("tmpfs delete failed: %s", type(e).__name__)
+            return False
+
+    def _delete_released(self, paths: List[str]):
+        for p in paths:
+            if self.held(p) or self.keep(p):
+                continue  # picked up again by a newer request meanwhile
+            if self._remove(p):
+                self.counters["deleted"] += 1
+
+    def _scan(self) -> List[tuple]:
+        files = []
+        for d in self.dirs():
+            for base, subdirs, names in os.walk(d):
+                for name in names:
+                    path = os.path.join(base, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, path, st.st_size, d))
+        return files
+
+    def _removable(self, path: str) -> bool:
+        rp = os.path.realpath(path)
+        return not self.held(rp) and not self.keep(rp)
+
+    def sweep(self) -> Dict[str, Any]:
+        """Expire files past the TTL, evict oldest unheld files over budget, refresh usage."""
+        now = time.time()
+        files = sorted(self._scan())
+        kept = []
+        for mtime, path, size, d in files:
+            if now - mtime > self.ttl_s and self._removable(path):
+                if self._remove(path):
+                    self.counters["expired"] += 1
+                continue
+            kept.append((mtime, path, size, d))
+        total = sum(f[2] for f in kept)
+        survivors = []
+        for mtime, path, size, d in kept:  # oldest first; uploads still being written (.part) are spared
+            if total > self.budget and not path.endswith(".part") and self._removable(path):
+                if self._remove(path):
+                    self.counters["evicted"] += 1
+                    total -= size
+                    continue
+            survivors.append((path, size, d))
+        by_dir: Dict[str, int] = {}
+        for _, size, d in survivors:
+            by_dir[d] = by_dir.get(d, 0) + size
+        self.usage = {"bytes": total, "files": len(survivors), "dirs": by_dir}
+        self.counters["sweeps"] += 1
+        self._check_pressure(total)
+        return self.stats()
+
+    def _check_pressure(self, total: int):
+        pressured = total >= self.budget * self.pressure_ratio
+        if pressured and not self._under_pressure:
+            self.counters["pressure_alerts"] += 1
+            log.warning("tmpfs usage %d of %d bytes budget (%.0f%%)", total, self.budget, 100 * total / self.budget)
+        self._under_pressure = pressured
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            held = len(self._refs)
+        return {"budget": self.budget, "pressure": self._under_pressure, "held": held, **self.usage, **self.counters}
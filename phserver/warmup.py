@@ -0,0 +1,166 @@
+import os, time, uuid, threading, logging
+from typing import Any, Callable, Dict, List, Optional
+
+from phserver import comfy_client
+
+# Model warm-up after ComfyUI starts, so the first real job does not pay the load
+# from a (network) volume.
+# - PRELOAD_MODELS: comma-separated paths relative to the model dir, e.g.
+#   "checkpoints/sd15.safetensors,loras/ink.safetensors".
+# - Every file is paged into the OS cache (posix_fadvise WILLNEED, or a sequential
+#   read with WARMUP_READ=1 / where fadvise is unavailable).
+# - Checkpoints are then loaded by ComfyUI itself through a 1-step 64x64 prompt, cancelled
+#   and counted as a failed warm-up after WARMUP_TIMEOUT seconds.
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "")
+WARMUP_PROMPT = os.getenv("WARMUP_PROMPT", "1").lower() in ("1", "true", "yes")
+WARMUP_READ = os.getenv("WARMUP_READ", "0").lower() in ("1", "true", "yes")
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "600"))
+_CHUNK = 8 * 1024 * 1024
+
+IDLE = "idle"
+WARMING = "warming"
+READY = "ready"
+
+log = logging.getLogger("worker")
+
+
+def parse_list(value: str) -> List[str]:
+    return [p.strip() for p in (value or "").split(",") if p.strip()]
+
+
+def readahead(path: str, force_read: bool = WARMUP_READ) -> int:
+    """Ask the kernel to cache path; returns bytes read when it had to read the file itself."""
+    with open(path, "rb", buffering=0) as f:
+        if not force_read and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            return 0
+        n = 0
+        buf = bytearray(_CHUNK)
+        while True:
+            got = f.readinto(buf)
+            if not got:
+                return n
+            n += got
+
+
+def checkpoint_prompt(ckpt_name: str) -> Dict[str, Any]:
+    """Smallest graph that makes ComfyUI load a checkpoint's UNet, CLIP and VAE onto the device."""
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["1", 1]}},
+        "3": {"class_type": "EmptyLatentImage", "inputs": {"width": 64, "height": 64, "batch_size": 1}},
+        "4": {"class_type": "KSampler", "inputs": {
+            "model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0], "latent_image": ["3", 0],
+            "seed": 0, "steps": 1, "cfg": 1.0, "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0,
+        }},
+        "5": {"class_type": "VAEDecode", "inputs": {"samples": ["4", 0], "vae": ["1", 2]}},
+        "6": {"class_type": "PreviewImage", "inputs": {"images": ["5", 0]}},
+    }
+
+
+class Warmer:
+    """
+    Tracks warm-up state for /healthz. With nothing to preload the worker is ready as
+    soon as ComfyUI is up; otherwise it turns ready once every listed model has been
+    tried. A model that fails to warm is reported in errors but does not keep the
+    worker out of rotation (it will just load on first use).
+    """
+
+    def __init__(self, model_dir: str, models: Optional[List[str]] = None, run_prompt: bool = WARMUP_PROMPT,
+                 clients: Optional[Callable[[], list]] = None):
+        self.model_dir = model_dir
+        self.clients = clients  # ComfyUI clients to load checkpoints on (every pool instance); default: local one
+        self.models = list(models if models is not None else parse_list(PRELOAD_MODELS))
+        self.run_prompt = run_prompt
+        self.status = IDLE
+        self.timings: Dict[str, int] = {}
+        self.errors: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._loading: Dict[int, threading.Lock] = {}  # per client: one warm-up prompt at a time
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status == READY or (self.status == IDLE and not self.models)
+
+    def _resolve(self, rel: str) -> str:
+        base = os.path.realpath(self.model_dir)
+        full = os.path.realpath(os.path.join(base, rel))
+        if os.path.commonpath([base, full]) != base:
+            raise ValueError("path outside model dir")
+        return full
+
+    def _load(self, client, rel: str, name: str):
+        """Load checkpoint name on client, unless its current process already has it; PromptTimeout past WARMUP_TIMEOUT."""
+        warmed = getattr(client, "warmed", None)  # pool clients; cleared when the process restarts
+        with self._lock:
+            lock = self._loading.setdefault(id(client), threading.Lock())
+        with lock:
+            if warmed is not None and rel in warmed:
+                return
+            res = client.run_workflow_and_wait(checkpoint_prompt(name), f"warmup-{uuid.uuid4()}",
+                                               deadline=time.time() + WARMUP_TIMEOUT)
+            if isinstance(res, dict) and res.get("error"):
+                raise RuntimeError(res["error"])
+            if warmed is not None:
+                warmed.add(rel)
+
+    def warm_client(self, client):
+        """Load the listed checkpoints on one ComfyUI process, e.g. a pool instance that just (re)started."""
+        if not self.run_prompt:
+            return
+        for rel in list(self.models):
+            folder, _, name = rel.replace(os.sep, "/").partition("/")
+            if folder != "checkpoints" or not name:
+                continue
+            try:
+                if os.path.isfile(self._resolve(rel)):
+                    self._load(client, rel, name)
+            except Exception as e:
+                log.warning("warm-up of %s on a restarted instance failed: %s", rel, type(e).__name__)
+
+    def run(self, models: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Warm synchronously (serverless handler, background thread)."""
+        with self._lock:
+            if models is not None:
+                self.models = list(models)
+            self.status = WARMING
+            self.timings, self.errors = {}, {}
+        for rel in self.models:
+            t0 = time.time()
+            try:
+                readahead(self._resolve(rel))
+                folder, _, name = rel.replace(os.sep, "/").partition("/")
+                if self.run_prompt and folder == "checkpoints" and name:
+                    for client in (self.clients() if self.clients else [comfy_client]):
+                        self._load(client, rel, name)
+            except Exception as e:
+                log.warning("warm-up failed for %s: %s", rel, type(e).__name__)
+                self.errors[rel] = f"{type(e).__name__}: {e}"
+            self.timings[rel] = int((time.time() - t0) * 1000)
+        self.status = READY
+        return self.state()
+
+    def start(self, models: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Warm on a background thread; a call while one is running just reports its state."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self.state()
+            if models is not None:
+                self.models = list(models)
+            if not self.models:
+                self.status = READY
+                return self.state()
+            self.status = WARMING
+            self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+            self._thread.start()
+        return self.state()
+
+    def wait(self, timeout: Optional[float] = None):
+        t = self._thread
+        if t is not None:
+            t.join(timeout)
+
+    def state(self) -> Dict[str, Any]:
+        return {"status": self.status, "ready": self.ready, "models": list(self.models),
+                "ms": dict(self.timings), "errors": dict(self.errors)}
@@ -1,9 +1,11 @@
-import os, json, uuid, subprocess, logging
+import os, sys, json, time, base64, uuid, asyncio, hashlib, threading, subprocess, logging
 from shared.env_loader import load_dotenv_if_present
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
-from phserver import comfy_client
-from shared.crypto_secure import decrypt_from_client, load_private_key_b64
+from phserver import batcher, comfy_client, comfy_pool, input_stage, input_store, metrics, output_stage, result_cache, scheduler, single_flight, tmpfs_manager
+from shared import crypto_secure
+from shared.crypto_secure import decrypt_from_client, decrypt_from_client_binary
+from shared.payload_codec import unpack_payload
 
 # --------- Config ---------
 # Load .env (best-effort) without overriding already-set environment
@@ -21,6 +23,10 @@ NO_HISTORY = os.getenv("NO_HISTORY", "0")  # "1" => don't GET /history
 # Require encrypted payloads by default for security. Set to "0" to allow plaintext workflows for testing.
 ENCRYPTION_REQUIRED = os.getenv("ENCRYPTION_REQUIRED", "1").lower() in ("1", "true", "yes")
 DRY_RUN = os.getenv("DRY_RUN", "0").lower() in ("1", "true", "yes")
+# Identical requests (same caller, workflow and inputs) arriving while one runs share its result
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1").lower() in ("1", "true", "yes")
+# Per-job deadline in seconds from arrival (0 = none); a request's timeout_s can only shorten it
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "0"))
 WORKER_PRIVATE_KEY_B64 = os.getenv("WORKER_PRIVATE_KEY_B64", "")
 
 # Logging (quiet by default)
@@ -41,69 +47,262 @@ except Exception:
     pass
 
 WORKSPACE = os.environ.get("COMFY_WORKSPACE", "/opt/ComfyUI")
+OUTPUT_DIR = "/dev/shm/comfy_output"
+TEMP_DIR = "/dev/shm/comfy_temp"
+# COMFY_WATCH_STDOUT=1: read ComfyUI's output (echoed unless LOG_SILENT=1) to time startup
+# phases and to probe readiness the moment COMFY_READY_MARKER is printed.
+COMFY_WATCH_STDOUT = os.environ.get("COMFY_WATCH_STDOUT", "0").lower() in ("1", "true", "yes")
+COMFY_READY_MARKER = os.environ.get("COMFY_READY_MARKER", "Starting server")
+# Startup phases recognised in ComfyUI's output, in order: torch/device init, node imports, HTTP server.
+_STARTUP_MARKERS = (("import", "Total VRAM"), ("nodes", "Import times for custom nodes"), ("server", COMFY_READY_MARKER))
 
 def ensure_dirs():
     os.makedirs(MODEL_DIR, exist_ok=True)
-    os.makedirs("/dev/shm/comfy_output", exist_ok=True)
-    os.makedirs("/dev/shm/comfy_temp", exist_ok=True)
-    os.makedirs("/dev/shm/comfy_input", exist_ok=True)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    os.makedirs(input_stage.INPUT_DIR, exist_ok=True)
 
-def start_comfy():
+# Milliseconds since spawn for each startup phase of the last ComfyUI launch (see /healthz).
+STARTUP_TIMINGS: Dict[str, Any] = {}
+_READY_SIGNAL = threading.Event()
+
+def _watch_output(proc, t0: float, echo: bool, timings: Dict[str, Any], ready: Optional[threading.Event]):
+    """Drain ComfyUI's merged stdout/stderr, recording when each startup marker appears."""
+    pending = [(phase, marker) for phase, marker in _STARTUP_MARKERS if marker]
+    for raw in proc.stdout:
+        line = raw.decode("utf-8", "replace")
+        if echo:
+            sys.stdout.write(line)
+        for i, (phase, marker) in enumerate(pending):
+            if marker in line:
+                # Earlier phases whose line never showed up (e.g. no VRAM line on CPU) are skipped.
+                timings[f"{phase}_ms"] = int((time.time() - t0) * 1000)
+                if phase == "server" and ready is not None:
+                    ready.set()
+                del pending[:i + 1]
+                break
+
+def cpu_mode() -> bool:
+    """True when ComfyUI runs with --cpu: DEVICE_MODE=cpu, or auto with FORCE_CPU=1 / no GPU visible."""
+    # If no GPU is visible in the container, force CPU mode so ComfyUI starts.
+    force_cpu_env = os.getenv("FORCE_CPU", "0")
+    no_gpu_detected = not os.path.exists("/dev/nvidiactl") and not os.getenv("NVIDIA_VISIBLE_DEVICES")
+    return DEVICE_MODE == "cpu" or (DEVICE_MODE == "auto" and (force_cpu_env == "1" or no_gpu_detected))
+
+def start_comfy(port: str = None, output_dir: str = None, temp_dir: str = None,
+                env_extra: Optional[Dict[str, str]] = None, timings: Optional[Dict[str, Any]] = None,
+                ready: Optional[threading.Event] = None, preexec_fn=None):
     """
     Launch ComfyUI in headless mode, bound to localhost, with RAM-only output/temp.
+    Defaults are the single-process port and dirs; the instance pool passes its own.
     """
+    port = str(port or COMFY_PORT)
+    output_dir = output_dir or OUTPUT_DIR
+    temp_dir = temp_dir or TEMP_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(temp_dir, exist_ok=True)
     env = os.environ.copy()
     env["COMFYUI_MODEL_DIR"] = MODEL_DIR
+    env.update(env_extra or {})
 
     cmd = [
         "python3", f"{WORKSPACE}/main.py",
         "--disable-auto-launch",
         "--listen", "127.0.0.1",
-        "--port", COMFY_PORT,
-        "--output-directory", "/dev/shm/comfy_output",
-        "--temp-directory", "/dev/shm/comfy_temp",
-        "--input-directory", "/dev/shm/comfy_input",
+        "--port", port,
+        "--output-directory", output_dir,
+        "--temp-directory", temp_dir,
+        "--input-directory", input_stage.INPUT_DIR,
         "--dont-print-server"
     ]
-    # If no GPU is visible in the container, force CPU mode so ComfyUI starts.
-    force_cpu_env = os.getenv("FORCE_CPU", "0")
-    no_gpu_detected = not os.path.exists("/dev/nvidiactl") and not os.getenv("NVIDIA_VISIBLE_DEVICES")
-    device_force_cpu = (
-        DEVICE_MODE == "cpu" or
-        (DEVICE_MODE == "auto" and (force_cpu_env == "1" or no_gpu_detected))
-    )
-    if device_force_cpu:
+    if cpu_mode():
         # Prevent PyTorch from attempting CUDA init by hiding CUDA devices when in CPU-only mode.
         # This avoids RuntimeError: Found no NVIDIA driver on your system during import.
         env["CUDA_VISIBLE_DEVICES"] = ""
         cmd.append("--cpu")
+    if COMFY_WATCH_STDOUT:
+        # The ready marker is only printed without --dont-print-server; output is drained either way.
+        cmd.remove("--dont-print-server")
+        t0 = time.time()
+        proc = subprocess.Popen(cmd, env=env, cwd=WORKSPACE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=preexec_fn)
+        args = (proc, t0, LOG_SILENT != "1", STARTUP_TIMINGS if timings is None else timings,
+                _READY_SIGNAL if timings is None else ready)
+        threading.Thread(target=_watch_output, args=args, name=f"comfy-stdout-{port}", daemon=True).start()
+        return proc
     if LOG_SILENT == "1":
-        return subprocess.Popen(cmd, env=env, cwd=WORKSPACE,
+        return subprocess.Popen(cmd, env=env, cwd=WORKSPACE, preexec_fn=preexec_fn,
                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     else:
-        return subprocess.Popen(cmd, env=env, cwd=WORKSPACE)
+        return subprocess.Popen(cmd, env=env, cwd=WORKSPACE, preexec_fn=preexec_fn)
 
 COMFY_PROC = None
+POOL: Optional[comfy_pool.ComfyPool] = None
+_POOL_LOCK = threading.Lock()
+
+def _spawn_instance(inst: comfy_pool.Instance):
+    if inst.cpus:
+        return start_comfy(port=inst.port, output_dir=inst.output_dir, temp_dir=inst.temp_dir, timings=inst.timings,
+                           env_extra=comfy_pool.shard_env(inst.cpus), preexec_fn=comfy_pool.pin_to(inst.cpus))
+    return start_comfy(port=inst.port, output_dir=inst.output_dir, temp_dir=inst.temp_dir, timings=inst.timings)
+
+def _cpu_shards() -> int:
+    return comfy_pool.shard_count(len(comfy_pool.available_cpus())) if cpu_mode() else 1
+
+def _start_pool():
+    """
+    Supervise several ComfyUI processes instead of COMFY_PROC: COMFY_INSTANCES/COMFY_STANDBY,
+    or COMFY_CPU_SHARDS in CPU mode (one pinned instance per shard).
+    """
+    global POOL
+    with _POOL_LOCK:
+        if POOL is None:
+            shards = _cpu_shards()
+            if shards > 1:
+                POOL = comfy_pool.ComfyPool(_spawn_instance, int(COMFY_PORT), OUTPUT_DIR, TEMP_DIR,
+                                            active=max(shards, comfy_pool.COMFY_INSTANCES),
+                                            startup_timeout=COMFY_STARTUP_TIMEOUT,
+                                            cpu_sets=comfy_pool.cpu_sets(shards, comfy_pool.available_cpus()),
+                                            on_ready=_instance_ready)
+            else:
+                POOL = comfy_pool.ComfyPool(_spawn_instance, int(COMFY_PORT), OUTPUT_DIR, TEMP_DIR,
+                                            startup_timeout=COMFY_STARTUP_TIMEOUT, on_ready=_instance_ready)
+        POOL.start()
+
+# Warm-up for pool instances that come up after startup (standbys, restarts after a crash):
+# the API server and the serverless handler point this at their Warmer's warm_client.
+WARM_INSTANCE = None
+
+def _instance_ready(inst: comfy_pool.Instance):
+    if WARM_INSTANCE is not None:
+        WARM_INSTANCE(inst.client)
+
+def comfy_clients() -> list:
+    """Clients for every ComfyUI process that should be warmed (all pool instances, or the default one)."""
+    if POOL is not None:
+        return [i.client for i in POOL.instances if i.state == comfy_pool.READY]
+    return [comfy_client]  # module-level helpers use the default client
+
+def _tmpfs_dirs() -> list:
+    dirs = [OUTPUT_DIR, TEMP_DIR, input_stage.INPUT_DIR]
+    if POOL is not None:
+        for inst in POOL.instances[1:]:
+            dirs += [inst.output_dir, inst.temp_dir]
+    return dirs
+
+# Per-job cleanup of the /dev/shm dirs plus TTL/budget sweeps (see tmpfs_manager)
+TMPFS = tmpfs_manager.TmpfsManager(_tmpfs_dirs, keep=output_stage.PARKED.holds)
+
+# Encrypted-at-rest results of deterministic prompts (RESULT_CACHE_BYTES > 0 enables it)
+RESULTS = result_cache.ResultCache(server_sk_b64=WORKER_PRIVATE_KEY_B64)
+metrics.REGISTRY.gauge("result_cache_lookups", "Result cache lookups by result (hit | miss)",
+                       lambda: {metrics.labels(result=r): RESULTS.stats()[r + "s"] for r in ("hit", "miss")},
+                       kind="counter")
+
+# Priority classes and per-client fair share in front of ComfyUI (SCHED_CONCURRENCY > 0; API server only)
+SCHEDULER = scheduler.Scheduler()
+metrics.REGISTRY.gauge("sched_queued", "Jobs waiting for a ComfyUI slot by priority",
+                       lambda: {metrics.labels(priority=p): n for p, n in SCHEDULER.stats()["queued"].items()})
+metrics.REGISTRY.gauge("sched_running", "Jobs holding a ComfyUI slot", lambda: SCHEDULER.running)
+metrics.REGISTRY.gauge("sched_rejected", "Jobs refused with 429 by the scheduler", lambda: SCHEDULER.rejected, kind="counter")
+
+FLIGHTS = single_flight.SingleFlight()
+metrics.REGISTRY.gauge("single_flight_saved", "Executions saved by joining an identical running request",
+                       lambda: FLIGHTS.saved, kind="counter")
+
+_COMFY_RESTARTS = [0]  # single-process mode; the pool counts per instance
+
+def _comfy_instances() -> list:
+    if POOL is not None:
+        return [(i.index, i.client, i.restarts) for i in POOL.instances]
+    return [(0, comfy_client.default_client(), _COMFY_RESTARTS[0])]
+
+metrics.REGISTRY.gauge("comfy_queue_depth", "Prompts queued in ComfyUI and not started yet",
+                       lambda: {metrics.labels(instance=i): c.waiting for i, c, _ in _comfy_instances()})
+metrics.REGISTRY.gauge("comfy_restarts", "ComfyUI restarts after an exit or failed health checks",
+                       lambda: {metrics.labels(instance=i): n for i, _, n in _comfy_instances()}, kind="counter")
+metrics.REGISTRY.gauge("tmpfs_bytes", "Bytes in the /dev/shm output/temp/input dirs (last sweep)",
+                       lambda: TMPFS.stats()["bytes"])
+metrics.REGISTRY.gauge("tmpfs_budget_bytes", "tmpfs budget before eviction", lambda: TMPFS.budget)
+metrics.REGISTRY.gauge("tmpfs_removed_files", "Files removed from tmpfs by reason",
+                       lambda: {metrics.labels(reason=r): TMPFS.counters[r] for r in ("deleted", "expired", "evicted")},
+                       kind="counter")
+
+# Results carry "_dirs": the (output, temp) dirs of the ComfyUI process that ran the prompt.
+def _run_workflow(wf: Dict[str, Any], client_id: str, deadline: float | None = None):
+    if POOL is None:
+        return dict(comfy_client.run_workflow_and_wait(wf, client_id, deadline=deadline), _dirs=(OUTPUT_DIR, TEMP_DIR))
+    inst = POOL.acquire()
+    try:
+        return dict(inst.client.run_workflow_and_wait(wf, client_id, deadline=deadline),
+                    _dirs=(inst.output_dir, inst.temp_dir))
+    finally:
+        POOL.release(inst)
+
+async def _run_workflow_async(wf: Dict[str, Any], client_id: str, on_event=None, deadline: float | None = None,
+                              scope: str = "", ticket: scheduler.Ticket | None = None):
+    if BATCHER.enabled:
+        return await BATCHER.run(wf, client_id, on_event=on_event, deadline=deadline, scope=scope, ticket=ticket)
+    return await _run_prompt_async(wf, client_id, on_event=on_event, deadline=deadline, ticket=ticket)
+
+async def _run_prompt_async(wf: Dict[str, Any], client_id: str, on_event=None, deadline: float | None = None,
+                            ticket: scheduler.Ticket | None = None):
+    if ticket is not None:
+        try:
+            # only prompts that really go to ComfyUI take a slot
+            await asyncio.wait_for(ticket.acquire(), _remaining(deadline))
+        except asyncio.TimeoutError:
+            raise comfy_client.PromptTimeout(None, "waiting") from None
+    try:
+        if POOL is None:
+            res = await comfy_client.run_workflow_async(wf, client_id, on_event=on_event, deadline=deadline)
+            return dict(res, _dirs=(OUTPUT_DIR, TEMP_DIR))
+        inst = await asyncio.to_thread(POOL.acquire)
+        try:
+            res = await inst.client.run_workflow_async(wf, client_id, on_event=on_event, deadline=deadline)
+            return dict(res, _dirs=(inst.output_dir, inst.temp_dir))
+        finally:
+            POOL.release(inst)
+    finally:
+        if ticket is not None:
+            ticket.release()  # free the slot before output encryption
+
+# Merges compatible small text2img jobs into one prompt (BATCH_WINDOW_MS > 0; API server only)
+BATCHER = batcher.MicroBatcher(_run_prompt_async)
+metrics.REGISTRY.gauge("batched_jobs", "Jobs run as part of a merged micro-batch prompt",
+                       lambda: BATCHER.batched_jobs, kind="counter")
 
 def init_comfy():
     global COMFY_PROC
     ensure_dirs()
+    TMPFS.start()
     # Warn if encryption is required but no private key is present
     if ENCRYPTION_REQUIRED and not WORKER_PRIVATE_KEY_B64:
         log.warning("WORKER_PRIVATE_KEY_B64 is missing while ENCRYPTION_REQUIRED=1; encrypted requests will fail")
+    if comfy_pool.enabled() or _cpu_shards() > 1:
+        _start_pool()
+        return
     if COMFY_PROC is None or (COMFY_PROC.poll() is not None):
+        if COMFY_PROC is not None:
+            _COMFY_RESTARTS[0] += 1
         try:
+            STARTUP_TIMINGS.clear()
+            _READY_SIGNAL.clear()
+            t0 = time.time()
             COMFY_PROC = start_comfy()
-            if not comfy_client.wait_for_server(timeout=COMFY_STARTUP_TIMEOUT):
-                # Check process status
+            STARTUP_TIMINGS["spawn_ms"] = int((time.time() - t0) * 1000)
+            up = comfy_client.wait_for_server(timeout=COMFY_STARTUP_TIMEOUT, proc=COMFY_PROC, ready=_READY_SIGNAL)
+            elapsed = time.time() - t0
+            if not up:
+                # wait_for_server returns early when the process dies: report that instead of a timeout
                 if COMFY_PROC.poll() is not None:
-                    log.error(f"ComfyUI process exited with code: {COMFY_PROC.returncode}")
+                    STARTUP_TIMINGS["exit_code"] = COMFY_PROC.returncode
+                    raise RuntimeError(f"ComfyUI exited with code {COMFY_PROC.returncode} after {elapsed:.1f}s")
                 raise RuntimeError(f"ComfyUI server failed to start within {COMFY_STARTUP_TIMEOUT}s")
+            STARTUP_TIMINGS["ready_ms"] = int(elapsed * 1000)
+            log.info("ComfyUI ready: %s", STARTUP_TIMINGS)
         except Exception as e:
             log.error(f"ComfyUI initialization failed: {e}")
-            # Try to get more details if process exists
-            if COMFY_PROC and COMFY_PROC.poll() is not None:
-                log.error(f"ComfyUI exit code: {COMFY_PROC.returncode}")
             raise
 
 def server_public_key_b64() -> str:
@@ -111,22 +310,53 @@ def server_public_key_b64() -> str:
     if not WORKER_PRIVATE_KEY_B64:
         return ""
     try:
-        sk = load_private_key_b64(WORKER_PRIVATE_KEY_B64)
-        return __import__("base64").b64encode(bytes(sk.public_key)).decode()
+        return crypto_secure.server_public_key_b64(WORKER_PRIVATE_KEY_B64)
     except Exception:
         return ""
 
+# Request fields a sealed {workflow, ...} payload may carry next to its workflow.
+_SEALED_FIELDS = ("input_images", "client_id", "no_history", "return_outputs", "cache", "priority", "timeout_s",
+                  "tenant_key")
+
+def _unwrap_sealed(payload: Dict[str, Any], obj: Any) -> Any:
+    """
+    Decrypted content is either a bare workflow mapping or an envelope such as
+    {"workflow": {...}, "input_images": {...}}; lift the envelope's request fields
+    into payload and return the workflow.
+    """
+    if isinstance(obj, dict) and isinstance(obj.get("workflow"), dict) and "class_type" not in obj["workflow"]:
+        for k in _SEALED_FIELDS:
+            if k in obj:
+                payload[k] = obj[k]
+        return obj["workflow"]
+    return obj
+
 def _decrypt_if_needed(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
     If payload contains encrypted content, decrypt and return a workflow dict.
     Expected fields in payload:
       encrypted: true
       epk, nonce, ciphertext: base64 strings
+      or binary: raw epk|nonce|ciphertext buffer (see shared.payload_codec), whose
+      blobs end up in payload['input_blobs']
     Otherwise return payload['workflow'] as-is.
     """
     if payload.get("encrypted"):
         if not WORKER_PRIVATE_KEY_B64:
             raise RuntimeError("Worker private key not set (WORKER_PRIVATE_KEY_B64)")
+        payload.pop("tenant_key", None)  # only ever taken from inside the envelope
+
+        if payload.get("binary") is not None:
+            try:
+                buf = payload.pop("binary")
+                payload["epk"] = base64.b64encode(bytes(buf[:32])).decode()  # replies are sealed to it
+                pt = decrypt_from_client_binary(WORKER_PRIVATE_KEY_B64, buf)
+                meta, blobs = unpack_payload(pt)
+            except Exception:
+                log.error("Decrypt failed")
+                return {"__error": "invalid ciphertext"}
+            payload["input_blobs"] = blobs
+            return _unwrap_sealed(payload, meta)
 
         epk = payload.get("epk", "")
         nonce = payload.get("nonce", "")
@@ -136,14 +366,45 @@ def _decrypt_if_needed(payload: Dict[str, Any]) -> Dict[str, Any]:
 
         try:
             pt = decrypt_from_client(WORKER_PRIVATE_KEY_B64, epk, nonce, ciphertext)
-            return json.loads(pt.decode("utf-8"))
+            return _unwrap_sealed(payload, json.loads(pt.decode("utf-8")))
         except Exception:
             log.error("Decrypt failed")
             return {"__error": "invalid ciphertext"}
     else:
         return payload.get("workflow", {})
 
-def _handle_input_images(data: Dict[str, Any]) -> None:
+async def stage_input_stream(filename: str, pieces) -> int:
+    """Chunked encrypted upload of one input file; see input_stage.stage_input_stream."""
+    if not WORKER_PRIVATE_KEY_B64:
+        raise RuntimeError("Worker private key not set (WORKER_PRIVATE_KEY_B64)")
+    return await input_stage.stage_input_stream(
+        filename, pieces, WORKER_PRIVATE_KEY_B64,
+        scope_for=lambda epk: _tenant({"encrypted": True, "epk": base64.b64encode(epk).decode()}))
+
+def probe_inputs(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Which input hashes the caller's scope of the input store holds. An encrypted probe
+    seals {"hashes": [...]} like a run and gets the answer sealed to its epk; a plaintext
+    one (ENCRYPTION_REQUIRED=0) names its client_id.
+    """
+    if not data.get("encrypted"):
+        if ENCRYPTION_REQUIRED:
+            return {"error": "encryption_required: set ENCRYPTION_REQUIRED=0 to allow plaintext for testing"}
+        return input_store.STORE.probe(data.get("hashes") or [], _tenant(data))
+    if not WORKER_PRIVATE_KEY_B64:
+        raise RuntimeError("Worker private key not set (WORKER_PRIVATE_KEY_B64)")
+    try:
+        sealed = json.loads(decrypt_from_client(WORKER_PRIVATE_KEY_B64, data.get("epk") or "",
+                                                data.get("nonce") or "", data.get("ciphertext") or ""))
+        hashes = list(sealed.get("hashes") or [])
+        data["tenant_key"] = sealed.get("tenant_key")
+    except Exception:
+        log.error("Decrypt failed")
+        return {"error": "invalid ciphertext"}
+    found = input_store.STORE.probe(hashes, _tenant(data))
+    return crypto_secure.encrypt_to_client(WORKER_PRIVATE_KEY_B64, data["epk"], json.dumps(found).encode("utf-8"))
+
+def _handle_input_images(data: Dict[str, Any]) -> list:
     """
     Handle input_images in the payload by saving them to /dev/shm/comfy_input/
     Expected format:
@@ -153,40 +414,283 @@ def _handle_input_images(data: Dict[str, Any]) -> None:
         "another.jpg": "https://example.com/image.jpg"
       }
     }
+    Raw files from a binary request (payload['input_blobs']) are written as-is.
+    Returns per-file timing stats (see input_stage.stage_inputs).
     """
-    input_images = data.get("input_images", {})
-    if not input_images:
+    return input_stage.stage_inputs(data, _tenant(data))
+
+def _check_workflow(wf: Any) -> Dict[str, Any] | None:
+    """Return an error response for an unusable workflow, or None if it can be queued."""
+    # Basic validation and friendly guidance if the wrong JSON shape was sent
+    if not isinstance(wf, dict):
+        return {"error": "Missing or invalid workflow: expected an API prompt mapping (id->node)"}
+    if "__error" in wf:
+        return {"error": wf.get("__error", "Invalid encrypted payload")}
+    return None
+
+def _check_graph_export(wf: Dict[str, Any]) -> Dict[str, Any] | None:
+    # Detect ComfyUI graph-editor export (nodes/links) and guide the user
+    if any(k in wf for k in ("nodes", "links", "last_node_id")):
+        return {
+            "error": "Invalid workflow format: received a graph export (nodes/links). Send an API-ready prompt mapping instead.",
+            "hint": "Use a client that converts ComfyUI graph JSON to the /prompt API format (id->node mapping with class_type/inputs)."
+        }
+    return None
+
+def _wants_no_history(data: Dict[str, Any]) -> bool:
+    # Allow per-request override of history behavior
+    no_history_req = str(data.get("no_history", "")).strip()
+    return (NO_HISTORY == "1") or (no_history_req == "1" or no_history_req.lower() == "true")
+
+def _wants_outputs(data: Dict[str, Any]) -> bool:
+    return str(data.get("return_outputs", "")).strip().lower() in ("1", "true")
+
+def _collect_outputs(res: Dict[str, Any], data: Dict[str, Any], park: bool = True) -> Dict[str, Any]:
+    """
+    Package the prompt's output files for the response (sealed to epk for encrypted requests).
+    park=False for the serverless handler, which has no /outputs/{token} route.
+    """
+    output_dir, temp_dir = res.get("_dirs") or (OUTPUT_DIR, TEMP_DIR)
+    files = output_stage.collect(res.get("history") or {}, res.get("prompt_id"), output_dir, temp_dir)
+    epk = data.get("epk") if data.get("encrypted") else None
+    return output_stage.package(files, epk, WORKER_PRIVATE_KEY_B64, park=park)
+
+def _tenant(data: Dict[str, Any]) -> str:
+    """
+    Caller a cached or shared result may be handed to. For encrypted requests this is the
+    tenant_key sealed in the envelope (a secret only the client and this worker see), else the
+    epk: the payload only decrypts if the sender holds its secret key. client_id is self-asserted,
+    so it only scopes plaintext requests (ENCRYPTION_REQUIRED=0, where callers are trusted anyway).
+    """
+    if data.get("encrypted"):
+        if data.get("tenant_key"):
+            return "key:" + hashlib.sha256(str(data["tenant_key"]).encode("utf-8")).hexdigest()
+        return f"epk:{data.get('epk') or ''}"
+    return f"client:{data.get('client_id') or ''}"
+
+def _scoped(key: str | None, tenant: str) -> str | None:
+    return None if key is None else hashlib.sha256(f"{tenant}\0{key}".encode("utf-8")).hexdigest()
+
+def _cache_key(wf: Dict[str, Any], data: Dict[str, Any]) -> str | None:
+    if not RESULTS.enabled or str(data.get("cache", "")).strip().lower() in ("0", "false"):
+        return None
+    key = result_cache.cache_key(wf, input_stage.INPUT_DIR, MODEL_DIR, data.get("_input_digests"))
+    return key if result_cache.RESULT_CACHE_SHARED else _scoped(key, _tenant(data))
+
+def _cache_store(key: str, res: Dict[str, Any]):
+    entry = (res.get("history") or {}).get(res.get("prompt_id")) or {}
+    if not entry or (entry.get("status") or {}).get("status_str", "success") != "success":
+        return  # failed or unknown outcome: let the next identical request run it
+    try:
+        output_dir, temp_dir = res.get("_dirs") or (OUTPUT_DIR, TEMP_DIR)
+        files = output_stage.collect(res["history"], res["prompt_id"], output_dir, temp_dir)
+        RESULTS.put(key, *result_cache.capture(res["history"], res["prompt_id"], files))
+    except Exception as e:
+        log.warning("result cache store failed: %s", type(e).__name__)
+
+def _cache_restore(hit) -> Dict[str, Any]:
+    res = dict(result_cache.restore(*hit, OUTPUT_DIR, TEMP_DIR), _dirs=(OUTPUT_DIR, TEMP_DIR))
+    if result_cache.RESULT_CACHE_SHARED:
+        res.pop("_cached", None)  # a hit would tell this caller that another one ran the same job
+    return res
+
+def _remaining(deadline: float | None) -> float | None:
+    return None if deadline is None else max(0.0, deadline - time.time())
+
+def _run_cached(wf: Dict[str, Any], data: Dict[str, Any], client_id: str, deadline: float | None = None) -> Dict[str, Any]:
+    key = _cache_key(wf, data)
+    hit = RESULTS.get(key) if key else None
+    if hit:
+        return _cache_restore(hit)
+    res = _run_workflow(wf, client_id, deadline)
+    if key:
+        _cache_store(key, res)
+    return res
+
+async def _run_cached_async(wf: Dict[str, Any], data: Dict[str, Any], client_id: str, on_event=None,
+                            ticket: scheduler.Ticket | None = None, deadline: float | None = None) -> Dict[str, Any]:
+    key = await asyncio.to_thread(_cache_key, wf, data)
+    hit = await asyncio.to_thread(RESULTS.get, key) if key else None
+    if hit:
+        return await asyncio.to_thread(_cache_restore, hit)
+    res = await _run_workflow_async(wf, client_id, on_event=on_event, deadline=deadline, scope=_tenant(data),
+                                    ticket=ticket)
+    if key:
+        await asyncio.to_thread(_cache_store, key, res)
+    return res
+
+def _flight_key(wf: Dict[str, Any], data: Dict[str, Any]) -> str | None:
+    if not SINGLE_FLIGHT:
+        return None
+    # Scoped to the caller (see _tenant) so one tenant never receives another tenant's run
+    return _scoped(result_cache.cache_key(wf, input_stage.INPUT_DIR, MODEL_DIR, data.get("_input_digests")),
+                   _tenant(data))
+
+def _share(res: Dict[str, Any]):
+    """Copy of the leader's history and output files, since its own files are packaged and wiped."""
+    output_dir, temp_dir = res.get("_dirs") or (OUTPUT_DIR, TEMP_DIR)
+    files = output_stage.collect(res.get("history") or {}, res.get("prompt_id"), output_dir, temp_dir)
+    return result_cache.capture(res.get("history") or {}, res.get("prompt_id"), files)
+
+def _from_shared(shared) -> Dict[str, Any]:
+    res = _cache_restore(shared)
+    res.pop("_cached", None)
+    res["_shared"] = True
+    return res
+
+def _lead(key: str, flight: single_flight.Flight, res: Dict[str, Any] | None, error: BaseException | None):
+    if isinstance(error, comfy_client.PromptTimeout):
+        FLIGHTS.finish(key, flight, error=error)  # followers report the same structured timeout
         return
+    if error is not None:
+        FLIGHTS.finish(key, flight, error=RuntimeError(f"shared execution failed: {type(error).__name__}"))
+        return
+    try:
+        shared = _share(res) if FLIGHTS.close(key, flight) else None
+    except Exception as e:
+        FLIGHTS.finish(key, flight, error=e)
+        return
+    flight.future.set_result(shared)
 
-    import base64
-    import requests
-    from urllib.parse import urlparse
+def _run_single(wf: Dict[str, Any], data: Dict[str, Any], client_id: str, deadline: float | None = None) -> Dict[str, Any]:
+    key = _flight_key(wf, data)
+    if key is None:
+        return _run_cached(wf, data, client_id, deadline)
+    flight, leader = FLIGHTS.join(key)
+    if not leader:
+        try:
+            return _from_shared(flight.future.result(_remaining(deadline)))
+        except comfy_client.PromptTimeout:
+            raise  # the leader's own timeout
+        except TimeoutError:
+            raise comfy_client.PromptTimeout(None, "running") from None
+    try:
+        res = _run_cached(wf, data, client_id, deadline)
+    except BaseException as e:
+        _lead(key, flight, None, e)
+        raise
+    _lead(key, flight, res, None)
+    return res
 
-    for filename, image_data in input_images.items():
+async def _run_single_async(wf: Dict[str, Any], data: Dict[str, Any], client_id: str, on_event=None,
+                            ticket: scheduler.Ticket | None = None, deadline: float | None = None) -> Dict[str, Any]:
+    key = await asyncio.to_thread(_flight_key, wf, data)
+    if key is None:
+        return await _run_cached_async(wf, data, client_id, on_event=on_event, ticket=ticket, deadline=deadline)
+    flight, leader = FLIGHTS.join(key)
+    if not leader:
+        # shield: a follower that times out or is cancelled must not cancel the leader's future
         try:
-            if isinstance(image_data, str):
-                if image_data.startswith("data:"):
-                    # Base64 encoded image
-                    header, encoded = image_data.split(',', 1)
-                    decoded = base64.b64decode(encoded)
-                    with open(f"/dev/shm/comfy_input/{filename}", "wb") as f:
-                        f.write(decoded)
-                    log.info(f"Saved base64 image: {filename}")
-                elif image_data.startswith("http"):
-                    # URL reference - download it
-                    response = requests.get(image_data, timeout=30)
-                    response.raise_for_status()
-                    with open(f"/dev/shm/comfy_input/{filename}", "wb") as f:
-                        f.write(response.content)
-                    log.info(f"Downloaded image: {filename}")
-        except Exception as e:
-            log.error(f"Failed to process image {filename}: {e}")
+            shared = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight.future)), _remaining(deadline))
+        except comfy_client.PromptTimeout:
+            raise
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if FLIGHTS.leave(key, flight) and flight.task is not None:
+                flight.task.cancel()  # the last one waiting on a run its leader left
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise comfy_client.PromptTimeout(None, "running") from None
+        return await asyncio.to_thread(_from_shared, shared)
+    flight.task = asyncio.ensure_future(
+        _lead_async(key, flight, wf, data, client_id, on_event=on_event, ticket=ticket, deadline=deadline))
+    try:
+        # shield: a cancelled leader must not cancel the prompt its followers are waiting for
+        return await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        if not flight.task.done():
+            if FLIGHTS.abandon(key, flight):
+                flight.task.add_done_callback(_drop_abandoned)
+                if ticket is not None:
+                    # the prompt goes on: its slot is freed when the run ends, not with this request
+                    ticket.handed_off = True
+                    flight.task.add_done_callback(lambda _task: ticket.release())
+            else:
+                flight.task.cancel()  # nobody else waits: cancel the prompt in ComfyUI
+        raise
+
+async def _lead_async(key: str, flight: single_flight.Flight, wf: Dict[str, Any], data: Dict[str, Any],
+                      client_id: str, on_event=None, ticket: scheduler.Ticket | None = None,
+                      deadline: float | None = None) -> Dict[str, Any]:
+    try:
+        res = await _run_cached_async(wf, data, client_id, on_event=on_event, ticket=ticket, deadline=deadline)
+    except BaseException as e:
+        _lead(key, flight, None, e)
+        raise
+    await asyncio.to_thread(_lead, key, flight, res, None)
+    return res
+
+def _drop_abandoned(task: asyncio.Task):
+    """Done callback of a run that outlived its leader: wipe the outputs its followers took copies of."""
+    if task.cancelled() or task.exception() is not None:
+        return
+    lease = TMPFS.lease()
+    lease.hold(_job_outputs(task.result()))
+    TMPFS.finish(lease)
+
+def _deadline(data: Dict[str, Any], t0: float) -> float | None:
+    """Absolute deadline of a job that arrived at t0: the shorter of its timeout_s and JOB_TIMEOUT_SECONDS."""
+    try:
+        requested = float(data.get("timeout_s") or 0)
+    except (TypeError, ValueError):
+        requested = 0
+    limits = [x for x in (requested, JOB_TIMEOUT_SECONDS) if x > 0]
+    return t0 + min(limits) if limits else None
+
+def _timeout_error(e: comfy_client.PromptTimeout, t0: float, deadline: float) -> Dict[str, Any]:
+    log.warning("job timed out while %s (prompt %s)", e.stage, e.prompt_id)
+    return {"error": f"timeout: {e}", "timeout": {"stage": e.stage, "prompt_id": e.prompt_id,
+                                                   "limit_s": round(deadline - t0, 3),
+                                                   "elapsed_s": round(time.time() - t0, 3)}}
+
+def _job_inputs(data: Dict[str, Any]) -> list:
+    """INPUT_DIR paths the request stages (call before staging: it pops input_blobs)."""
+    paths = []
+    for name in list(data.get("input_blobs") or {}) + list(data.get("input_images") or {}):
+        try:
+            paths.append(input_stage.input_path(name))
+        except ValueError:
+            pass  # rejected again (and reported) by staging
+    return paths
+
+def _job_outputs(res: Dict[str, Any]) -> list:
+    output_dir, temp_dir = res.get("_dirs") or (OUTPUT_DIR, TEMP_DIR)
+    return [f["path"] for f in output_stage.collect(res.get("history") or {}, res.get("prompt_id"), output_dir, temp_dir)]
+
+def _result(res: Dict[str, Any], no_history: bool, inputs: list | None = None,
+            outputs: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    if no_history:
+        # Return only bare minimum
+        out = {"status": "ok", "prompt_id": res.get("prompt_id")}
+    else:
+        # Minimal history return; caller decides how to handle artifacts
+        out = {"status": "ok", "prompt_id": res.get("prompt_id"), "history": res.get("history")}
+    if res.get("_cached"):
+        out["cached"] = True  # served from the result cache, ComfyUI did not run
+    if res.get("_shared"):
+        out["shared"] = True  # joined an identical request that was already running
+    if inputs:
+        out["inputs"] = inputs  # per-file staging stats (source, ok, bytes, ms)
+    if outputs is not None:
+        out["outputs"] = outputs
+    return out
 
 def handle_request(data: Dict[str, Any]) -> Dict[str, Any]:
     """
     Accepts a dict with either an encrypted payload or a plain 'workflow' mapping.
     Starts ComfyUI if needed, queues the workflow, waits, and returns minimal metadata.
+    The job's staged inputs and outputs are removed from tmpfs once it completes.
     """
+    lease = TMPFS.lease()
+    with metrics.request() as m:
+        try:
+            out = _handle_request(data, lease)
+        finally:
+            TMPFS.finish(lease)
+        m["ok"] = not out.get("error")
+        return out
+
+def _handle_request(data: Dict[str, Any], lease: tmpfs_manager.Lease) -> Dict[str, Any]:
+    t0 = time.time()
     init_comfy()
 
     # DRY-RUN short circuit for Hub tests / smoke checks
@@ -197,40 +701,130 @@ def handle_request(data: Dict[str, Any]) -> Dict[str, Any]:
     if ENCRYPTION_REQUIRED and not data.get("encrypted"):
         return {"error": "encryption_required: set ENCRYPTION_REQUIRED=0 to allow plaintext for testing"}
 
-    wf = _decrypt_if_needed(data)
-    # Basic validation and friendly guidance if the wrong JSON shape was sent
-    if not isinstance(wf, dict):
-        return {"error": "Missing or invalid workflow: expected an API prompt mapping (id->node)"}
-    if "__error" in wf:
-        return {"error": wf.get("__error", "Invalid encrypted payload")}
+    with metrics.stage("decrypt"):
+        wf = _decrypt_if_needed(data)
+    err = _check_workflow(wf)
+    if err:
+        return err
 
     # Handle input images before workflow execution
+    lease.hold(_job_inputs(data))
     try:
-        _handle_input_images(data)
+        with metrics.stage("input_staging"):
+            inputs = _handle_input_images(data)
     except Exception as e:
         log.error(f"Image handling failed: {e}")
         return {"error": f"image_processing_failed: {e}"}
-    # Detect ComfyUI graph-editor export (nodes/links) and guide the user
-    if any(k in wf for k in ("nodes", "links", "last_node_id")):
-        return {
-            "error": "Invalid workflow format: received a graph export (nodes/links). Send an API-ready prompt mapping instead.",
-            "hint": "Use a client that converts ComfyUI graph JSON to the /prompt API format (id->node mapping with class_type/inputs)."
-        }
+    err = _check_graph_export(wf)
+    if err:
+        return err
 
     client_id = data.get("client_id") or f"rp-{uuid.uuid4()}"
-    # Allow per-request override of history behavior
-    no_history_req = str(data.get("no_history", "")).strip()
-    no_history = (NO_HISTORY == "1") or (no_history_req == "1" or no_history_req.lower() == "true")
+    no_history = _wants_no_history(data)
 
+    deadline = _deadline(data, t0)
     try:
-        res = comfy_client.run_workflow_and_wait(wf, client_id)
+        res = _run_single(wf, data, client_id, deadline)
+    except comfy_client.PromptTimeout as e:
+        return _timeout_error(e, t0, deadline)
     except Exception as e:
         log.exception("workflow execution failed")
         return {"error": f"execution_failed: {type(e).__name__}: {str(e)}"}
+    metrics.observe_stages(res.get("_timings"))
+    lease.hold(_job_outputs(res))
 
-    if no_history:
-        # Return only bare minimum
-        return {"status": "ok", "prompt_id": res.get("prompt_id")}
+    outputs = None
+    if _wants_outputs(data):
+        try:
+            with metrics.stage("output_encrypt"):
+                outputs = _collect_outputs(res, data, park=False)
+        except output_stage.OutputsTooLarge as e:
+            return {"error": f"outputs_too_large: {e}; raise OUTPUT_INLINE_MAX_BYTES or use the Pod API",
+                    "prompt_id": res.get("prompt_id")}
+        except Exception as e:
+            log.error(f"Output collection failed: {e}")
+            return {"error": f"output_collection_failed: {type(e).__name__}", "prompt_id": res.get("prompt_id")}
+
+    return _result(res, no_history, inputs, outputs)
+
+async def handle_request_async(data: Dict[str, Any], on_event=None) -> Dict[str, Any]:
+    """
+    Same contract as handle_request, for the asyncio API server. CPU-bound and blocking
+    stages (init check, decrypt, input staging) run in the default executor; the wait
+    for ComfyUI completes on the event loop, so many jobs can be in flight at once
+    without each one pinning a thread. on_event receives raw ComfyUI events for the prompt.
+    """
+    lease = TMPFS.lease()
+    with metrics.request() as m:
+        try:
+            out = await _handle_request_async(data, lease, on_event)
+        finally:
+            TMPFS.finish(lease)
+        m["ok"] = not out.get("error")
+        return out
+
+async def _handle_request_async(data: Dict[str, Any], lease: tmpfs_manager.Lease, on_event=None) -> Dict[str, Any]:
+    t0 = time.time()
+    await asyncio.to_thread(init_comfy)
+
+    if DRY_RUN:
+        return {"status": "ok", "prompt_id": "dry-run"}
+
+    if ENCRYPTION_REQUIRED and not data.get("encrypted"):
+        return {"error": "encryption_required: set ENCRYPTION_REQUIRED=0 to allow plaintext for testing"}
+
+    with metrics.stage("decrypt"):
+        wf = await asyncio.to_thread(_decrypt_if_needed, data)
+    err = _check_workflow(wf)
+    if err:
+        return err
+
+    ticket = None
+    if SCHEDULER.enabled:
+        try:
+            ticket = SCHEDULER.enqueue(scheduler.client_of(data.get("client_id")), data.get("priority"))
+        except scheduler.QueueFull as e:
+            return {"error": f"queue_full: {e}", "retry_after": e.retry_after}
+    try:
+        return await _handle_admitted_async(wf, data, lease, on_event, ticket, t0)
+    finally:
+        if ticket is not None and not ticket.handed_off:
+            ticket.release()
+
+async def _handle_admitted_async(wf: Dict[str, Any], data: Dict[str, Any], lease: tmpfs_manager.Lease,
+                                 on_event, ticket: scheduler.Ticket | None, t0: float) -> Dict[str, Any]:
+    lease.hold(_job_inputs(data))
+    try:
+        with metrics.stage("input_staging"):
+            inputs = await asyncio.to_thread(_handle_input_images, data)
+    except Exception as e:
+        log.error(f"Image handling failed: {e}")
+        return {"error": f"image_processing_failed: {e}"}
+    err = _check_graph_export(wf)
+    if err:
+        return err
+
+    client_id = data.get("client_id") or f"rp-{uuid.uuid4()}"
+    no_history = _wants_no_history(data)
+
+    deadline = _deadline(data, t0)
+    try:
+        res = await _run_single_async(wf, data, client_id, on_event=on_event, ticket=ticket, deadline=deadline)
+    except comfy_client.PromptTimeout as e:
+        return _timeout_error(e, t0, deadline)
+    except Exception as e:
+        log.exception("workflow execution failed")
+        return {"error": f"execution_failed: {type(e).__name__}: {str(e)}"}
+    metrics.observe_stages(res.get("_timings"))
+    lease.hold(await asyncio.to_thread(_job_outputs, res))
+
+    outputs = None
+    if _wants_outputs(data):
+        try:
+            with metrics.stage("output_encrypt"):
+                outputs = await asyncio.to_thread(_collect_outputs, res, data)
+        except Exception as e:
+            log.error(f"Output collection failed: {e}")
+            return {"error": f"output_collection_failed: {type(e).__name__}", "prompt_id": res.get("prompt_id")}
 
-    # Minimal history return; caller decides how to handle artifacts
-    return {"status": "ok", "prompt_id": res.get("prompt_id"), "history": res.get("history")}
+    return _result(res, no_history, inputs, outputs)
@@ -1,8 +1,13 @@
 # crypto_secure.py
-import base64, json
+import base64, json, os, threading
+from collections import OrderedDict
 from typing import Tuple
 from nacl.public import PrivateKey, PublicKey, Box
+from nacl.secret import SecretBox
+from nacl.hash import blake2b
+from nacl.encoding import RawEncoder
 from nacl.utils import random as nacl_random
+from nacl import bindings as _ss
 
 # --- Key utilities ---
 
@@ -18,6 +23,67 @@ def load_private_key_b64(sk_b64: str) -> PrivateKey:
 def load_public_key_b64(pk_b64: str) -> PublicKey:
     return PublicKey(base64.b64decode(pk_b64))
 
+# --- Server key + precomputed Box cache ---
+# The server key is parsed once; Box(server_sk, client_epk) does the Curve25519 scalar
+# multiplication in its constructor, so boxes are kept in an LRU keyed by the client epk.
+# Seeing a different server key (rotation) drops everything derived from the old one.
+BOX_CACHE_SIZE = int(os.getenv("BOX_CACHE_SIZE", "1024"))
+
+_KEY_LOCK = threading.Lock()
+_SERVER_SK_B64 = None
+_SERVER_SK = None
+_BOX_CACHE = OrderedDict()  # client epk bytes -> Box
+
+def clear_key_cache():
+    """Forget the parsed server key and all precomputed boxes (call on key rotation)."""
+    global _SERVER_SK_B64, _SERVER_SK
+    with _KEY_LOCK:
+        _SERVER_SK_B64 = None
+        _SERVER_SK = None
+        _BOX_CACHE.clear()
+
+def server_private_key(server_sk_b64: str) -> PrivateKey:
+    """Parsed server key, cached; a different key clears the box cache."""
+    global _SERVER_SK_B64, _SERVER_SK
+    with _KEY_LOCK:
+        if _SERVER_SK_B64 == server_sk_b64 and _SERVER_SK is not None:
+            return _SERVER_SK
+    sk = load_private_key_b64(server_sk_b64)
+    with _KEY_LOCK:
+        if _SERVER_SK_B64 != server_sk_b64:
+            _BOX_CACHE.clear()
+        _SERVER_SK_B64, _SERVER_SK = server_sk_b64, sk
+    return sk
+
+def server_public_key_b64(server_sk_b64: str) -> str:
+    return base64.b64encode(bytes(server_private_key(server_sk_b64).public_key)).decode()
+
+def server_box(server_sk_b64: str, client_epk: bytes) -> Box:
+    """Box(server_sk, client_epk) with the shared key precomputed, from the LRU when possible."""
+    sk = server_private_key(server_sk_b64)
+    with _KEY_LOCK:
+        box = _BOX_CACHE.get(client_epk)
+        if box is not None:
+            _BOX_CACHE.move_to_end(client_epk)
+            return box
+    box = Box(sk, PublicKey(client_epk))
+    with _KEY_LOCK:
+        if _SERVER_SK is sk and BOX_CACHE_SIZE > 0:
+            _BOX_CACHE[client_epk] = box
+            while len(_BOX_CACHE) > BOX_CACHE_SIZE:
+                _BOX_CACHE.popitem(last=False)
+    return box
+
+# --- Direction keys ---
+# Requests are sealed with the raw Box shared key; replies and streams use a subkey per
+# direction, so nothing the server sends to a client opens as an upload or a request
+# (and the other way round), even though both sides share one Curve25519 secret.
+_C2S = b"comfy-c2s"
+_S2C = b"comfy-s2c"
+
+def direction_key(shared_key: bytes, direction: bytes) -> bytes:
+    return blake2b(shared_key, digest_size=SecretBox.KEY_SIZE, person=direction, encoder=RawEncoder)
+
 # --- Encrypt / Decrypt ---
 
 def encrypt_for_server(server_pk_b64: str, plaintext_bytes: bytes) -> dict:
@@ -45,12 +111,188 @@ def decrypt_from_client(server_sk_b64: str, epk_b64: str, nonce_b64: str, cipher
     """
     Server-side: use server private key + client epk to decrypt.
     """
-    server_sk = load_private_key_b64(server_sk_b64)
-    client_epk = load_public_key_b64(epk_b64)
     nonce = base64.b64decode(nonce_b64)
     ciphertext = base64.b64decode(ciphertext_b64)
 
-    box = Box(server_sk, client_epk)
+    box = server_box(server_sk_b64, base64.b64decode(epk_b64))
     # Box wants full message = ciphertext only (nonce passed separately)
     return box.decrypt(ciphertext, nonce)
 
+# --- Binary envelope: epk(32) | nonce(24) | ciphertext, no base64/JSON wrapping ---
+
+BINARY_HEADER_SIZE = PublicKey.SIZE + Box.NONCE_SIZE
+
+def encrypt_for_server_binary(server_pk_b64: str, plaintext_bytes: bytes) -> bytes:
+    """Client-side: like encrypt_for_server, returned as one raw buffer (epk | nonce | ciphertext)."""
+    return encrypt_for_server_binary_session(server_pk_b64, plaintext_bytes)[0]
+
+def encrypt_for_server_binary_session(server_pk_b64: str, plaintext_bytes: bytes) -> Tuple[bytes, str]:
+    """encrypt_for_server_binary plus the ephemeral private key (base64) for decrypting replies."""
+    server_pk = load_public_key_b64(server_pk_b64)
+    eph_sk = PrivateKey.generate()
+    nonce = nacl_random(Box.NONCE_SIZE)
+    ct = Box(eph_sk, server_pk).encrypt(plaintext_bytes, nonce)
+    return bytes(eph_sk.public_key) + ct, base64.b64encode(bytes(eph_sk)).decode()  # ct is nonce | ciphertext
+
+def decrypt_from_client_binary(server_sk_b64: str, buf) -> bytes:
+    """Server-side: decrypt an epk | nonce | ciphertext buffer (bytes or memoryview) as received."""
+    mv = memoryview(buf)
+    if len(mv) <= BINARY_HEADER_SIZE:
+        raise ValueError("binary envelope too short")
+    box = server_box(server_sk_b64, bytes(mv[:PublicKey.SIZE]))
+    return box.decrypt(bytes(mv[BINARY_HEADER_SIZE:]), bytes(mv[PublicKey.SIZE:BINARY_HEADER_SIZE]))
+
+# --- Server -> client replies (encrypted to the request's ephemeral key) ---
+
+def encrypt_for_server_session(server_pk_b64: str, plaintext_bytes: bytes) -> Tuple[dict, str]:
+    """
+    Like encrypt_for_server, but also returns the ephemeral private key (base64) so the
+    client can decrypt replies the server encrypts to this request's epk.
+    """
+    server_pk = load_public_key_b64(server_pk_b64)
+    eph_sk = PrivateKey.generate()
+    box = Box(eph_sk, server_pk)
+    nonce = nacl_random(Box.NONCE_SIZE)
+    ct = box.encrypt(plaintext_bytes, nonce)
+    payload = {
+        "epk": base64.b64encode(bytes(eph_sk.public_key)).decode(),
+        "nonce": base64.b64encode(nonce).decode(),
+        "ciphertext": base64.b64encode(ct.ciphertext).decode(),
+    }
+    return payload, base64.b64encode(bytes(eph_sk)).decode()
+
+def encrypt_to_client(server_sk_b64: str, client_epk_b64: str, plaintext_bytes: bytes) -> dict:
+    """
+    Server-side: encrypt a reply to the client's ephemeral public key.
+    Returns dict: {nonce, ciphertext} as base64 strings.
+    """
+    shared = server_box(server_sk_b64, base64.b64decode(client_epk_b64)).shared_key()
+    nonce = nacl_random(SecretBox.NONCE_SIZE)
+    ct = SecretBox(direction_key(shared, _S2C)).encrypt(plaintext_bytes, nonce)
+    return {
+        "nonce": base64.b64encode(nonce).decode(),
+        "ciphertext": base64.b64encode(ct.ciphertext).decode(),
+    }
+
+def decrypt_from_server(client_sk_b64: str, server_pk_b64: str, nonce_b64: str, ciphertext_b64: str) -> bytes:
+    """
+    Client-side: decrypt a reply produced by encrypt_to_client using the ephemeral private key.
+    """
+    shared = Box(load_private_key_b64(client_sk_b64), load_public_key_b64(server_pk_b64)).shared_key()
+    return SecretBox(direction_key(shared, _S2C)).decrypt(base64.b64decode(ciphertext_b64), base64.b64decode(nonce_b64))
+
+# --- Chunked streaming encryption (libsodium secretstream, XChaCha20-Poly1305) ---
+# Stream: MAGIC(4) | epk(32) | secretstream header(24) | frames
+# frame:  u32 BE length | secretstream ciphertext of one chunk (chunk + 17 bytes)
+# The key is the Box shared key between the two parties, reduced to the direction key of
+# the stream (uploads c2s, results s2c); epk identifies the client's ephemeral key (the
+# sender's for uploads, the recipient's for server replies).
+# Each chunk gets its own nonce from the secretstream state, so chunks cannot be
+# reordered, dropped or replayed; the last one carries TAG_FINAL and a stream that
+# ends without it is rejected as truncated. Memory use is one chunk, not the payload.
+
+STREAM_MAGIC = b"CSS1"
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_MAX_FRAME = 64 * 1024 * 1024
+_STREAM_PREFIX = len(STREAM_MAGIC) + PublicKey.SIZE
+_SS_HEADER = _ss.crypto_secretstream_xchacha20poly1305_HEADERBYTES
+_TAG_MESSAGE = _ss.crypto_secretstream_xchacha20poly1305_TAG_MESSAGE
+_TAG_FINAL = _ss.crypto_secretstream_xchacha20poly1305_TAG_FINAL
+
+class StreamEncryptor:
+    def __init__(self, key: bytes, epk: bytes):
+        self._state = _ss.crypto_secretstream_xchacha20poly1305_state()
+        self.header = STREAM_MAGIC + epk + _ss.crypto_secretstream_xchacha20poly1305_init_push(self._state, key)
+
+    def push(self, chunk: bytes, final: bool = False) -> bytes:
+        tag = _TAG_FINAL if final else _TAG_MESSAGE
+        ct = _ss.crypto_secretstream_xchacha20poly1305_push(self._state, bytes(chunk), tag=tag)
+        return len(ct).to_bytes(4, "big") + ct
+
+    def encrypt_iter(self, chunks):
+        """Yield header then one frame per chunk; the last chunk is sealed as final."""
+        yield self.header
+        prev = None
+        for chunk in chunks:
+            if prev is not None:
+                yield self.push(prev)
+            prev = chunk
+        yield self.push(prev if prev is not None else b"", final=True)
+
+class StreamDecryptor:
+    """
+    Incremental decryptor: feed() arbitrary network-sized pieces, get back plaintext
+    chunks as soon as their frame is complete. close() raises if the final frame never came.
+    """
+
+    def __init__(self, key_for_epk):
+        self._key_for_epk = key_for_epk  # callable(epk bytes) -> 32-byte stream key
+        self._buf = bytearray()
+        self._state = None
+        self.epk = None
+        self.finished = False
+
+    def feed(self, data: bytes) -> list:
+        self._buf += data
+        out = []
+        if self._state is None:
+            if len(self._buf) < _STREAM_PREFIX + _SS_HEADER:
+                return out
+            if bytes(self._buf[:len(STREAM_MAGIC)]) != STREAM_MAGIC:
+                raise ValueError("bad stream magic")
+            self.epk = bytes(self._buf[len(STREAM_MAGIC):_STREAM_PREFIX])
+            self._state = _ss.crypto_secretstream_xchacha20poly1305_state()
+            _ss.crypto_secretstream_xchacha20poly1305_init_pull(
+                self._state, bytes(self._buf[_STREAM_PREFIX:_STREAM_PREFIX + _SS_HEADER]), self._key_for_epk(self.epk))
+            del self._buf[:_STREAM_PREFIX + _SS_HEADER]
+        while len(self._buf) >= 4:
+            n = int.from_bytes(self._buf[:4], "big")
+            if n > STREAM_MAX_FRAME:
+                raise ValueError("stream frame too large")
+            if len(self._buf) < 4 + n:
+                break
+            if self.finished:
+                raise ValueError("data after final stream frame")
+            pt, tag = _ss.crypto_secretstream_xchacha20poly1305_pull(self._state, bytes(self._buf[4:4 + n]))
+            del self._buf[:4 + n]
+            if tag == _TAG_FINAL:
+                self.finished = True
+            out.append(pt)
+        return out
+
+    def close(self):
+        if not self.finished or self._buf:
+            raise ValueError("truncated or trailing stream data")
+
+    def decrypt_iter(self, pieces):
+        for piece in pieces:
+            yield from self.feed(piece)
+        self.close()
+
+def stream_encryptor_for_server(server_pk_b64: str) -> StreamEncryptor:
+    """Client-side: stream to the server under a fresh ephemeral key."""
+    eph_sk = PrivateKey.generate()
+    key = Box(eph_sk, load_public_key_b64(server_pk_b64)).shared_key()
+    return StreamEncryptor(direction_key(key, _C2S), bytes(eph_sk.public_key))
+
+def stream_decryptor_from_client(server_sk_b64: str) -> StreamDecryptor:
+    """Server-side: open a client upload stream (epk read from the stream header)."""
+    return StreamDecryptor(lambda epk: direction_key(server_box(server_sk_b64, epk).shared_key(), _C2S))
+
+def stream_encryptor_to_client(server_sk_b64: str, client_epk_b64: str) -> StreamEncryptor:
+    """Server-side: stream a result to the client's ephemeral key."""
+    epk = base64.b64decode(client_epk_b64)
+    return StreamEncryptor(direction_key(server_box(server_sk_b64, epk).shared_key(), _S2C), epk)
+
+def stream_decryptor_from_server(client_sk_b64: str, server_pk_b64: str) -> StreamDecryptor:
+    """Client-side: open a result stream with the ephemeral private key used for the request."""
+    key = Box(load_private_key_b64(client_sk_b64), load_public_key_b64(server_pk_b64)).shared_key()
+    key = direction_key(key, _S2C)
+    return StreamDecryptor(lambda epk: key)
+
+def iter_chunks(fileobj, chunk_size: int = STREAM_CHUNK_SIZE):
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,37 @@
+# payload_codec.py
+import json, struct
+from typing import Dict, Tuple
+
+# Binary request plaintext (sealed with crypto_secure.encrypt_for_server_binary):
+#   MAGIC(4) | header_len(u32 BE) | header JSON | blob bytes back to back
+# header JSON = request fields (workflow, client_id, ...) + "blobs": [[filename, size], ...]
+# Input files travel as raw bytes, so there is no base64 inflation and no JSON parse of media.
+MAGIC = b"CEP1"
+_HDR = struct.Struct(">4sI")
+
+def pack_payload(meta: dict, blobs: Dict[str, bytes] | None = None) -> bytes:
+    blobs = blobs or {}
+    header = dict(meta)
+    header["blobs"] = [[name, len(data)] for name, data in blobs.items()]
+    hj = json.dumps(header).encode("utf-8")
+    return b"".join([_HDR.pack(MAGIC, len(hj)), hj, *blobs.values()])
+
+def unpack_payload(buf) -> Tuple[dict, Dict[str, memoryview]]:
+    """Inverse of pack_payload; blobs are zero-copy memoryviews into buf."""
+    mv = memoryview(buf)
+    if len(mv) < _HDR.size:
+        raise ValueError("payload too short")
+    magic, hlen = _HDR.unpack_from(mv, 0)
+    if magic != MAGIC:
+        raise ValueError("bad payload magic")
+    off = _HDR.size + hlen
+    if off > len(mv):
+        raise ValueError("truncated payload header")
+    meta = json.loads(bytes(mv[_HDR.size:off]).decode("utf-8"))
+    blobs = {}
+    for name, size in meta.pop("blobs", []):
+        if off + size > len(mv):
+            raise ValueError("truncated payload blob")
+        blobs[str(name)] = mv[off:off + size]
+        off += size
+    return meta, blobs
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Throughput of CPU sharding: K stub ComfyUI instances, each pinned to a disjoint slice of
+the cores with OMP_NUM_THREADS to match (comfy_pool.cpu_sets / shard_env / pin_to), fed
+least-loaded first by ComfyPool. Use it to pick COMFY_CPU_SHARDS for a machine size.
+
+Each stub job mimics a CPU diffusion step loop: a Python-level part that holds the GIL
+(graph bookkeeping, sampler glue) followed by an "operator" part spread over
+OMP_NUM_THREADS threads (hashlib releases the GIL, like torch kernels).
+
+    python tests/bench_cpu_shards.py [--jobs 48] [--shards 1,2,4] [--py-ms 20] [--op-mb 64]
+"""
+import argparse
+import pathlib
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import comfy_pool
+
+STUB = r'''
+import os, sys, time, hashlib, threading, http.server
+THREADS = int(os.environ.get("OMP_NUM_THREADS", "1"))
+PY_MS, OP_MB = float(sys.argv[2]), int(sys.argv[3])
+BLOCK = os.urandom(1024 * 1024)
+
+def _op(mb):
+    h = hashlib.sha256()
+    for _ in range(mb):
+        h.update(BLOCK)
+
+def job():
+    for _ in range(4):  # a few "steps"
+        t0 = time.perf_counter()
+        x = 0
+        while (time.perf_counter() - t0) * 1000 < PY_MS / 4:
+            x += 1
+        per = max(1, OP_MB // 4 // THREADS)
+        ts = [threading.Thread(target=_op, args=(per,)) for _ in range(THREADS)]
+        [t.start() for t in ts]
+        [t.join() for t in ts]
+
+class H(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/prompt":
+            job()
+        self.send_response(200); self.send_header("Content-Length", "2"); self.end_headers(); self.wfile.write(b"{}")
+    def log_message(self, *a): pass
+
+http.server.ThreadingHTTPServer(("127.0.0.1", int(sys.argv[1])), H).serve_forever()
+'''
+
+
+def _base_port(n):
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port if port + n < 65535 else _base_port(n)
+
+
+def run(k, cpus, jobs, py_ms, op_mb, script):
+    sets = comfy_pool.cpu_sets(k, cpus)
+
+    def spawn(inst):
+        env = dict(__import__("os").environ, **comfy_pool.shard_env(inst.cpus))
+        return subprocess.Popen([sys.executable, script, str(inst.port), str(py_ms), str(op_mb)],
+                                env=env, preexec_fn=comfy_pool.pin_to(inst.cpus))
+
+    pool = comfy_pool.ComfyPool(spawn, _base_port(k), "/tmp/bench_out", "/tmp/bench_tmp",
+                                active=len(sets), standby=0, startup_timeout=30, cpu_sets=sets)
+    pool.start()
+    while any(i.state != comfy_pool.READY for i in pool.instances):
+        time.sleep(0.05)
+    sessions = threading.local()
+
+    def worker(n):
+        s = getattr(sessions, "s", None) or requests.Session()
+        sessions.s = s
+        for _ in range(n):
+            inst = pool.acquire()
+            try:
+                s.get(f"http://127.0.0.1:{inst.port}/prompt", timeout=600)
+            finally:
+                pool.release(inst)
+
+    clients = 2 * len(sets)  # keep every shard busy with one job queued behind it
+    per = [jobs // clients + (1 if i < jobs % clients else 0) for i in range(clients)]
+    t0 = time.perf_counter()
+    ts = [threading.Thread(target=worker, args=(n,)) for n in per]
+    [t.start() for t in ts]
+    [t.join() for t in ts]
+    dt = time.perf_counter() - t0
+    pool.stop()
+    return dt
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--jobs", type=int, default=48)
+    ap.add_argument("--shards", default="", help="comma-separated K values (default: 1,2,4,... up to #cores)")
+    ap.add_argument("--py-ms", type=float, default=20, help="GIL-bound Python work per job (ms)")
+    ap.add_argument("--op-mb", type=int, default=64, help="multi-threaded operator work per job (MiB hashed)")
+    args = ap.parse_args()
+
+    cpus = comfy_pool.available_cpus()
+    ks = [int(k) for k in args.shards.split(",") if k] or [k for k in (1, 2, 4, 8, 16, 32, 64) if k <= len(cpus)]
+    script = "/tmp/bench_cpu_shards_stub.py"
+    pathlib.Path(script).write_text(STUB)
+
+    print(f"cores={len(cpus)} jobs={args.jobs} py_ms={args.py_ms} op_mb={args.op_mb}")
+    print(f"{'K':>3} {'cores/shard':>11} {'seconds':>8} {'jobs/s':>8}")
+    base = None
+    for k in ks:
+        dt = run(k, cpus, args.jobs, args.py_ms, args.op_mb, script)
+        rate = args.jobs / dt
+        base = base or rate
+        print(f"{k:>3} {len(cpus) // k:>11} {dt:>8.2f} {rate:>8.2f}  ({rate / base:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-request overhead of one-shot requests.get/post (old comfy_client
+behaviour) vs the pooled keep-alive ComfyClient, against a local stub ComfyUI server.
+
+    python tests/bench_http_pool.py [--n 2000]
+"""
+import argparse
+import json
+import pathlib
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver.comfy_client import ComfyClient
+
+
+class StubComfy(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive capable, like aiohttp in ComfyUI
+    disable_nagle_algorithm = True  # aiohttp sets TCP_NODELAY too
+
+    def _reply(self, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/history/"):
+            pid = self.path.rsplit("/", 1)[-1]
+            self._reply({pid: {"outputs": {}}})
+        else:
+            self._reply({"system": {}})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        self._reply({"prompt_id": "p", "number": 0})
+
+    def log_message(self, *args):
+        pass
+
+
+def _time(label, fn, n):
+    fn()  # warm
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    dt = time.perf_counter() - t0
+    print(f"{label:<28} {n} calls  {dt * 1e6 / n:8.1f} us/call")
+    return dt / n
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=2000)
+    args = ap.parse_args()
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), StubComfy)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    host, port = srv.server_address
+    base = f"http://{host}:{port}"
+    wf = {"1": {"class_type": "Note", "inputs": {"text": "x"}}}
+
+    print("# GET /history/<id>")
+    old = _time("requests.get (per call)", lambda: requests.get(f"{base}/history/p", timeout=30).json(), args.n)
+    client = ComfyClient(host, port)
+    new = _time("ComfyClient (pooled)", lambda: client.get_history("p"), args.n)
+    print(f"speedup x{old / new:.2f}")
+
+    print("# POST /prompt")
+    old = _time("requests.post (per call)",
+                lambda: requests.post(f"{base}/prompt", json={"prompt": wf, "client_id": "c"}, timeout=30).json(), args.n)
+    new = _time("ComfyClient (pooled)", lambda: client.queue_prompt(wf, "c"), args.n)
+    print(f"speedup x{old / new:.2f}")
+    srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
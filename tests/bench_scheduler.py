@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Simulated load: one tenant dumps a backlog of jobs while another submits interactive jobs
+at a steady rate, against a fake single-GPU ComfyUI (FIFO, one prompt at a time).
+Compares the interactive tenant's latency when every job goes straight to ComfyUI's FIFO
+queue with the same load behind phserver.scheduler (fair share, and fair share + priority).
+
+    python tests/bench_scheduler.py [--bulk 200] [--interactive 20] [--job-ms 20] [--every-ms 100]
+"""
+import argparse
+import asyncio
+import pathlib
+import statistics
+import sys
+import time
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver.scheduler import Scheduler
+
+
+class FakeComfy:
+    """ComfyUI's /prompt queue: strictly FIFO, one prompt executing at a time."""
+
+    def __init__(self, job_s: float):
+        self.job_s = job_s
+        self._lock = asyncio.Lock()  # asyncio.Lock wakes waiters in FIFO order
+
+    async def run(self):
+        async with self._lock:
+            await asyncio.sleep(self.job_s)
+
+
+async def _scenario(args, sched):
+    comfy = FakeComfy(args.job_ms / 1000.0)
+    latencies = []
+
+    async def _job(client, prio, record):
+        t0 = time.perf_counter()
+        if sched is None:
+            await comfy.run()
+        else:
+            ticket = sched.enqueue(client, prio)
+            try:
+                await ticket.acquire()
+                await comfy.run()
+            finally:
+                ticket.release()
+        if record:
+            latencies.append(time.perf_counter() - t0)
+
+    tasks = [asyncio.create_task(_job("bulk", "low" if args.prio else "normal", False)) for _ in range(args.bulk)]
+    for _ in range(args.interactive):
+        await asyncio.sleep(args.every_ms / 1000.0)
+        tasks.append(asyncio.create_task(_job("ui", "high" if args.prio else "normal", True)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def _report(label, lat):
+    lat = sorted(x * 1000 for x in lat)
+    p95 = lat[max(0, int(len(lat) * 0.95) - 1)]
+    print(f"{label:<26} p50 {statistics.median(lat):8.1f} ms   p95 {p95:8.1f} ms   max {lat[-1]:8.1f} ms")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bulk", type=int, default=200, help="backlog submitted at t=0 by the heavy tenant")
+    ap.add_argument("--interactive", type=int, default=20, help="jobs from the interactive tenant")
+    ap.add_argument("--job-ms", type=float, default=20.0, help="fake execution time per prompt")
+    ap.add_argument("--every-ms", type=float, default=100.0, help="interactive submission interval")
+    args = ap.parse_args()
+    big = args.bulk + args.interactive
+
+    print(f"# {args.bulk} bulk jobs + {args.interactive} interactive jobs, {args.job_ms:g} ms each")
+    args.prio = False
+    _report("FIFO (ComfyUI queue)", asyncio.run(_scenario(args, None)))
+    _report("scheduler, fair share", asyncio.run(_scenario(args, Scheduler(1, big, big))))
+    args.prio = True
+    _report("scheduler, high vs low", asyncio.run(_scenario(args, Scheduler(1, big, big))))
+
+
+if __name__ == "__main__":
+    main()
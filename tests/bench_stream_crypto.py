@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Peak-memory benchmark: one-shot Box envelope (encrypt_for_server / decrypt_from_client,
+base64 inside JSON) vs chunked streaming encryption, for a file of --mb megabytes.
+
+    python tests/bench_stream_crypto.py [--mb 128]
+"""
+import argparse
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from shared.crypto_secure import (
+    decrypt_from_client, encrypt_for_server, gen_keypair_b64, iter_chunks,
+    stream_decryptor_from_client, stream_encryptor_for_server,
+)
+
+
+def _measure(label, fn):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    fn()
+    dt = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<34} peak {peak / 2**20:9.1f} MiB   {dt:6.2f} s")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=int, default=128)
+    args = ap.parse_args()
+
+    pk, sk = gen_keypair_b64()
+    with tempfile.TemporaryDirectory() as d:
+        src = pathlib.Path(d) / "input.bin"
+        wire = pathlib.Path(d) / "wire.bin"
+        out = pathlib.Path(d) / "out.bin"
+        with open(src, "wb") as f:
+            for _ in range(args.mb):
+                f.write(os.urandom(1 << 20))
+
+        def oneshot():
+            env = encrypt_for_server(pk, src.read_bytes())
+            body = json.dumps(env)  # what travels today
+            env = json.loads(body)
+            out.write_bytes(decrypt_from_client(sk, env["epk"], env["nonce"], env["ciphertext"]))
+
+        def encrypt_stream():
+            enc = stream_encryptor_for_server(pk)
+            with open(src, "rb") as f, open(wire, "wb") as w:
+                for frame in enc.encrypt_iter(iter_chunks(f)):
+                    w.write(frame)
+
+        def decrypt_stream():
+            dec = stream_decryptor_from_client(sk)
+            with open(wire, "rb") as f, open(out, "wb") as o:
+                for chunk in dec.decrypt_iter(iter_chunks(f, 64 * 1024)):
+                    o.write(chunk)
+
+        print(f"# {args.mb} MiB payload")
+        _measure("one-shot Box (json+base64)", oneshot)
+        _measure("stream encrypt (1 MiB chunks)", encrypt_stream)
+        _measure("stream decrypt (64 KiB reads)", decrypt_stream)
+        assert out.read_bytes() == src.read_bytes()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import importlib
+import pathlib
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    """Factory for a freshly reloaded worker_core/api_server with ComfyUI stubbed out.
+
+    ``worker(JOB_QUEUE_MAX="2")`` sets extra env vars before the reload; the returned
+    namespace has ``core``, ``api`` and ``fake_run(fn)``, which installs fn as the async
+    ComfyUI runner. Module-level config is reloaded from the restored env on teardown.
+    """
+    from phserver import api_server, jobs, scheduler, worker_core
+
+    def _make(**env):
+        env = {"COMFYUI_MODEL_DIR": str(tmp_path / "models"), "ENCRYPTION_REQUIRED": "0", "DRY_RUN": "0", **env}
+        for k, v in env.items():
+            monkeypatch.setenv(k, v)
+        for mod in (scheduler, jobs, worker_core, api_server):
+            importlib.reload(mod)
+        monkeypatch.setattr(api_server, "init_comfy", lambda: None)
+        monkeypatch.setattr(worker_core, "init_comfy", lambda: None)
+
+        def fake_run(fn):
+            monkeypatch.setattr(worker_core.comfy_client, "run_workflow_async", fn)
+            return fn
+
+        return SimpleNamespace(core=worker_core, api=api_server, fake_run=fake_run)
+
+    yield _make
+    monkeypatch.undo()
+    for mod in (scheduler, jobs, worker_core, api_server):
+        importlib.reload(mod)
@@ -0,0 +1,252 @@
+import asyncio
+import hashlib
+import json
+import pathlib
+import sys
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch, worker):
+    w = worker(NO_HISTORY="0")
+    monkeypatch.setattr(w.api.input_store, "STORE", w.api.input_store.InputStore(str(tmp_path / "store")))
+    return w.api, w.core
+
+
+def test_run_waits_on_event_loop_for_concurrent_jobs(api, monkeypatch):
+    api_server, worker_core = api
+    state = {"inflight": 0, "peak": 0}
+
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        state["inflight"] += 1
+        state["peak"] = max(state["peak"], state["inflight"])
+        await asyncio.sleep(0.05)
+        state["inflight"] -= 1
+        return {"prompt_id": f"p-{client_id}", "history": {"ok": True}}
+
+    monkeypatch.setattr(worker_core.comfy_client, "run_workflow_async", _fake_run)
+
+    async def _burst():
+        import httpx
+
+        transport = httpx.ASGITransport(app=api_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            reqs = [
+                client.post("/run", json={"workflow": {"1": {"class_type": "Note", "inputs": {}}}, "client_id": str(i)})
+                for i in range(8)
+            ]
+            return await asyncio.gather(*reqs)
+
+    resps = asyncio.run(_burst())
+
+    assert all(r.status_code == 200 for r in resps)
+    assert resps[0].json() == {"status": "ok", "prompt_id": "p-0", "history": {"ok": True}}
+    assert state["peak"] == 8
+
+
+def test_run_rejects_graph_export(api):
+    api_server, _ = api
+    with TestClient(api_server.app) as client:
+        resp = client.post("/run", json={"workflow": {"nodes": [], "links": []}})
+    assert resp.status_code == 400
+    assert "graph export" in resp.text
+
+
+def test_run_binary_writes_raw_input_blobs(api, monkeypatch, tmp_path):
+    api_server, worker_core = api
+    from shared.crypto_secure import encrypt_for_server_binary, gen_keypair_b64
+    from shared.payload_codec import pack_payload
+
+    pk, sk = gen_keypair_b64()
+    monkeypatch.setattr(worker_core, "WORKER_PRIVATE_KEY_B64", sk)
+    monkeypatch.setattr(worker_core.input_stage, "INPUT_DIR", str(tmp_path / "input"))
+    seen = {}
+
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        seen["wf"] = wf
+        seen["staged"] = (tmp_path / "input" / "ref.png").read_bytes()
+        return {"prompt_id": "p-bin", "history": {}}
+
+    monkeypatch.setattr(worker_core.comfy_client, "run_workflow_async", _fake_run)
+
+    image = bytes(range(256)) * 4
+    wf = {"1": {"class_type": "LoadImage", "inputs": {"image": "ref.png"}}}
+    body = encrypt_for_server_binary(pk, pack_payload({"workflow": wf, "no_history": True}, {"ref.png": image}))
+
+    with TestClient(api_server.app) as client:
+        resp = client.post("/run/binary", content=body, headers={"content-type": "application/octet-stream"})
+        bad = client.post("/run/binary", content=body[:-1], headers={"content-type": "application/octet-stream"})
+        probe = client.post("/inputs/probe", json={"hashes": [hashlib.sha256(image).hexdigest(), "0" * 64]})
+
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["prompt_id"] == "p-bin" and "history" not in body
+    assert body["inputs"] == [{"source": "blob", "ok": True, "bytes": len(image), "ms": body["inputs"][0]["ms"]}]
+    assert seen["wf"] == wf
+    assert seen["staged"] == image
+    assert worker_core.TMPFS.drain()
+    assert not (tmp_path / "input" / "ref.png").exists()  # removed from tmpfs once the job completed
+    assert bad.status_code == 400
+    # staged under the request's epk: another caller cannot learn that the store holds it
+    assert probe.json() == {"present": [], "missing": [hashlib.sha256(image).hexdigest(), "0" * 64]}
+
+
+def test_probe_only_sees_the_callers_inputs(api, monkeypatch, tmp_path):
+    api_server, worker_core = api
+    from shared.crypto_secure import decrypt_from_server, encrypt_for_server_session, gen_keypair_b64
+
+    pk, sk = gen_keypair_b64()
+    monkeypatch.setattr(worker_core, "WORKER_PRIVATE_KEY_B64", sk)
+    monkeypatch.setattr(worker_core.input_stage, "INPUT_DIR", str(tmp_path / "input"))
+    image = b"probe me" * 32
+    sha = hashlib.sha256(image).hexdigest()
+    worker_core._handle_input_images({"client_id": "alice", "input_blobs": {"probe.png": image}})
+    sealed, client_sk = encrypt_for_server_session(pk, json.dumps({"hashes": [sha]}).encode())
+
+    with TestClient(api_server.app) as client:
+        mine = client.post("/inputs/probe", json={"hashes": [sha], "client_id": "alice"})
+        theirs = client.post("/inputs/probe", json={"hashes": [sha], "client_id": "bob"})
+        enc = client.post("/inputs/probe", json={"encrypted": True, **sealed})
+
+    assert mine.json() == {"present": [sha], "missing": []}
+    assert theirs.json() == {"present": [], "missing": [sha]}
+    reply = enc.json()
+    assert json.loads(decrypt_from_server(client_sk, pk, reply["nonce"], reply["ciphertext"])) == {"present": [], "missing": [sha]}
+
+    # a sealed tenant_key carries an encrypted caller's uploads across fresh epks
+    worker_core._handle_input_images({"encrypted": True, "epk": "e1", "tenant_key": "t1", "input_blobs": {"k.png": image}})
+    sealed, client_sk = encrypt_for_server_session(pk, json.dumps({"hashes": [sha], "tenant_key": "t1"}).encode())
+    with TestClient(api_server.app) as client:
+        reply = client.post("/inputs/probe", json={"encrypted": True, **sealed}).json()
+    assert json.loads(decrypt_from_server(client_sk, pk, reply["nonce"], reply["ciphertext"])) == {"present": [sha], "missing": []}
+
+
+def test_binary_body_over_cap_is_refused(api, monkeypatch):
+    api_server, _ = api
+    monkeypatch.setattr(api_server, "BINARY_MAX_BYTES", 64)
+    with TestClient(api_server.app) as client:
+        for path in ("/run/binary", "/jobs/binary"):
+            resp = client.post(path, content=b"x" * 65, headers={"content-type": "application/octet-stream"})
+            assert resp.status_code == 413, path
+
+
+def test_streamed_input_upload_decrypts_to_input_dir(api, monkeypatch, tmp_path):
+    import os
+
+    api_server, worker_core = api
+    from shared.crypto_secure import gen_keypair_b64, stream_encryptor_for_server
+
+    pk, sk = gen_keypair_b64()
+    monkeypatch.setattr(worker_core, "WORKER_PRIVATE_KEY_B64", sk)
+    monkeypatch.setattr(worker_core.input_stage, "INPUT_DIR", str(tmp_path / "input"))
+
+    data = os.urandom(300_000)
+    chunks = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+    body = b"".join(stream_encryptor_for_server(pk).encrypt_iter(chunks))
+
+    with TestClient(api_server.app) as client:
+        ok = client.post("/inputs/stream/clip.mp4", content=body)
+        cut = client.post("/inputs/stream/cut.mp4", content=body[:-10])
+
+    assert ok.status_code == 200 and ok.json()["size"] == len(data)
+    assert (tmp_path / "input" / "clip.mp4").read_bytes() == data
+    assert cut.status_code == 400
+    assert not (tmp_path / "input" / "cut.mp4").exists()
+    assert not [p.name for p in (tmp_path / "input").iterdir() if p.name.endswith(".part")]
+
+
+def test_run_returns_outputs_sealed_to_epk_and_wipes_them(api, monkeypatch, tmp_path):
+    import json
+    import os
+
+    api_server, worker_core = api
+    from shared.crypto_secure import (decrypt_from_server, encrypt_for_server_session, gen_keypair_b64,
+                                      stream_decryptor_from_server)
+    from shared.payload_codec import unpack_payload
+
+    pk, sk = gen_keypair_b64()
+    out_dir, tmp_dir = tmp_path / "out", tmp_path / "tmp"
+    (out_dir / "sub").mkdir(parents=True)
+    tmp_dir.mkdir()
+    monkeypatch.setattr(worker_core, "WORKER_PRIVATE_KEY_B64", sk)
+    monkeypatch.setattr(worker_core, "OUTPUT_DIR", str(out_dir))
+    monkeypatch.setattr(worker_core, "TEMP_DIR", str(tmp_dir))
+    monkeypatch.setattr(worker_core.output_stage, "OUTPUT_INLINE_MAX_BYTES", 1000)
+    small, big = b"png" * 100, os.urandom(3 * 1024 * 1024 + 7)
+
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        (out_dir / "sub" / "img_00001_.png").write_bytes(small)
+        (tmp_dir / "preview.mp4").write_bytes(big)
+        outputs = {"9": {"images": [{"filename": "img_00001_.png", "subfolder": "sub", "type": "output"},
+                                    {"filename": "../../escape", "subfolder": "", "type": "output"}]},
+                   "10": {"gifs": [{"filename": "preview.mp4", "subfolder": "", "type": "temp"}]}}
+        return {"prompt_id": "p-out", "history": {"p-out": {"outputs": outputs}}}
+
+    monkeypatch.setattr(worker_core.comfy_client, "run_workflow_async", _fake_run)
+    wf = {"9": {"class_type": "SaveImage", "inputs": {}}}
+    envelope, eph_sk = encrypt_for_server_session(pk, json.dumps({"workflow": wf, "return_outputs": True}).encode())
+
+    with TestClient(api_server.app) as client:
+        resp = client.post("/run", json={"encrypted": True, **envelope})
+        outputs = resp.json()["outputs"]
+        opened = decrypt_from_server(eph_sk, pk, outputs["sealed"]["nonce"], outputs["sealed"]["ciphertext"])
+        meta, blobs = unpack_payload(opened)
+        parked = next(f for f in meta["files"] if "download" in f)
+        streamed = client.get(parked["download"])
+        again = client.get(parked["download"])
+
+    assert resp.status_code == 200 and outputs["count"] == 2 and "files" not in outputs
+    assert bytes(blobs["sub/img_00001_.png"]) == small
+    assert parked["name"] == "preview.mp4" and parked["type"] == "temp" and parked["size"] == len(big)
+    dec = stream_decryptor_from_server(eph_sk, pk)
+    assert b"".join(dec.decrypt_iter([streamed.content])) == big
+    assert again.status_code == 404
+    assert not (out_dir / "sub" / "img_00001_.png").exists() and not (tmp_dir / "preview.mp4").exists()
+
+
+def test_run_deadline_returns_structured_timeout(api, monkeypatch):
+    api_server, worker_core = api
+
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        await asyncio.sleep(max(0.0, deadline - time.time()))
+        raise worker_core.comfy_client.PromptTimeout("p-slow", "running")
+
+    monkeypatch.setattr(worker_core.comfy_client, "run_workflow_async", _fake_run)
+    monkeypatch.setattr(worker_core, "JOB_TIMEOUT_SECONDS", 30.0)
+    wf = {"1": {"class_type": "Note", "inputs": {}}}
+    with TestClient(api_server.app) as client:
+        resp = client.post("/run", json={"workflow": wf, "timeout_s": 0.2})
+
+    assert resp.status_code == 504
+    detail = resp.json()["detail"]
+    assert detail["error"].startswith("timeout") and detail["timeout"]["prompt_id"] == "p-slow"
+    assert detail["timeout"]["stage"] == "running" and detail["timeout"]["limit_s"] == 0.2
+
+
+def test_serverless_outputs_over_inline_cap_are_refused_and_wiped(api, monkeypatch, tmp_path):
+    api_server, worker_core = api
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    monkeypatch.setattr(worker_core, "OUTPUT_DIR", str(out_dir))
+    monkeypatch.setattr(worker_core.output_stage, "OUTPUT_INLINE_MAX_BYTES", 100)
+
+    def _fake_run(wf, client_id, deadline=None):
+        (out_dir / "big.png").write_bytes(b"x" * 1000)
+        outputs = {"9": {"images": [{"filename": "big.png", "subfolder": "", "type": "output"}]}}
+        return {"prompt_id": "p-big", "history": {"p-big": {"outputs": outputs}}}
+
+    monkeypatch.setattr(worker_core.comfy_client, "run_workflow_and_wait", _fake_run)
+    wf = {"9": {"class_type": "SaveImage", "inputs": {}}}
+    res = worker_core.handle_request({"workflow": wf, "return_outputs": True})
+
+    assert res["error"].startswith("outputs_too_large") and res["prompt_id"] == "p-big"
+    assert not (out_dir / "big.png").exists()
+    assert len(worker_core.output_stage.PARKED) == 0
@@ -0,0 +1,173 @@
+import asyncio
+import copy
+import json
+import pathlib
+import sys
+import time
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import batcher, comfy_client
+
+BASE = json.loads((ROOT_DIR / "examples" / "minimal_text2img.json").read_text())
+
+
+def _job(text, seed, width=512):
+    wf = copy.deepcopy(BASE)
+    wf["3"]["inputs"]["text"] = text
+    wf["5"]["inputs"]["seed"] = seed
+    wf["7"]["inputs"]["width"] = width
+    return wf
+
+
+def test_merge_shares_common_nodes_and_keeps_outputs_apart():
+    merged, (a, b) = batcher.merge([_job("cat", 1), _job("dog", 2)])
+    assert a["6"] == b["6"] and a["7"] == b["7"] and a["4"] == b["4"]  # loaders and latent shared
+    assert a["3"] != b["3"] and a["5"] != b["5"] and a["9"] != b["9"]
+    assert len(merged) == 3 + 2 * 4  # shared loaders/latent + per job: encode, sampler, decode, save
+    assert merged[b["5"]]["inputs"]["positive"] == [b["3"], 0]
+    assert merged[b["5"]]["inputs"]["model"] == [a["6"], 0]
+    assert batcher.signature(_job("x", 1)) != batcher.signature(_job("x", 1, width=768))
+    assert batcher.signature({"1": {"class_type": "Note", "inputs": {}}}) is None
+
+
+def test_compatible_jobs_run_as_one_prompt_and_split_back():
+    calls = []
+
+    async def _runner(wf, client_id, on_event=None, deadline=None, ticket=None):
+        calls.append(wf)
+        await asyncio.sleep(0.01)
+        saves = [nid for nid, n in wf.items() if n["class_type"] == "SaveImage"]
+        if on_event:
+            for nid in saves:
+                on_event({"type": "executed", "data": {"prompt_id": "p", "node": nid}})
+        outputs = {nid: {"images": [{"filename": f"{nid}.png", "subfolder": "", "type": "output"}]} for nid in saves}
+        return {"prompt_id": "p", "history": {"p": {"outputs": outputs}}}
+
+    mb = batcher.MicroBatcher(_runner, window_ms=50, max_jobs=8)
+    seen = {0: [], 1: []}
+
+    async def _go():
+        return await asyncio.gather(
+            mb.run(_job("cat", 1), "c0", on_event=seen[0].append),
+            mb.run(_job("dog", 2), "c1", on_event=seen[1].append),
+            mb.run(_job("big", 3, width=1024), "c2"),
+        )
+
+    r0, r1, r2 = asyncio.run(_go())
+    assert len(calls) == 2 and mb.batches == 1 and mb.batched_jobs == 2
+    assert list(r0["history"]["p"]["outputs"]) == ["9"] and list(r1["history"]["p"]["outputs"]) == ["9"]
+    assert r0["history"]["p"]["outputs"]["9"] != r1["history"]["p"]["outputs"]["9"]
+    assert [e["data"]["node"] for e in seen[0]] == ["9"] and [e["data"]["node"] for e in seen[1]] == ["9"]
+    assert "_batched" not in r2 and list(r2["history"]["p"]["outputs"]) == ["9"]
+
+
+def test_waiters_keep_their_own_deadline_and_cancel_reaches_the_prompt():
+    state = {"started": 0, "cancelled": 0, "deadlines": []}
+
+    async def _runner(wf, client_id, on_event=None, deadline=None, ticket=None):
+        state["started"] += 1
+        state["deadlines"].append(deadline)
+        try:
+            await asyncio.sleep(0.5)
+        except asyncio.CancelledError:
+            state["cancelled"] += 1  # what deletes/interrupts the prompt in ComfyUI
+            raise
+        return {"prompt_id": "p", "history": {}}
+
+    mb = batcher.MicroBatcher(_runner, window_ms=20, max_jobs=8)
+
+    async def _go():
+        loop = asyncio.get_running_loop()
+        # merged with a job that has no deadline, a 0.1 s job still times out on time
+        t0 = loop.time()
+        short = asyncio.create_task(mb.run(_job("cat", 1), "c0", deadline=time.time() + 0.1))
+        patient = asyncio.create_task(mb.run(_job("dog", 2), "c1"))
+        with pytest.raises(comfy_client.PromptTimeout):
+            await short
+        waited = loop.time() - t0
+        assert (await patient)["_batched"]  # the merged prompt ran on for the other job
+
+        # a lone job's cancelled waiter cancels the group run
+        lone = asyncio.create_task(mb.run(_job("owl", 3), "c2"))
+        await asyncio.sleep(0.1)
+        lone.cancel()
+        await asyncio.gather(lone, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        return waited
+
+    waited = asyncio.run(_go())
+    assert waited < 0.3
+    assert state["started"] == 2 and state["cancelled"] == 1 and state["deadlines"] == [None, None]
+
+
+def test_split_keeps_nothing_of_the_other_jobs():
+    a, b = _job("cat", 1), _job("secret dog", 2)
+    merged, maps = batcher.merge([a, b])
+    ids_a, ids_b = maps
+    only_b = {m for m in ids_b.values() if m not in ids_a.values()}
+    res = {"prompt_id": "p", "history": {"p": {
+        "prompt": [0, "p", merged, {"client_id": "mux"}, [ids_a["9"], ids_b["9"]]],
+        "outputs": {ids_a["9"]: {"images": [{"filename": "a.png"}]}, ids_b["9"]: {"images": [{"filename": "b.png"}]}},
+        "meta": {ids_a["9"]: {"node_id": ids_a["9"]}, ids_b["9"]: {"node_id": ids_b["9"]}},
+        "status": {"status_str": "success", "completed": True, "messages": [
+            ["execution_start", {"prompt_id": "p"}],
+            ["execution_cached", {"prompt_id": "p", "nodes": [ids_a["6"], ids_b["3"]]}],
+            ["execution_error", {"prompt_id": "p", "node_id": ids_b["5"], "exception_message": "secret dog"}],
+        ]},
+    }}}
+
+    entry = batcher.split(res, ids_a, a)["history"]["p"]
+
+    assert entry["prompt"] == [0, "p", a, {"client_id": "mux"}, ["9"]]
+    assert entry["outputs"] == {"9": {"images": [{"filename": "a.png"}]}}
+    assert list(entry["meta"]) == ["9"]
+    assert entry["status"]["status_str"] == "success"
+    assert entry["status"]["messages"] == [["execution_start", {"prompt_id": "p"}],
+                                           ["execution_cached", {"prompt_id": "p", "nodes": ["6"]}]]
+    text = json.dumps(entry)
+    assert "secret dog" not in text and "b.png" not in text and not any(f'"{m}"' in text for m in only_b)
+
+
+def test_jobs_from_different_scopes_are_never_merged():
+    calls = []
+
+    async def _runner(wf, client_id, on_event=None, deadline=None, ticket=None):
+        calls.append(wf)
+        return {"prompt_id": "p", "history": {}}
+
+    mb = batcher.MicroBatcher(_runner, window_ms=30, max_jobs=8)
+
+    async def _go():
+        return await asyncio.gather(mb.run(_job("cat", 1), "c", scope="client:a"),
+                                    mb.run(_job("dog", 2), "c", scope="client:b"),
+                                    mb.run(_job("owl", 3), "c", scope="client:a"))
+
+    asyncio.run(_go())
+    assert len(calls) == 2 and mb.batches == 1 and mb.batched_jobs == 2
+
+
+def test_batch_window_holds_no_scheduler_slot(worker, monkeypatch):
+    w = worker(SCHED_CONCURRENCY="1")
+    monkeypatch.setattr(w.core, "BATCHER", batcher.MicroBatcher(w.core._run_prompt_async, window_ms=50, max_jobs=8))
+    prompts = []
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        prompts.append((len(wf), w.core.SCHEDULER.running))
+        await asyncio.sleep(0.05)
+        return {"prompt_id": "p", "history": {}}
+
+    async def _go():
+        reqs = [{"workflow": _job(text, i), "client_id": "a"} for i, text in enumerate(("cat", "dog", "owl"))]
+        return await asyncio.gather(*(w.core.handle_request_async(r) for r in reqs))
+
+    results = asyncio.run(_go())
+    # one slot, yet all three jobs end up in one merged prompt that holds exactly that slot
+    assert prompts == [(3 + 3 * 4, 1)]
+    assert all("error" not in r for r in results)
+    assert w.core.SCHEDULER.running == 0 and w.core.SCHEDULER.queued() == 0
@@ -0,0 +1,214 @@
+import pathlib
+import sys
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import comfy_client
+
+
+def test_mux_replays_events_that_arrive_before_subscribe():
+    mux = comfy_client.EventMux(client_id="test")
+    mux._dispatch({"type": "executing", "data": {"prompt_id": "p1", "node": "3"}})
+    mux._dispatch({"type": "execution_success", "data": {"prompt_id": "p1"}})
+
+    seen = []
+    mux.subscribe("p1", seen.append)
+    mux._dispatch({"type": "status", "data": {}})  # no prompt id: dropped
+
+    assert [e["type"] for e in seen] == ["executing", "execution_success"]
+    assert comfy_client.is_terminal(seen[-1], "p1")
+
+
+def test_mux_routes_by_prompt_id():
+    mux = comfy_client.EventMux(client_id="test")
+    a, b = [], []
+    mux.subscribe("a", a.append)
+    mux.subscribe("b", b.append)
+    mux._dispatch({"type": "executing", "data": {"prompt_id": "b", "node": None}})
+    mux.unsubscribe("a", a.append)
+    mux._dispatch({"type": "progress", "data": {"prompt_id": "a", "value": 1, "max": 2}})
+
+    assert a == []
+    assert len(b) == 1 and comfy_client.is_terminal(b[0], "b")
+    assert "a" in mux._orphans
+
+
+class _DeadProc:
+    returncode = 3
+
+    def poll(self):
+        return self.returncode
+
+
+def test_wait_for_server_gives_up_when_process_exits():
+    import time
+
+    client = comfy_client.ComfyClient(host="127.0.0.1", port=9)  # nothing listens on the discard port
+    t0 = time.time()
+    assert client.wait_for_server(timeout=30, proc=_DeadProc()) is False
+    assert time.time() - t0 < 1
+
+
+def test_init_comfy_times_startup_phases_from_stdout(tmp_path, monkeypatch):
+    import socket
+
+    from phserver import worker_core
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    # Stand-in for ComfyUI's main.py: prints the startup lines, then serves /system_stats.
+    (tmp_path / "main.py").write_text(
+        "import sys, time, http.server\n"
+        "print('Total VRAM 0 MB', flush=True)\n"
+        "print('Import times for custom nodes:', flush=True)\n"
+        "time.sleep(0.2)\n"
+        "print('Starting server', flush=True)\n"
+        "class H(http.server.BaseHTTPRequestHandler):\n"
+        "    def do_GET(self):\n"
+        "        self.send_response(200); self.send_header('Content-Length', '2'); self.end_headers(); self.wfile.write(b'{}')\n"
+        "    def log_message(self, *a): pass\n"
+        "http.server.HTTPServer(('127.0.0.1', int(sys.argv[sys.argv.index('--port') + 1])), H).serve_forever()\n"
+    )
+    monkeypatch.setattr(worker_core, "WORKSPACE", str(tmp_path))
+    monkeypatch.setattr(worker_core, "COMFY_PORT", str(port))
+    monkeypatch.setattr(worker_core, "COMFY_WATCH_STDOUT", True)
+    monkeypatch.setattr(worker_core, "MODEL_DIR", str(tmp_path / "models"))
+    monkeypatch.setattr(worker_core, "ensure_dirs", lambda: None)
+    monkeypatch.setattr(worker_core, "COMFY_PROC", None)
+    monkeypatch.setattr(comfy_client, "_DEFAULT", comfy_client.ComfyClient(host="127.0.0.1", port=port))
+    try:
+        worker_core.init_comfy()
+        t = worker_core.STARTUP_TIMINGS
+        assert {"spawn_ms", "import_ms", "nodes_ms", "server_ms", "ready_ms"} <= set(t)
+        assert t["import_ms"] <= t["nodes_ms"] <= t["server_ms"] <= t["ready_ms"]
+    finally:
+        worker_core.COMFY_PROC.kill()
+        worker_core.COMFY_PROC.wait()
+
+
+class _FakeMux:
+    client_id = "mux"
+
+    def __init__(self, events, connected=True):
+        self.events = events
+        self.connected = connected
+
+    def start(self, timeout: float = 10.0):
+        return self.connected
+
+    def subscribe(self, prompt_id, sink):
+        for evt in self.events:
+            sink(evt)
+
+    def unsubscribe(self, prompt_id, sink):
+        pass
+
+
+def _stub_comfy(prompt_delay=0.0):
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    calls = []
+
+    class _Stub(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+            if self.path == "/prompt":
+                time.sleep(prompt_delay)
+            calls.append((self.path, body))
+            reply = json.dumps({"prompt_id": "p1", "number": 0} if self.path == "/prompt" else {}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Stub)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    client = comfy_client.ComfyClient(*srv.server_address)
+    return srv, client, calls
+
+
+def test_deadline_interrupts_running_prompt():
+    import time
+
+    import pytest
+
+    srv, client, calls = _stub_comfy()
+    client._mux = _FakeMux([{"type": "execution_start", "data": {"prompt_id": "p1"}}])
+    try:
+        with pytest.raises(comfy_client.PromptTimeout) as exc:
+            client.run_workflow_and_wait({}, "c", deadline=time.time() + 0.2)
+    finally:
+        srv.shutdown()
+    assert exc.value.prompt_id == "p1" and exc.value.stage == "running"
+    assert ("/queue", {"delete": ["p1"]}) in calls and ("/interrupt", {"prompt_id": "p1"}) in calls
+
+
+def test_cancelled_wait_deletes_queued_prompt():
+    import asyncio
+
+    srv, client, calls = _stub_comfy()
+    client._mux = _FakeMux([])
+
+    async def _go():
+        task = asyncio.create_task(client.run_workflow_async({}, "c"))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        for _ in range(50):  # the cancel request is sent from the executor
+            if len(calls) > 1:
+                break
+            await asyncio.sleep(0.02)
+
+    try:
+        asyncio.run(_go())
+    finally:
+        srv.shutdown()
+    assert [path for path, _ in calls] == ["/prompt", "/queue"]  # never started: no /interrupt
+
+
+def test_cancel_while_submitting_still_cancels_the_queued_prompt():
+    import asyncio
+
+    srv, client, calls = _stub_comfy(prompt_delay=0.3)
+    client._mux = _FakeMux([])
+
+    async def _go():
+        task = asyncio.create_task(client.run_workflow_async({}, "c"))
+        await asyncio.sleep(0.1)  # /prompt is still in flight
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        for _ in range(50):
+            if len(calls) > 2:
+                break
+            await asyncio.sleep(0.02)
+
+    try:
+        asyncio.run(_go())
+    finally:
+        srv.shutdown()
+    assert calls == [("/prompt", calls[0][1]), ("/queue", {"delete": ["p1"]}), ("/interrupt", {"prompt_id": "p1"})]
+
+
+def test_prompt_is_not_queued_without_an_event_socket():
+    import asyncio
+
+    import pytest
+
+    srv, client, calls = _stub_comfy()
+    client._mux = _FakeMux([], connected=False)
+    try:
+        with pytest.raises(RuntimeError, match="event socket"):
+            asyncio.run(client.run_workflow_async({}, "c"))
+    finally:
+        srv.shutdown()
+    assert calls == []
@@ -0,0 +1,139 @@
+import pathlib
+import socket
+import subprocess
+import sys
+import time
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import comfy_pool
+
+# Stand-in for ComfyUI: answers GET /system_stats on the given port.
+_STUB = (
+    "import sys, http.server\n"
+    "class H(http.server.BaseHTTPRequestHandler):\n"
+    "    def do_GET(self):\n"
+    "        self.send_response(200); self.send_header('Content-Length', '2'); self.end_headers(); self.wfile.write(b'{}')\n"
+    "    def log_message(self, *a): pass\n"
+    "http.server.HTTPServer(('127.0.0.1', int(sys.argv[1])), H).serve_forever()\n"
+)
+
+
+def _free_base_port(n):
+    while True:
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        base = s.getsockname()[1]
+        s.close()
+        if base + n < 65535:
+            return base
+
+
+def _pool(tmp_path, active, standby):
+    script = tmp_path / "stub.py"
+    script.write_text(_STUB)
+    spawn = lambda inst: subprocess.Popen([sys.executable, str(script), str(inst.port)])
+    return comfy_pool.ComfyPool(spawn, _free_base_port(active + standby), str(tmp_path / "out"), str(tmp_path / "tmp"),
+                                active=active, standby=standby, startup_timeout=10, health_interval=0.05)
+
+
+def _wait(cond, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_standby_takes_over_and_crashed_instance_restarts(tmp_path):
+    pool = _pool(tmp_path, active=1, standby=1)
+    try:
+        pool.start()
+        assert _wait(lambda: all(i.state == comfy_pool.READY for i in pool.instances))
+        first = pool.acquire()
+        pool.release(first)
+        assert first.index == 0 and first.output_dir.endswith("out")
+
+        first.proc.kill()
+        first.proc.wait()
+        took_over = pool.acquire(timeout=1)  # no cold start: the standby is promoted
+        pool.release(took_over)
+        assert took_over.index == 1 and took_over.role == "active"
+
+        assert _wait(lambda: first.restarts == 1 and first.state == comfy_pool.READY)
+        assert first.role == "standby" and pool.instances[1].output_dir.endswith("out_1")
+    finally:
+        pool.stop()
+
+
+def test_jobs_go_to_least_loaded_instance(tmp_path):
+    pool = _pool(tmp_path, active=2, standby=0)
+    try:
+        pool.start()
+        assert _wait(lambda: all(i.state == comfy_pool.READY for i in pool.instances))
+        a = pool.acquire()
+        b = pool.acquire()
+        assert {a.index, b.index} == {0, 1}
+        pool.release(a)
+        assert pool.acquire() is a
+        assert [i["inflight"] for i in pool.status()] == [1, 1]
+    finally:
+        pool.stop()
+
+
+def test_stop_reaps_every_process_including_one_still_spawning(tmp_path):
+    pool = _pool(tmp_path, active=2, standby=0)
+    spawned = []
+    spawn = pool.spawn
+
+    def _slow_spawn(inst):
+        if inst.index == 1:
+            time.sleep(0.5)  # stop() arrives while this one is being spawned
+        spawned.append(spawn(inst))
+        return spawned[-1]
+
+    pool.spawn = _slow_spawn
+    pool.start()
+    pool.stop()
+
+    assert len(spawned) == 2
+    assert all(proc.returncode is not None for proc in spawned)
+    assert pool.instances[1].state == comfy_pool.DEAD
+
+
+def test_cpu_shards_split_cores_disjointly(monkeypatch):
+    monkeypatch.setattr(comfy_pool, "COMFY_CPU_SHARD_CORES", 4)
+    assert comfy_pool.shard_count(16, "auto") == 4
+    assert comfy_pool.shard_count(2, "auto") == 1
+    assert comfy_pool.shard_count(8, "32") == 8
+    sets = comfy_pool.cpu_sets(3, list(range(8)))
+    assert sets == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert comfy_pool.shard_env(sets[2])["OMP_NUM_THREADS"] == "2"
+
+    pool = comfy_pool.ComfyPool(lambda inst: None, 9000, "/o", "/t", active=3, standby=0, cpu_sets=sets)
+    assert [i.cpus for i in pool.instances] == sets
+    assert pool.status()[1]["cpus"] == [3, 4, 5]
+
+    # COMFY_INSTANCES above the shard count: capped, never two instances on one slice
+    pool = comfy_pool.ComfyPool(lambda inst: None, 9000, "/o", "/t", active=5, standby=1, cpu_sets=sets)
+    assert [i.cpus for i in pool.instances] == sets
+    assert [i.role for i in pool.instances] == ["active"] * 3
+
+
+def test_ready_hook_runs_for_standby_and_restarted_instances(tmp_path):
+    pool = _pool(tmp_path, active=1, standby=1)
+    ready = []
+    pool.on_ready = lambda inst: ready.append(inst.index) or inst.client.warmed.add("checkpoints/a.safetensors")
+    try:
+        pool.start()
+        assert _wait(lambda: sorted(ready) == [0, 1])
+        first = pool.instances[0]
+        first.proc.kill()
+        first.proc.wait()
+        assert _wait(lambda: first.restarts == 1 and ready.count(0) == 2)
+        assert first.client.warmed == {"checkpoints/a.safetensors"}  # re-warmed after the reset on launch
+    finally:
+        pool.stop()
@@ -0,0 +1,109 @@
+import pathlib
+import sys
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from shared import crypto_secure
+from shared.crypto_secure import decrypt_from_client, encrypt_for_server, gen_keypair_b64
+
+
+def test_box_cache_reuses_shared_key_and_clears_on_rotation():
+    crypto_secure.clear_key_cache()
+    pk, sk = gen_keypair_b64()
+    env = encrypt_for_server(pk, b"hello")
+    assert decrypt_from_client(sk, env["epk"], env["nonce"], env["ciphertext"]) == b"hello"
+
+    epk = crypto_secure.base64.b64decode(env["epk"])
+    box = crypto_secure.server_box(sk, epk)
+    assert crypto_secure.server_box(sk, epk) is box
+
+    pk2, sk2 = gen_keypair_b64()
+    assert crypto_secure.server_public_key_b64(sk2) == pk2
+    assert len(crypto_secure._BOX_CACHE) == 0
+
+
+def test_box_cache_is_bounded(monkeypatch):
+    crypto_secure.clear_key_cache()
+    monkeypatch.setattr(crypto_secure, "BOX_CACHE_SIZE", 3)
+    pk, sk = gen_keypair_b64()
+    for _ in range(5):
+        env = encrypt_for_server(pk, b"x")
+        decrypt_from_client(sk, env["epk"], env["nonce"], env["ciphertext"])
+    assert len(crypto_secure._BOX_CACHE) == 3
+
+
+def _stream_roundtrip(data, chunk_size, piece):
+    import io
+
+    pk, sk = gen_keypair_b64()
+    enc = crypto_secure.stream_encryptor_for_server(pk)
+    wire = b"".join(enc.encrypt_iter(crypto_secure.iter_chunks(io.BytesIO(data), chunk_size)))
+    dec = crypto_secure.stream_decryptor_from_client(sk)
+    pieces = [wire[i:i + piece] for i in range(0, len(wire), piece)]
+    return wire, sk, b"".join(dec.decrypt_iter(pieces))
+
+
+def test_stream_roundtrip_with_arbitrary_network_splits():
+    import os
+
+    for size in (0, 1, 4095, 4096, 10000):
+        data = os.urandom(size)
+        _, _, out = _stream_roundtrip(data, 4096, 777)
+        assert out == data
+
+
+def test_stream_rejects_truncation_and_tampering():
+    import os
+
+    import pytest
+
+    wire, sk, _ = _stream_roundtrip(os.urandom(10000), 4096, 1 << 20)
+
+    # drop the final frame: every remaining frame authenticates, but the stream is incomplete
+    final_frame = 4 + (10000 % 4096) + 17  # length prefix + last chunk + secretstream tag
+    dec = crypto_secure.stream_decryptor_from_client(sk)
+    with pytest.raises(ValueError):
+        list(dec.decrypt_iter([wire[:-final_frame]]))
+
+    tampered = bytearray(wire)
+    tampered[100] ^= 1
+    dec = crypto_secure.stream_decryptor_from_client(sk)
+    with pytest.raises(Exception):
+        list(dec.decrypt_iter([bytes(tampered)]))
+
+
+def test_stream_reply_to_client_epk():
+    from shared.crypto_secure import encrypt_for_server_session
+
+    pk, sk = gen_keypair_b64()
+    env, eph_sk = encrypt_for_server_session(pk, b"req")
+    enc = crypto_secure.stream_encryptor_to_client(sk, env["epk"])
+    wire = list(enc.encrypt_iter([b"a" * 10, b"b" * 5]))
+    dec = crypto_secure.stream_decryptor_from_server(eph_sk, pk)
+    assert b"".join(dec.decrypt_iter(wire)) == b"a" * 10 + b"b" * 5
+
+
+def test_replies_do_not_open_as_requests_or_uploads():
+    import base64
+
+    import pytest
+
+    pk, sk = crypto_secure.gen_keypair_b64()
+    _, eph_sk = crypto_secure.encrypt_for_server_session(pk, b"request")
+    epk = base64.b64encode(bytes(crypto_secure.load_private_key_b64(eph_sk).public_key)).decode()
+
+    stream = b"".join(crypto_secure.stream_encryptor_to_client(sk, epk).encrypt_iter([b"victim output"]))
+    with pytest.raises(Exception):
+        list(crypto_secure.stream_decryptor_from_client(sk).decrypt_iter([stream]))
+    opened = crypto_secure.stream_decryptor_from_server(eph_sk, pk).decrypt_iter([stream])
+    assert b"".join(opened) == b"victim output"
+
+    sealed = crypto_secure.encrypt_to_client(sk, epk, b"victim reply")
+    with pytest.raises(Exception):
+        crypto_secure.decrypt_from_client(sk, epk, sealed["nonce"], sealed["ciphertext"])
+    binary = base64.b64decode(epk) + base64.b64decode(sealed["nonce"]) + base64.b64decode(sealed["ciphertext"])
+    with pytest.raises(Exception):
+        crypto_secure.decrypt_from_client_binary(sk, binary)
+    assert crypto_secure.decrypt_from_server(eph_sk, pk, sealed["nonce"], sealed["ciphertext"]) == b"victim reply"
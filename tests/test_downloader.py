@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi.testclient import TestClient
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import downloader
+
+
+class _RangeServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    blob = b""
+    ranges = True
+    fail_after = None  # cut each ranged response after N bytes (simulated network drop)
+    hold = None  # threading.Event: responses wait for it before sending the body
+    seen = []
+    auth = []
+
+    def do_GET(self):
+        cls = type(self)
+        rng = self.headers.get("Range")
+        cls.seen.append(rng)
+        cls.auth.append(self.headers.get("Authorization"))
+        blob = cls.blob
+        if rng and cls.ranges:
+            first, last = map(int, re.match(r"bytes=(\d+)-(\d+)", rng).groups())
+            body = blob[first:last + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(blob)}")
+        else:
+            body = blob
+            self.send_response(200)
+        if cls.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if cls.hold is not None:
+            cls.hold.wait(5)
+        if rng and cls.fail_after is not None:
+            self.wfile.write(body[:cls.fail_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    handler = type("Handler", (_RangeServer,), {"blob": os.urandom(1_000_003), "seen": [], "auth": []})
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    monkeypatch.setattr(downloader, "DOWNLOAD_MIN_SPAN_BYTES", 100_000)
+    yield handler, f"http://127.0.0.1:{srv.server_address[1]}/model.safetensors"
+    srv.shutdown()
+
+
+def test_parallel_ranged_download_with_checksum(server, tmp_path):
+    handler, url = server
+    dest = tmp_path / "model.safetensors"
+    sha = hashlib.sha256(handler.blob).hexdigest()
+
+    res = downloader.download(url, lambda h: dest, connections=4, sha256=sha)
+
+    assert res["status"] == "ok" and res["connections"] == 4 and not res["resumed"]
+    assert dest.read_bytes() == handler.blob
+    assert sorted(r for r in handler.seen if r) == sorted(set(r for r in handler.seen if r))
+    assert len([r for r in handler.seen if r]) == 4
+    assert not (tmp_path / "model.safetensors.part").exists()
+    assert not (tmp_path / "model.safetensors.part.json").exists()
+
+
+def test_failed_download_resumes_from_part_file(server, tmp_path):
+    handler, url = server
+    dest = tmp_path / "model.safetensors"
+
+    handler.fail_after = 200_000
+    with pytest.raises(Exception):
+        downloader.download(url, lambda h: dest, connections=4)
+    assert not dest.exists()
+    manifest = json.loads((tmp_path / "model.safetensors.part.json").read_text())
+    saved = {first + done for first, last, done in manifest["spans"]}
+    assert all(0 < done <= 200_000 for _, _, done in manifest["spans"])
+
+    handler.fail_after = None
+    handler.seen.clear()
+    res = downloader.download(url, lambda h: dest, connections=4)
+
+    assert res["resumed"]
+    assert dest.read_bytes() == handler.blob
+    starts = {int(r.split("=")[1].split("-")[0]) for r in handler.seen if r}
+    assert starts == saved  # each span continued from its recorded offset
+
+
+def test_checksum_mismatch_and_non_range_server(server, tmp_path):
+    handler, url = server
+    dest = tmp_path / "model.safetensors"
+    with pytest.raises(downloader.DownloadError):
+        downloader.download(url, lambda h: dest, sha256="0" * 64)
+    assert not dest.exists() and not (tmp_path / "model.safetensors.part").exists()
+
+    handler.ranges = False
+    res = downloader.download(url, lambda h: dest, connections=4, sha256=hashlib.sha256(handler.blob).hexdigest())
+    assert res["connections"] == 1
+    assert dest.read_bytes() == handler.blob
+
+
+def test_concurrent_downloads_to_one_dest_take_turns(server, tmp_path):
+    handler, url = server
+    dest = tmp_path / "model.safetensors"
+    handler.hold = threading.Event()
+
+    def _dest_for(headers):
+        if dest.exists():
+            raise downloader.AlreadyExists(dest)
+        return dest
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(downloader.download(url, _dest_for, connections=4)))
+               for _ in range(2)]
+    for t in threads:
+        t.start()
+    time.sleep(0.3)  # both have their first response; only one may own the .part files
+    handler.hold.set()
+    for t in threads:
+        t.join(10)
+
+    assert sorted(r["status"] for r in results) == ["exists", "ok"]
+    assert dest.read_bytes() == handler.blob
+    assert len([r for r in handler.seen if r]) == 4  # one set of span requests
+
+
+def test_background_downloads_dedupe_and_report_progress(server, tmp_path, monkeypatch):
+    import importlib
+
+    handler, url = server
+    monkeypatch.setenv("COMFYUI_MODEL_DIR", str(tmp_path / "models"))
+    import phserver.worker_core as worker_core
+    import phserver.api_server as api_server
+
+    importlib.reload(worker_core)
+    api_server = importlib.reload(api_server)
+    monkeypatch.setattr(api_server, "init_comfy", lambda: None)
+    handler.hold = threading.Event()
+
+    body = {"url": url, "type": "checkpoints", "background": True}
+    with TestClient(api_server.app) as client:
+        first = client.post("/download", json=body).json()
+        again = client.post("/download", json=body).json()
+        batch = client.post("/download/batch", json={"items": [
+            {"url": url, "type": "checkpoints"},
+            {"url": url, "type": "loras"},
+            {"url": url, "filename": "../escape.bin"},
+        ]}).json()["downloads"]
+        handler.hold.set()
+
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            states = [client.get(f"/download/{t['id']}").json() for t in (first, batch[1])]
+            if all(s["status"] in ("COMPLETED", "FAILED") for s in states):
+                break
+            time.sleep(0.02)
+        missing = client.get("/download/nope")
+
+    assert first["status"] in ("IN_QUEUE", "IN_PROGRESS")
+    assert again["id"] == first["id"] and batch[0]["id"] == first["id"]
+    assert batch[1]["id"] != first["id"]
+    assert batch[2]["status"] == "FAILED" and "outside" in batch[2]["error"]
+    done = states[0]
+    assert done["status"] == "COMPLETED", done
+    assert done["bytes"] == done["total"] == len(handler.blob) and done["bytes_per_s"] > 0
+    assert (tmp_path / "models" / "checkpoints" / "model.safetensors").read_bytes() == handler.blob
+    assert (tmp_path / "models" / "loras" / "model.safetensors").read_bytes() == handler.blob
+    assert missing.status_code == 404
+
+
+def test_cross_host_redirect_drops_credentials(server, tmp_path):
+    handler, target = server
+
+    class _Redirect(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(302)
+            self.send_header("Location", target)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Redirect)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    dest = tmp_path / "model.safetensors"
+    try:
+        res = downloader.download(f"http://localhost:{srv.server_address[1]}/api/download/models/1", lambda h: dest,
+                                  headers={"Authorization": "Bearer SECRET"}, connections=4)
+    finally:
+        srv.shutdown()
+
+    assert res["status"] == "ok" and res["connections"] == 4
+    assert dest.read_bytes() == handler.blob
+    assert len(handler.auth) == 5 and not any(handler.auth)  # first hop via requests, then 4 spans
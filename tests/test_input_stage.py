@@ -0,0 +1,159 @@
+import base64
+import pathlib
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import input_stage, input_store
+
+
+class _SlowImages(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(0.2)
+        body = self.path.encode() * 100
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _SlowImages)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}"
+    srv.shutdown()
+
+
+@pytest.fixture
+def input_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(input_stage, "INPUT_DIR", str(tmp_path / "input"))
+    monkeypatch.setattr(input_store, "STORE", input_store.InputStore(str(tmp_path / "store"), budget=1000))
+    return tmp_path / "input"
+
+
+def test_url_fetches_run_concurrently(image_server, input_dir):
+    data = {"input_images": {f"f{i}.png": f"{image_server}/img{i}" for i in range(4)}}
+    t0 = time.perf_counter()
+    stats = input_stage.stage_inputs(data)
+    elapsed = time.perf_counter() - t0
+
+    assert elapsed < 0.6  # four 200 ms fetches overlap instead of adding up
+    assert [s["ok"] for s in stats] == [True] * 4
+    assert all(s["source"] == "url" and s["ms"] >= 150 for s in stats)
+    assert (input_dir / "f2.png").read_bytes() == b"/img2" * 100
+
+
+def test_size_cap_and_path_escape_are_per_file_failures(input_dir, monkeypatch):
+    monkeypatch.setattr(input_stage, "INPUT_MAX_BYTES", 8)
+    payload = base64.b64encode(b"0123456789").decode()
+    data = {
+        "input_blobs": {"ok.bin": b"1234"},
+        "input_images": {
+            "big.png": f"data:image/png;base64,{payload}",
+            "../escape.png": "data:image/png;base64,AAAA",
+        },
+    }
+    stats = input_stage.stage_inputs(data)
+
+    assert [s["ok"] for s in stats] == [True, False, False]
+    assert stats[1]["error"] == "InputTooLarge"
+    assert (input_dir / "ok.bin").read_bytes() == b"1234"
+    assert not (input_dir / "big.png").exists()
+    assert not (input_dir.parent / "escape.png").exists()
+
+
+def test_inputs_are_reusable_by_hash(input_dir):
+    import hashlib
+
+    blob = b"reference frame" * 10
+    sha = hashlib.sha256(blob).hexdigest()
+    assert input_store.STORE.probe([sha]) == {"present": [], "missing": [sha]}
+
+    input_stage.stage_inputs({"input_blobs": {"first.png": blob}})
+    assert input_store.STORE.probe([sha])["present"] == [sha]
+
+    stats = input_stage.stage_inputs({"input_images": {
+        "again.png": f"sha256:{sha}",
+        "ref.png": {"sha256": sha, "url": "http://unused.invalid/x"},
+        "gone.png": "sha256:" + "0" * 64,
+    }})
+    assert [(s["source"], s["ok"]) for s in stats] == [("store", True), ("ref", True), ("store", False)]
+    assert stats[2]["error"] == "InputNotStored"
+    assert (input_dir / "again.png").read_bytes() == blob
+    assert (input_dir / "ref.png").read_bytes() == blob
+
+
+def test_store_is_scoped_per_tenant(input_dir):
+    import hashlib
+
+    blob = b"private frame" * 10
+    sha = hashlib.sha256(blob).hexdigest()
+    input_stage.stage_inputs({"input_blobs": {"mine.png": blob}}, "client:alice")
+
+    assert input_store.STORE.probe([sha], "client:alice")["present"] == [sha]
+    assert input_store.STORE.probe([sha], "client:bob")["present"] == []
+    stats = input_stage.stage_inputs({"input_images": {"stolen.png": f"sha256:{sha}"}}, "client:bob")
+    assert stats[0]["ok"] is False and stats[0]["error"] == "InputNotStored"
+    assert not (input_dir / "stolen.png").exists()
+
+
+def test_store_evicts_least_recently_used(input_dir):
+    store = input_store.STORE
+    for i, name in enumerate(("a", "b", "c")):
+        input_stage.stage_inputs({"input_blobs": {f"{name}.bin": bytes([i]) * 400}})
+    # 3 x 400 bytes against a 1000 byte budget: the oldest entry ("a") is gone
+    usage = store.usage()
+    assert usage["entries"] == 2 and usage["bytes"] == 800
+    assert len(list((input_dir.parent / "store").iterdir())) == 2
+
+
+def test_concurrent_jobs_staging_one_name_do_not_share_a_temp_file(input_dir):
+    started = threading.Barrier(2)
+
+    def _chunks(byte):
+        started.wait(5)
+        for _ in range(50):
+            time.sleep(0.001)
+            yield byte * 1000
+
+    path = input_stage.input_path("same.png")
+    threads = [threading.Thread(target=input_stage._write_chunks, args=(path, _chunks(b), "")) for b in (b"a", b"b")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    data = (input_dir / "same.png").read_bytes()
+    assert data in (b"a" * 50000, b"b" * 50000)  # one complete upload, never interleaved
+    assert [p.name for p in input_dir.iterdir()] == ["same.png"]
+
+
+def test_staging_digests_feed_the_cache_key_without_rehashing(input_dir, monkeypatch):
+    import hashlib
+
+    from phserver import result_cache
+
+    blob = b"reference image"
+    url = "data:image/png;base64," + base64.b64encode(blob).decode()
+    data = {"input_images": {"ref.png": url}, "_input_digests": {"forged": "0" * 64}}
+    input_stage.stage_inputs(data)
+    assert data["_input_digests"] == {str((input_dir / "ref.png").resolve()): hashlib.sha256(blob).hexdigest()}
+
+    wf = {"1": {"class_type": "LoadImage", "inputs": {"image": "ref.png"}}}
+    with monkeypatch.context() as m:
+        m.setattr(result_cache, "file_sha256", lambda path: pytest.fail("staged input hashed again"))
+        key = result_cache.cache_key(wf, str(input_dir), str(input_dir / "models"), data["_input_digests"])
+    assert key == result_cache.cache_key(wf, str(input_dir), str(input_dir / "models"))
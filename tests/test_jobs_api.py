@@ -0,0 +1,98 @@
+import asyncio
+import pathlib
+import sys
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+
+@pytest.fixture
+def api(worker):
+    w = worker(JOB_QUEUE_MAX="2")
+    release = asyncio.Event()
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        if wf.get("wait"):
+            await release.wait()
+        if on_event:
+            for evt in (
+                {"type": "execution_start", "data": {"prompt_id": "p1"}},
+                {"type": "executing", "data": {"prompt_id": "p1", "node": "3"}},
+                {"type": "progress", "data": {"prompt_id": "p1", "node": "3", "value": 1, "max": 2}},
+                {"type": "executing", "data": {"prompt_id": "p1", "node": None}},
+            ):
+                on_event(evt)
+        return {"prompt_id": "p1", "history": {}}
+
+    return w.api
+
+
+def _poll(client, job_id, timeout=5):
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        body = client.get(f"/status/{job_id}").json()
+        if body["status"] in ("COMPLETED", "FAILED", "CANCELLED"):
+            return body
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+def test_job_submit_and_poll(api):
+    with TestClient(api.app) as client:
+        resp = client.post("/jobs", json={"workflow": {"1": {"class_type": "Note", "inputs": {}}}})
+        assert resp.status_code == 200
+        job = resp.json()
+        assert job["status"] in ("IN_QUEUE", "IN_PROGRESS")
+
+        done = _poll(client, job["id"])
+        assert done["status"] == "COMPLETED"
+        assert done["output"]["prompt_id"] == "p1"
+        assert "executionTime" in done
+
+        assert client.get("/jobs/does-not-exist").status_code == 404
+
+
+def test_job_cancel_and_queue_bound(api):
+    slow = {"workflow": {"wait": True}}
+    with TestClient(api.app) as client:
+        a = client.post("/jobs", json=slow).json()
+        client.post("/jobs", json=slow)
+        full = client.post("/jobs", json=slow)
+        assert full.status_code == 429
+
+        cancelled = client.delete(f"/jobs/{a['id']}").json()
+        assert cancelled["status"] == "CANCELLED"
+        assert client.post("/jobs", json=slow).status_code == 200
+
+
+def test_job_event_stream_encrypted_to_epk(api, monkeypatch):
+    import json
+
+    import phserver.worker_core as worker_core
+    from shared.crypto_secure import decrypt_from_server, encrypt_for_server_session, gen_keypair_b64
+
+    pk, sk = gen_keypair_b64()
+    monkeypatch.setattr(api, "WORKER_PRIVATE_KEY_B64", sk)
+    monkeypatch.setattr(worker_core, "WORKER_PRIVATE_KEY_B64", sk)
+    payload, eph_sk = encrypt_for_server_session(pk, json.dumps({"1": {"class_type": "Note", "inputs": {}}}).encode())
+    payload.update(encrypted=True, stream_encrypt=True)
+
+    with TestClient(api.app) as client:
+        job = client.post("/jobs", json=payload).json()
+        assert _poll(client, job["id"])["status"] == "COMPLETED"
+        with client.stream("GET", f"/jobs/{job['id']}/events") as resp:
+            lines = [ln for ln in resp.iter_lines() if ln.startswith("data: ")]
+
+    events = []
+    for ln in lines:
+        env = json.loads(ln[len("data: "):])
+        events.append(json.loads(decrypt_from_server(eph_sk, pk, env["nonce"], env["ciphertext"])))
+    assert [e["type"] for e in events] == ["start", "node_start", "progress", "node_done", "end", "status"]
+    assert events[-1]["status"] == "COMPLETED"
@@ -0,0 +1,57 @@
+import pathlib
+import sys
+
+from fastapi.testclient import TestClient
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import metrics
+
+
+def test_registry_renders_prometheus_text():
+    reg = metrics.Registry(prefix="t")
+    h = reg.histogram("stage_seconds", "per stage", buckets=(0.1, 1))
+    h.observe(0.05, stage="decrypt")
+    h.observe(0.5, stage="decrypt")
+    reg.counter("requests", "by outcome").inc(outcome="ok")
+    reg.gauge("queue_depth", "waiting", lambda: {metrics.labels(instance=0): 3})
+
+    text = reg.render()
+    assert '# TYPE t_stage_seconds histogram' in text
+    assert 't_stage_seconds_bucket{stage="decrypt",le="0.1"} 1' in text
+    assert 't_stage_seconds_bucket{stage="decrypt",le="1"} 2' in text
+    assert 't_stage_seconds_bucket{stage="decrypt",le="+Inf"} 2' in text
+    assert 't_stage_seconds_count{stage="decrypt"} 2' in text
+    assert 't_requests_total{outcome="ok"} 1' in text
+    assert 't_queue_depth{instance="0"} 3' in text
+    assert reg.snapshot()["stage_seconds"]["decrypt"]["count"] == 2
+
+
+def test_metrics_endpoint_reports_stages_without_workflow_contents(worker):
+    w = worker()
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        return {"prompt_id": "p-1", "history": {},
+                "_timings": {"submit": 0.002, "queue_wait": 0.3, "execution": 2.0, "history_fetch": 0.004}}
+
+    before = metrics.STAGE_SECONDS.summary().get("execution", {}).get("count", 0)
+    ok_before = metrics.REQUESTS.value(outcome="ok")
+
+    wf = {"1": {"class_type": "CLIPTextEncode", "inputs": {"text": "a very secret prompt"}}}
+    with TestClient(w.api.app) as client:
+        assert client.post("/run", json={"workflow": wf, "client_id": "tenant-a"}).status_code == 200
+        resp = client.get("/metrics")
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    text = resp.text
+    assert metrics.STAGE_SECONDS.summary()["execution"]["count"] == before + 1
+    assert metrics.REQUESTS.value(outcome="ok") == ok_before + 1
+    for stage in ("decrypt", "input_staging", "queue_wait", "execution", "history_fetch"):
+        assert f'comfy_worker_stage_seconds_count{{stage="{stage}"}}' in text
+    assert "comfy_worker_jobs_inflight 0" in text
+    assert "comfy_worker_tmpfs_bytes" in text and "comfy_worker_comfy_restarts" in text
+    assert "secret" not in text and "tenant-a" not in text
@@ -0,0 +1,82 @@
+import hashlib
+import importlib
+import json
+import os
+import pathlib
+import struct
+import sys
+
+from fastapi.testclient import TestClient
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import model_index
+
+
+def _safetensors(path: pathlib.Path, meta: dict, payload: bytes = b"\0" * 64):
+    header = json.dumps({"__metadata__": meta, "w": {"dtype": "F16", "shape": [32], "data_offsets": [0, 64]}}).encode()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(struct.pack("<Q", len(header)) + header + payload)
+
+
+def test_incremental_rescan_keeps_hashes_across_restarts(tmp_path, monkeypatch):
+    root = tmp_path / "models"
+    _safetensors(root / "checkpoints" / "sd15.safetensors", {"ss_base_model_version": "sd_v1"})
+    (root / "loras" / "style").mkdir(parents=True)
+    (root / "loras" / "style" / "ink.pt").write_bytes(b"lora-bytes")
+    (root / "loras" / "half.safetensors.part").write_bytes(b"in flight")
+
+    hashed = []
+    real = model_index.file_sha256
+    monkeypatch.setattr(model_index, "file_sha256", lambda p: hashed.append(p) or real(p))
+
+    idx = model_index.ModelIndex(str(root), ["checkpoints", "loras"])
+    assert idx.refresh() == {"files": 2, "added": 2, "changed": 0, "removed": 0}
+    assert idx.hash_pending() == 2
+    lora_sha = hashlib.sha256(b"lora-bytes").hexdigest()
+    assert idx.by_hash(lora_sha)["name"] == "style/ink.pt"
+    assert idx.by_hash(lora_sha[:10])["folder"] == "loras"
+    ls = idx.listing(metadata=True)
+    assert ls["checkpoints"][0]["metadata"] == {"ss_base_model_version": "sd_v1"}
+    assert [f["name"] for f in idx.listing(ext="pt")["loras"]] == ["style/ink.pt"]
+
+    # A new process loads the saved index and only re-reads what changed.
+    hashed.clear()
+    (root / "loras" / "style" / "ink.pt").write_bytes(b"lora-bytes-v2")
+    os.remove(root / "checkpoints" / "sd15.safetensors")
+    again = model_index.ModelIndex(str(root), ["checkpoints", "loras"])
+    assert again.refresh() == {"files": 1, "added": 0, "changed": 1, "removed": 1}
+    assert again.hash_pending() == 1 and len(hashed) == 1
+    assert again.by_hash(lora_sha) is None
+    assert again.by_hash(hashlib.sha256(b"lora-bytes-v2").hexdigest())["size"] == 13
+
+
+def test_models_ls_and_lookup_by_hash_endpoints(tmp_path, monkeypatch):
+    monkeypatch.setenv("COMFYUI_MODEL_DIR", str(tmp_path / "models"))
+    import phserver.worker_core as worker_core
+    import phserver.api_server as api_server
+
+    importlib.reload(worker_core)
+    api_server = importlib.reload(api_server)
+    monkeypatch.setattr(api_server, "init_comfy", lambda: None)
+
+    vae = tmp_path / "models" / "vae" / "kl-f8.safetensors"
+    _safetensors(vae, {"format": "pt"})
+    sha = hashlib.sha256(vae.read_bytes()).hexdigest()
+
+    with TestClient(api_server.app) as client:
+        first = client.get("/models/ls", params={"type": "vae"}).json()
+        api_server.MODELS.wait(5)
+        found = client.get(f"/models/by-hash/{sha}")
+        missing = client.get(f"/models/by-hash/{'0' * 64}")
+        filtered = client.get("/models/ls", params={"q": "nothing-matches"}).json()
+        bad = client.get("/models/ls", params={"type": "bogus"})
+
+    assert list(first["models"]) == ["vae"]
+    assert first["models"]["vae"][0]["name"] == "kl-f8.safetensors"
+    assert found.status_code == 200 and found.json()["path"] == str(vae)
+    assert missing.status_code == 404
+    assert all(files == [] for files in filtered["models"].values())
+    assert bad.status_code == 400
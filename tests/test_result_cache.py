@@ -0,0 +1,73 @@
+import base64
+import pathlib
+import sys
+
+from fastapi.testclient import TestClient
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import result_cache
+
+
+def test_cache_key_covers_inputs_and_skips_nondeterministic_nodes(tmp_path):
+    inputs = tmp_path / "input"
+    inputs.mkdir()
+    (inputs / "ref.png").write_bytes(b"one")
+    wf = {"1": {"class_type": "LoadImage", "inputs": {"image": "ref.png"}},
+          "2": {"class_type": "KSampler", "inputs": {"seed": 5}}}
+
+    k1 = result_cache.cache_key(wf, str(inputs), str(tmp_path / "models"))
+    reordered = {"2": wf["2"], "1": wf["1"]}
+    assert result_cache.cache_key(reordered, str(inputs), str(tmp_path / "models")) == k1
+    (inputs / "ref.png").write_bytes(b"two")
+    assert result_cache.cache_key(wf, str(inputs), str(tmp_path / "models")) != k1
+    assert result_cache.cache_key({**wf, "3": {"class_type": "RandomNoise", "inputs": {}}},
+                                  str(inputs), str(tmp_path / "models")) is None
+
+
+def test_entries_are_encrypted_and_evicted(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path / "c"), budget=600, ttl_s=60, server_sk_b64="k")
+    cache.put("a" * 64, {"history": {"secret": 1}}, {"0": b"pixels" * 50})
+    raw = (tmp_path / "c" / ("a" * 64)).read_bytes()
+    assert b"secret" not in raw and b"pixels" not in raw
+    assert cache.get("a" * 64)[1]["0"] == b"pixels" * 50
+
+    cache.put("b" * 64, {"history": {}}, {"0": b"x" * 300})
+    assert cache.get("a" * 64) is None  # least recently used entry went over budget
+    assert cache.stats()["entries"] == 1 and cache.stats()["hits"] == 1
+
+
+def test_duplicate_run_is_served_from_cache(tmp_path, monkeypatch, worker):
+    w = worker()
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    monkeypatch.setattr(w.core, "OUTPUT_DIR", str(out_dir))
+    monkeypatch.setattr(w.core, "RESULTS", result_cache.ResultCache(str(tmp_path / "cache"), budget=10**6))
+    runs = []
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        runs.append(client_id)
+        (out_dir / "img_00001_.png").write_bytes(b"png-bytes")
+        hist = {"p-1": {"status": {"status_str": "success"},
+                        "outputs": {"9": {"images": [{"filename": "img_00001_.png", "subfolder": "", "type": "output"}]}}}}
+        return {"prompt_id": "p-1", "history": hist}
+
+    wf = {"9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "img"}}}
+    with TestClient(w.api.app) as client:
+        first = client.post("/run", json={"workflow": wf, "return_outputs": True}).json()
+        second = client.post("/run", json={"workflow": wf, "return_outputs": True}).json()
+        bypass = client.post("/run", json={"workflow": wf, "cache": False}).json()
+        other = client.post("/run", json={"workflow": wf, "client_id": "tenant-b"}).json()
+        monkeypatch.setattr(result_cache, "RESULT_CACHE_SHARED", True)
+        client.post("/run", json={"workflow": wf, "client_id": "tenant-c"})
+        shared = client.post("/run", json={"workflow": wf, "client_id": "tenant-d"}).json()
+
+    assert len(runs) == 4  # the second and last requests never reached ComfyUI
+    assert "cached" not in first and second["cached"] is True and "cached" not in bypass
+    assert "cached" not in other  # another tenant's identical job is not served from the first one's entry
+    assert "cached" not in shared  # opted-in cross-tenant hits are not reported
+    assert base64.b64decode(second["outputs"]["files"][0]["data_b64"]) == b"png-bytes"
+    assert second["outputs"]["files"][0]["name"].startswith("cached_")
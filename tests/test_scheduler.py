@@ -0,0 +1,103 @@
+import asyncio
+import pathlib
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import scheduler
+
+
+async def _order(sched, jobs):
+    """Run (client, priority) jobs through sched one at a time; returns the start order."""
+    started = []
+    gate = asyncio.Event()
+
+    async def _job(i, client, prio):
+        ticket = sched.enqueue(client, prio)
+        await ticket.acquire()
+        started.append(i)
+        await gate.wait()
+        ticket.release()
+
+    blocker = sched.enqueue("blocker", "normal")
+    await blocker.acquire()  # hold the only slot while everyone queues up
+    tasks = [asyncio.create_task(_job(i, c, p)) for i, (c, p) in enumerate(jobs)]
+    await asyncio.sleep(0)
+    blocker.release()
+    gate.set()
+    await asyncio.gather(*tasks)
+    return started
+
+
+def test_priority_first_then_round_robin_across_clients():
+    jobs = [("bulk", "low")] + [("bulk", "normal")] * 4 + [("alice", "normal"), ("bob", "normal"), ("ui", "high")]
+    order = asyncio.run(_order(scheduler.Scheduler(concurrency=1, max_queue=64, max_per_client=16), jobs))
+    assert order[0] == 7  # high priority jumps the queue
+    assert order[1:5] == [1, 5, 6, 2]  # bulk, alice, bob, then bulk's next turn
+    assert order[-1] == 0  # low runs last
+
+
+def test_queue_full_and_cancelled_waiters_give_back_their_place():
+    async def _go():
+        sched = scheduler.Scheduler(concurrency=1, max_queue=3, max_per_client=1)
+        running = sched.enqueue("a")
+        await running.acquire()
+        waiting = asyncio.create_task(sched.enqueue("a").acquire())
+        sched.enqueue("b")
+        with pytest.raises(scheduler.QueueFull):
+            sched.enqueue("a")  # per-client bound
+        sched.enqueue("c")
+        with pytest.raises(scheduler.QueueFull) as exc:
+            sched.enqueue("d")  # global bound
+        assert exc.value.retry_after >= 1 and sched.rejected == 2
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert sched.queued("a") == 0 and sched.running == 1
+        running.release()
+        running.release()  # idempotent
+        return sched
+
+    sched = asyncio.run(_go())
+    assert sched.running == 0
+
+
+def test_api_returns_429_with_retry_after(worker):
+    api_server = worker(SCHED_CONCURRENCY="1", SCHED_MAX_QUEUE="0").api
+
+    wf = {"1": {"class_type": "Note", "inputs": {}}}
+    with TestClient(api_server.app) as client:
+        for path in ("/run", "/jobs"):
+            resp = client.post(path, json={"workflow": wf, "priority": "high"})
+            assert resp.status_code == 429, path
+            assert int(resp.headers["Retry-After"]) >= 1
+            assert resp.json()["detail"].startswith("queue_full")
+
+
+def test_requests_without_client_id_share_one_bucket(worker):
+    w = worker(SCHED_CONCURRENCY="1", SCHED_MAX_PER_CLIENT="1")
+    release = asyncio.Event()
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        await release.wait()
+        return {"prompt_id": "p", "history": {}}
+
+    async def _go():
+        # a fresh epk per request, as encrypt_for_server makes, must not mean a fresh client
+        reqs = [{"workflow": {"1": {"class_type": "Note", "inputs": {"text": str(i)}}}, "epk": f"k{i}"}
+                for i in range(3)]
+        tasks = [asyncio.create_task(w.core.handle_request_async(r)) for r in reqs]
+        await asyncio.sleep(0.2)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(_go())
+    rejected = [r for r in results if r.get("error")]
+    assert rejected and len(rejected) < 3
+    assert all(r["error"].startswith("queue_full: too many queued jobs for this client") for r in rejected)
@@ -0,0 +1,184 @@
+import asyncio
+import base64
+import pathlib
+import sys
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+
+def test_identical_requests_share_one_execution_per_client(tmp_path, monkeypatch, worker):
+    w = worker()
+    worker_core = w.core
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    monkeypatch.setattr(worker_core, "OUTPUT_DIR", str(out_dir))
+    runs = []
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        runs.append(client_id)
+        n = len(runs)
+        await asyncio.sleep(0.1)
+        (out_dir / f"img_{n}.png").write_bytes(b"img-%d" % n)
+        hist = {f"p-{n}": {"outputs": {"9": {"images": [{"filename": f"img_{n}.png", "subfolder": "", "type": "output"}]}}}}
+        return {"prompt_id": f"p-{n}", "history": hist}
+
+    wf = {"9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "img"}}}
+
+    async def _burst():
+        reqs = [{"workflow": wf, "client_id": cid, "return_outputs": True} for cid in ("a", "a", "a", "b")]
+        return await asyncio.gather(*(worker_core.handle_request_async(r) for r in reqs))
+
+    saved = worker_core.FLIGHTS.saved
+    a1, a2, a3, b = asyncio.run(_burst())
+
+    assert len(runs) == 2  # one execution for tenant a, one for tenant b
+    assert worker_core.FLIGHTS.saved == saved + 2 and len(worker_core.FLIGHTS) == 0
+    assert "shared" not in a1 and a2["shared"] and a3["shared"] and "shared" not in b
+    assert a2["prompt_id"] == a1["prompt_id"] != b["prompt_id"]
+    data = {base64.b64decode(r["outputs"]["files"][0]["data_b64"]) for r in (a1, a2, a3)}
+    assert len(data) == 1  # every follower got its own copy of the leader's output
+
+
+def test_cancelled_leader_keeps_running_for_followers_only(tmp_path, monkeypatch, worker):
+    w = worker()
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    monkeypatch.setattr(w.core, "OUTPUT_DIR", str(out_dir))
+    state = {"runs": 0, "cancelled": 0}
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        state["runs"] += 1
+        try:
+            await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            state["cancelled"] += 1  # what interrupts the prompt in ComfyUI
+            raise
+        (out_dir / "img.png").write_bytes(b"img")
+        return {"prompt_id": "p-1", "history": {"p-1": {"outputs": {"9": {"images": [
+            {"filename": "img.png", "subfolder": "", "type": "output"}]}}}}}
+
+    def _req(text):
+        return {"workflow": {"9": {"class_type": "SaveImage", "inputs": {"filename_prefix": text}}},
+                "client_id": "a", "return_outputs": True}
+
+    async def _go():
+        # a retry joins the leader, then the leader's client goes away
+        leader = asyncio.create_task(w.core.handle_request_async(_req("x")))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(w.core.handle_request_async(_req("x")))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        shared = await follower
+
+        # alone, a cancelled leader cancels its prompt
+        alone = asyncio.create_task(w.core.handle_request_async(_req("y")))
+        await asyncio.sleep(0.05)
+        alone.cancel()
+        await asyncio.gather(alone, return_exceptions=True)
+
+        # a run kept for followers is cancelled once the last of them leaves too
+        leader = asyncio.create_task(w.core.handle_request_async(_req("z")))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(w.core.handle_request_async(_req("z")))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        await asyncio.gather(leader, follower, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        return shared
+
+    shared = asyncio.run(_go())
+    assert shared["shared"] and shared["prompt_id"] == "p-1"
+    assert base64.b64decode(shared["outputs"]["files"][0]["data_b64"]) == b"img"
+    assert state == {"runs": 3, "cancelled": 2} and len(w.core.FLIGHTS) == 0
+
+
+def test_follower_that_times_out_is_not_counted_as_saved(worker):
+    w = worker()
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        await asyncio.sleep(0.3)
+        return {"prompt_id": "p-1", "history": {}}
+
+    req = {"workflow": {"9": {"class_type": "SaveImage", "inputs": {}}}, "client_id": "a"}
+
+    async def _go():
+        leader = asyncio.create_task(w.core.handle_request_async(dict(req)))
+        await asyncio.sleep(0.05)
+        impatient = await w.core.handle_request_async({**req, "timeout_s": 0.05})
+        return impatient, await leader
+
+    saved = w.core.FLIGHTS.saved
+    impatient, leader = asyncio.run(_go())
+    assert "error" in impatient and "error" not in leader
+    assert w.core.FLIGHTS.saved == saved
+
+
+def test_abandoned_leader_keeps_its_scheduler_slot_until_the_run_ends(worker):
+    w = worker(SCHED_CONCURRENCY="1")
+    seen = {}
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        await asyncio.sleep(0.3)
+        seen["running_at_end"] = w.core.SCHEDULER.running
+        return {"prompt_id": "p-1", "history": {}}
+
+    req = {"workflow": {"9": {"class_type": "SaveImage", "inputs": {}}}, "client_id": "a"}
+
+    async def _go():
+        leader = asyncio.create_task(w.core.handle_request_async(dict(req)))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(w.core.handle_request_async(dict(req)))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        seen["running_after_cancel"] = w.core.SCHEDULER.running
+        await follower
+        await asyncio.sleep(0.01)
+        seen["running_after"] = w.core.SCHEDULER.running
+
+    asyncio.run(_go())
+    assert seen == {"running_after_cancel": 1, "running_at_end": 1, "running_after": 0}
+
+
+def test_sealed_tenant_key_lets_fresh_epks_share_a_run(worker, monkeypatch):
+    import json
+
+    from shared.crypto_secure import encrypt_for_server, gen_keypair_b64
+
+    w = worker()
+    pk, sk = gen_keypair_b64()
+    monkeypatch.setattr(w.core, "WORKER_PRIVATE_KEY_B64", sk)
+    runs = []
+
+    @w.fake_run
+    async def _fake_run(wf, client_id, on_event=None, deadline=None):
+        runs.append(client_id)
+        await asyncio.sleep(0.2)
+        return {"prompt_id": f"p-{len(runs)}", "history": {}}
+
+    wf = {"9": {"class_type": "SaveImage", "inputs": {}}}
+
+    def _req(tenant_key):
+        sealed = {"workflow": wf, "client_id": "a"}
+        if tenant_key:
+            sealed["tenant_key"] = tenant_key
+        return {"encrypted": True, **encrypt_for_server(pk, json.dumps(sealed).encode())}  # a fresh epk each time
+
+    async def _burst():
+        reqs = [_req("k1"), _req("k1"), _req("k2"), _req(None),
+                {**_req(None), "tenant_key": "k1"}]  # outside the envelope: ignored
+        return await asyncio.gather(*(w.core.handle_request_async(r) for r in reqs))
+
+    k1a, k1b, k2, bare, forged = asyncio.run(_burst())
+    assert len(runs) == 4
+    assert sorted(bool(r.get("shared")) for r in (k1a, k1b)) == [False, True]  # either may lead
+    assert k1b["prompt_id"] == k1a["prompt_id"]
+    assert not any(r.get("shared") for r in (k2, bare, forged))
@@ -0,0 +1,79 @@
+import logging
+import os
+import time
+
+from phserver import tmpfs_manager
+
+
+def _write(path, size, age=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    if age:
+        t = time.time() - age
+        os.utime(path, (t, t))
+    return str(path)
+
+
+def test_lease_deletes_on_finish_unless_another_job_holds_the_file(tmp_path):
+    mgr = tmpfs_manager.TmpfsManager(lambda: [str(tmp_path)], budget=10**9)
+    shared = _write(tmp_path / "in" / "ref.png", 10)
+    out = _write(tmp_path / "out" / "img.png", 10)
+
+    a, b = mgr.lease(), mgr.lease()
+    a.hold([shared, out])
+    b.hold([shared])
+    mgr.finish(a)
+    assert mgr.drain()
+    assert not os.path.exists(out)
+    assert os.path.exists(shared)  # b still needs it
+
+    mgr.finish(b)
+    assert mgr.drain()
+    assert not os.path.exists(shared)
+    assert mgr.stats()["deleted"] == 2 and mgr.stats()["held"] == 0
+
+
+def test_sweep_expires_old_files_and_evicts_oldest_over_budget(tmp_path, caplog):
+    caplog.set_level(logging.WARNING, logger="worker")
+    parked = _write(tmp_path / "parked.png", 100, age=50)
+    mgr = tmpfs_manager.TmpfsManager(lambda: [str(tmp_path)], budget=300, ttl_s=60, pressure_ratio=0.8,
+                                     keep=lambda p: p == os.path.realpath(parked))
+    stale = _write(tmp_path / "stale.png", 100, age=120)
+    old = _write(tmp_path / "old.png", 100, age=40)
+    held = _write(tmp_path / "held.png", 100, age=30)
+    new = _write(tmp_path / "new.png", 100, age=1)
+    lease = mgr.lease()
+    lease.hold([held])
+
+    stats = mgr.sweep()
+    assert not os.path.exists(stale)  # past the TTL
+    assert not os.path.exists(old)    # oldest unheld file, evicted to get under budget
+    assert os.path.exists(parked) and os.path.exists(held) and os.path.exists(new)
+    assert stats["expired"] == 1 and stats["evicted"] == 1
+    assert stats["bytes"] == 300 and stats["files"] == 3
+    assert stats["pressure"] and stats["pressure_alerts"] == 1
+    assert "tmpfs usage" in caplog.text
+
+
+def test_wipe_only_unlinks_hard_links(tmp_path):
+    store = _write(tmp_path / "store" / "abc", 16)
+    staged = tmp_path / "input" / "ref.png"
+    staged.parent.mkdir()
+    os.link(store, staged)
+
+    tmpfs_manager.wipe(str(staged))
+    assert not staged.exists()
+    with open(store, "rb") as f:
+        assert f.read() == b"x" * 16  # the input store's copy is not zeroed
+
+
+def test_expired_parked_output_is_no_longer_spared(tmp_path):
+    from phserver import output_stage
+
+    parked = output_stage.Parked(retention_s=0)
+    path = _write(tmp_path / "out" / "big.mp4", 100)
+    parked.park(path, None)
+    mgr = tmpfs_manager.TmpfsManager(lambda: [str(tmp_path)], budget=10, ttl_s=0, keep=parked.holds)
+
+    mgr.sweep()
+    assert not os.path.exists(path)
@@ -0,0 +1,97 @@
+import pathlib
+import sys
+import threading
+
+from fastapi.testclient import TestClient
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from phserver import warmup
+
+
+def test_warmer_caches_files_and_loads_checkpoints(tmp_path, monkeypatch):
+    (tmp_path / "checkpoints").mkdir()
+    (tmp_path / "checkpoints" / "sd15.safetensors").write_bytes(b"x" * 1000)
+    (tmp_path / "vae").mkdir()
+    (tmp_path / "vae" / "kl.safetensors").write_bytes(b"y" * 10)
+    prompts = []
+    monkeypatch.setattr(warmup.comfy_client, "run_workflow_and_wait",
+                        lambda wf, cid, deadline=None: prompts.append(wf) or {"prompt_id": "w"})
+
+    assert warmup.readahead(str(tmp_path / "vae" / "kl.safetensors"), force_read=True) == 10
+    w = warmup.Warmer(str(tmp_path), ["checkpoints/sd15.safetensors", "vae/kl.safetensors", "../etc/passwd", "loras/missing.pt"])
+    assert not w.ready
+    state = w.run()
+
+    assert state["ready"] and state["status"] == "ready"
+    assert set(state["errors"]) == {"../etc/passwd", "loras/missing.pt"}
+    assert len(prompts) == 1 and prompts[0]["1"]["inputs"] == {"ckpt_name": "sd15.safetensors"}
+    assert set(state["ms"]) == set(w.models)
+
+
+def test_warm_client_loads_each_checkpoint_once_per_process(tmp_path):
+    (tmp_path / "checkpoints").mkdir()
+    (tmp_path / "checkpoints" / "sd15.safetensors").write_bytes(b"x")
+
+    class _Client:
+        def __init__(self):
+            self.warmed = set()
+            self.prompts = []
+
+        def run_workflow_and_wait(self, wf, cid, deadline=None):
+            self.prompts.append(wf)
+            return {"prompt_id": "w"}
+
+    client = _Client()
+    w = warmup.Warmer(str(tmp_path), ["checkpoints/sd15.safetensors", "checkpoints/missing.safetensors"],
+                      clients=lambda: [client])
+    w.run()
+    w.warm_client(client)  # the pool's ready hook racing the startup warm-up
+    assert len(client.prompts) == 1
+
+    client.warmed.clear()  # what the pool does when it relaunches the process
+    w.warm_client(client)
+    assert len(client.prompts) == 2
+
+
+def test_healthz_is_unavailable_until_warm(tmp_path, monkeypatch, worker):
+    monkeypatch.setattr(warmup, "PRELOAD_MODELS", "checkpoints/a.safetensors")
+    (tmp_path / "checkpoints").mkdir()
+    (tmp_path / "checkpoints" / "a.safetensors").write_bytes(b"z")
+    api_server = worker(COMFYUI_MODEL_DIR=str(tmp_path)).api
+    release = threading.Event()
+    monkeypatch.setattr(warmup.comfy_client, "run_workflow_and_wait", lambda wf, cid, deadline=None: release.wait(5) and {})
+
+    with TestClient(api_server.app) as client:
+        cold = client.get("/healthz")
+        release.set()
+        api_server.WARMER.wait(5)
+        warm = client.get("/healthz")
+
+    assert cold.status_code == 503 and cold.json()["warmup"]["status"] == "warming"
+    assert warm.status_code == 200 and warm.json()["ok"] is True
+
+
+def test_warmup_prompt_past_its_deadline_counts_as_failed(tmp_path, monkeypatch):
+    import time
+
+    (tmp_path / "checkpoints").mkdir()
+    (tmp_path / "checkpoints" / "slow.safetensors").write_bytes(b"x")
+    monkeypatch.setattr(warmup, "WARMUP_TIMEOUT", 5)
+
+    class _Client:
+        warmed = set()
+
+        def run_workflow_and_wait(self, wf, cid, deadline=None):
+            self.deadline = deadline
+            raise warmup.comfy_client.PromptTimeout("w", "running")
+
+    client = _Client()
+    t0 = time.time()
+    state = warmup.Warmer(str(tmp_path), ["checkpoints/slow.safetensors"], clients=lambda: [client]).run()
+
+    assert t0 + 5 <= client.deadline <= time.time() + 5
+    assert state["ready"] and "PromptTimeout" in state["errors"]["checkpoints/slow.safetensors"]
+    assert client.warmed == set()  # tried again when the process restarts